@@ -3,25 +3,48 @@
 
 # IJ imports
 # TODO: are the imports RoiManager and ResultsTable needed when using the services?
-from ij import IJ, WindowManager as wm
-from ij.plugin import Duplicator, RoiEnlarger, RoiScaler
-from trainableSegmentation import WekaSegmentation
-from de.biovoxxel.toolbox import Extended_Particle_Analyzer
-from ij.measure import ResultsTable
-
-# Bio-formats imports
-from loci.plugins import BF
-from loci.plugins.in import ImporterOptions
+from ij import IJ, ImagePlus
+from ij.plugin import Duplicator, RoiEnlarger
+from ij.measure import ResultsTable, Measurements
+from ij.plugin.filter import Analyzer
+from ij.plugin.frame import RoiManager
+from ij.process import ByteProcessor
+
+# Java imports
+from java.awt import GraphicsEnvironment
+from java.io import RandomAccessFile
+from java.lang import Runtime, String
+from java.nio import ByteBuffer
 
 # python imports
 import time
 import os
+from array import array
+
+# shared helpers, see jars/Lib/myosoft_common.py
+from myosoft_common import (HISTOGRAM_TILE_SIZE, fix_ij_dirs, preprocess_membrane_channel,
+                            apply_weka_model, get_file_hash, get_image_key,
+                            get_probability_map_cache_key, open_cached_probability_map,
+                            save_probability_map_to_cache, is_journal_complete, write_journal,
+                            process_weka_result, delete_channel, build_particle_shape_table,
+                            gate_particle_shape_table, open_image_reader,
+                            get_calibration_from_reader, open_series_from_reader,
+                            get_image_title_from_path, read_tile, get_threshold_from_histogram,
+                            get_cached_channel_histogram, open_channel_downsampled, scale_roi,
+                            measure_in_all_rois, change_all_roi_color, change_subset_roi_color,
+                            show_all_rois_on_image, write_roi_store, get_flag_column, save_all_rois,
+                            save_selected_rois, enlarge_all_rois, enlarge_all_rois_without_overlap,
+                            measure_rois, get_results_columns, add_yes_no_column, write_results,
+                            enhance_contrast, renumber_rois, save_overview_png, start_stage_timer,
+                            time_stage, write_stage_timings, save_log, setup_defined_ij,
+                            get_tile_grid, log)
 
 #@ String (visibility=MESSAGE, value="<html><b> Welcome to Myosoft - identify fibers! </b></html>") msg1
 #@ File (label="Select directory with classifiers", style="directory") classifiers_dir
 #@ File (label="Select directory for output", style="directory") output_dir
 #@ File (label="Select image file", description="select your image")  path_to_image
 #@ Boolean (label="close image after processing", description="tick this box when using batch mode", value=False) close_raw
+#@ Boolean (label="only re-run the gates on the saved binary", description="skip the segmentation and use the (possibly manually edited) _all_fibers_binary.tif of a previous run, not in whole-slide mode", value=False) rerun_gates_only
 #@ String (visibility=MESSAGE, value="<html><b> Morphometric Gates </b></html>") msg2
 #@ Integer (label="Min Area [um²]", value=10) minAr
 #@ Integer (label="Max Area [um²]", value=6000) maxAr
@@ -39,350 +62,306 @@ import os
 #@ Float (label="Max roundess", value=1) maxRnd
 #@ String (visibility=MESSAGE, value="<html><b> Expand ROIS to match fibers </b></html>") msg3
 #@ Float (label="ROI expansion [microns]", value=1) enlarge
+#@ Boolean (label="expand ROIs without overlap", description="grow all ROIs at once on a distance map, pixels between fibers go to the nearest fiber", value=False) enlarge_without_overlap
 #@ String (visibility=MESSAGE, value="<html><b> channel positions in the hyperstack </b></html>") msg5
 #@ Integer (label="Membrane staining channel number", style="slider", min=1, max=5, value=1) membrane_channel
 #@ Integer (label="Fiber staining (MHC) channel number (0=skip)", style="slider", min=0, max=5, value=3) fiber_channel
 #@ Integer (label="minimum fiber intensity (0=auto)", description="0 = automatic threshold detection", value=0) min_fiber_intensity
 #@ Integer (label="sub-tiling to economize RAM", style="slider", min=1, max=8, value=4) tiling_factor
+#@ Float (label="segmentation pixel size [um] (0=full resolution)", description="segment the membrane channel downsampled to this pixel size (using the resolution pyramid if present), the ROIs are scaled back to full resolution", value=0) segmentation_pixel_size
+#@ Integer (label="whole-slide tile size [px] (0=off)", description="read and segment the image tile by tile, for slides that do not fit into RAM. Segmentation pixel size, expansion without overlap, probability map cache and gate-only re-run are not available then", value=0) slide_tile_size
+#@ Integer (label="whole-slide tile overlap [px]", description="should be larger than the largest fiber", value=256) slide_tile_overlap
+#@ Integer (label="WEKA threads (0=all cores)", description="limit this when running several images in parallel, see batch_runner.py", value=0) weka_threads
+#@ Integer (label="classifier cache size [MB] (0=off)", description="keep loaded classifiers in memory for the next image, useful in batch mode", value=256) classifier_cache_mb
+#@ Integer (label="probability map cache size [MB] (0=off)", description="store WEKA results in the output directory, re-running the morphometric gates then skips the segmentation", value=4096) probability_cache_mb
+#@ Boolean (label="also save ROI-zips", description="all ROIs and their classes are saved in one .roistore, tick this for RoiManager compatible zips, e.g. for manual curation", value=True) save_roi_zips
+#@ Integer (label="overview PNG maximum size [px] (0=full resolution)", description="the overview PNG is downsampled so that its longer side is at most this size", value=4096) overview_max_size
+#@ Boolean (label="save a zoomable full resolution overview", description="a Deep Zoom pyramid of PNG tiles next to the overview PNG, e.g. for OpenSeadragon", value=False) overview_pyramid
 
-#@ RoiManager rm
-#@ ResultsTable rt
-
-
-def fix_ij_options():
-    """put IJ into a defined state
-    """
-    # disable inverting LUT
-    IJ.run("Appearance...", " menu=0 16-bit=Automatic")
-    # set foreground color to be white, background black
-    IJ.run("Colors...", "foreground=white background=black selection=red")
-    # black BG for binary images and pad edges when eroding
-    IJ.run("Options...", "black pad")
-    # set saving format to .txt files
-    IJ.run("Input/Output...", "file=.txt save_column save_row")
-    # ============= DON’T MOVE UPWARDS =============
-    # set "Black Background" in "Binary Options"
-    IJ.run("Options...", "black")
-    # scale when converting = checked
-    IJ.run("Conversions...", "scale")
-
-
-def fix_ij_dirs(path):
-    """use forward slashes in directory paths
-
-    Parameters
-    ----------
-    path : string
-        a directory path obtained from dialogue or script parameter
-
-    Returns
-    -------
-    string
-        a more robust path with forward slashes as separators
-    """
-
-    fixed_path = str(path).replace("\\", "/")
-    # fixed_path = fixed_path + "/"
 
-    return fixed_path
+def get_saturated_range_from_histogram(histogram, saturated, lower_limit, upper_limit):
+    """get the display range that saturates the given percentage of pixels, like "Enhance Contrast"
 
-
-def open_image_with_BF(path_to_file):
-    """ use Bio-Formats to opens the first image from an image file path
+    Pixels outside of the limits are counted as if they were clipped to the limits, i.e. the range is
+    computed on the histogram of an image whose LUT was already applied with these limits.
 
     Parameters
     ----------
-    path_to_file : string
-        path to the image file
+    histogram : array
+        the pixel count of every intensity value
+    saturated : float
+        the percentage of saturated pixels, split equally between the dark and the bright end
+    lower_limit : integer
+        the lower limit of a previously applied display range
+    upper_limit : integer
+        the upper limit of a previously applied display range
 
     Returns
     -------
-    ImagePlus
-        the first imp stored in a give file
+    list
+        the lower and the upper value of the display range
     """
-    options = ImporterOptions()
-    options.setColorMode(ImporterOptions.COLOR_MODE_GRAYSCALE)
-    options.setAutoscale(True)
-    options.setId(path_to_file)
-    imps = BF.openImagePlus(options) # is an array of ImagePlus
+    threshold = sum(histogram) * saturated / 200.0
 
-    return imps[0]
+    lower = lower_limit
+    count = 0
+    for value in range(0, upper_limit + 1):
+        count += histogram[value]
+        if count > threshold:
+            lower = max(value, lower_limit)
+            break
 
+    upper = upper_limit
+    count = 0
+    for value in range(len(histogram) - 1, lower_limit - 1, -1):
+        count += histogram[value]
+        if count > threshold:
+            upper = min(value, upper_limit)
+            break
 
-def fix_BF_czi_imagetitle(imp):
-    image_title = os.path.basename( imp.getShortTitle() )
-    image_title = image_title.replace(".czi", "")
-    image_title = image_title.replace(" ", "_")
-    image_title = image_title.replace("_-_", "")
-    image_title = image_title.replace("__", "_")
-    image_title = image_title.replace("#", "Series")
+    return lower, upper
 
-    return image_title
 
-
-def preprocess_membrane_channel(imp):
-    """apply myosoft pre-processing steps for the membrane channel
+def preprocess_membrane_tile(imp, display_min, display_max):
+    """apply the myosoft pre-processing steps for the membrane channel to a tile of it.
+    The contrast is set from the whole channel (see get_saturated_range_from_histogram) instead of
+    the tile, so all tiles are pre-processed the same way.
 
     Parameters
     ----------
     imp : ImagePlus
-        a single channel image of the membrane staining
+        a single channel tile of the membrane staining
+    display_min : integer
+        the lower limit of the display range used for the 8-bit conversion
+    display_max : integer
+        the upper limit of the display range used for the 8-bit conversion
     """
-    IJ.run(imp, "Enhance Contrast", "saturated=0.35")
-    IJ.run(imp, "Apply LUT", "")
-    IJ.run(imp, "Enhance Contrast", "saturated=1")
-    IJ.run(imp, "8-bit", "")
+    ip = imp.getProcessor()
+    ip.setMinAndMax(display_min, display_max)
+    if imp.getBitDepth() == 8:
+        ip.applyLut()
+    else:
+        imp.setProcessor( ip.convertToByteProcessor(True) )
     IJ.run(imp, "Invert", "")
     IJ.run(imp, "Convolve...", "text1=[-1.0 -1.0 -1.0 -1.0 -1.0\n-1.0 -1.0 -1.0 -1.0 0\n-1.0 -1.0 24.0 -1.0 -1.0\n-1.0 -1.0 -1.0 -1.0 -1.0\n-1.0 -1.0 -1.0 -1.0 0] normalize")
 
 
-def get_threshold_from_method(imp, channel, method):
-    """returns the threshold value of chosen IJ AutoThreshold method in desired channel
+def create_tiled_binary(path, width, height, calibration):
+    """create an uncompressed 8-bit TIFF whose pixels are written tile by tile, see write_binary_tile.
+    The file is the size of the image, but only one tile is held in memory at a time.
 
     Parameters
     ----------
-    imp : ImagePlus
-        the imp from which to get the threshold value
-    channel : integer
-        the channel in which to get the treshold
-    method : string
-        the AutoThreshold method to use
-
-    Returns
-    -------
-    list
-        the upper and the lower threshold (integer values)
-    """
-    imp.setC(channel) # starts at 1
-    ip = imp.getProcessor()
-    ip.setAutoThreshold(method + " dark")
-    lower_thr = ip.getMinThreshold()
-    upper_thr = ip.getMaxThreshold()
-    ip.resetThreshold()
-
-    return lower_thr, upper_thr
-
-
-def apply_weka_model(model_path, imp, tiles_per_dim):
-    """apply a pretrained WEKA model to an ImagePlus
-
-    Parameters
-    ----------
-    model_path : string
-        path to the model file
-    imp : ImagePlus
-        ImagePlus to apply the model to
-    tiles_per_dim : integer
-        tiles the imp to save RAM
+    path : string
+        the path of the TIFF file
+    width : integer
+        the width of the image in pixels
+    height : integer
+        the height of the image in pixels
+    calibration : Calibration
+        the spatial calibration of the image, stored like ImageJ does
 
     Returns
     -------
-    ImagePlus
-        the result of the WEKA segmentation. One channel per class.
+    tuple
+        the opened RandomAccessFile and the offset of the first pixel in it
     """
-    segmentator = WekaSegmentation()
-    segmentator.loadClassifier( model_path )
-    result = segmentator.applyClassifier( imp, [tiles_per_dim, tiles_per_dim], 0, True ) #ImagePlus imp, int[x,y,z] tilesPerDim, int numThreads (0=all), boolean probabilityMaps
-
-    return result
-
-
-def process_weka_result(imp):
-    """apply myosoft pre-processing steps for the imp after WEKA classification to prepare it
-    for ROI detection with the extended particle analyzer
+    description = "ImageJ=" + IJ.getVersion() + "\nunit=" + calibration.getUnit().replace(u"\u00b5", "u") + "\n\0"
+    # tag, type (3 = short, 4 = long, 2 = ascii, 5 = rational), count, value or offset
+    entry_count = 13
+    description_offset = 8 + 2 + 12 * entry_count + 4
+    resolution_offset = description_offset + len(description)
+    data_offset = resolution_offset + 16
+    entries = [ (256, 4, 1, width), (257, 4, 1, height), (258, 3, 1, 8), (259, 3, 1, 1), (262, 3, 1, 1),
+        (270, 2, len(description), description_offset), (273, 4, 1, data_offset), (277, 3, 1, 1),
+        (278, 4, 1, height), (279, 4, 1, width * height), (282, 5, 1, resolution_offset),
+        (283, 5, 1, resolution_offset + 8), (296, 3, 1, 1) ]
+
+    header = ByteBuffer.allocate(data_offset) # big endian, as announced by "MM"
+    header.put( String("MM").getBytes() ).putShort(42).putInt(8)
+    header.putShort(entry_count)
+    for tag, value_type, count, value in entries:
+        header.putShort(tag).putShort(value_type).putInt(count)
+        if value_type == 3:
+            header.putShort(value).putShort(0)
+        else:
+            header.putInt( value - 2 ** 32 if value >= 2 ** 31 else value ) # unsigned in the file
+    header.putInt(0) # no further image
+    header.put( String(description).getBytes("US-ASCII") )
+    for pixel_size in [calibration.pixelWidth, calibration.pixelHeight]:
+        header.putInt( int( round(1000000.0 / pixel_size) ) ).putInt(1000000) # pixels per unit
+
+    binary_file = RandomAccessFile(path, "rw")
+    binary_file.setLength(data_offset + width * height)
+    binary_file.write( header.array() )
+
+    return binary_file, data_offset
+
+
+def write_binary_tile(binary_file, data_offset, width, ip, core, region):
+    """write the core of a segmented tile into a TIFF created by create_tiled_binary
 
     Parameters
     ----------
-    imp : ImagePlus
-        a single channel (= desired class) of the WEKA classification result imp
-    """
-    IJ.run(imp, "8-bit", "")
-    IJ.run(imp, "Median...", "radius=3")
-    IJ.run(imp, "Gaussian Blur...", "sigma=2")
-    IJ.run(imp, "Auto Threshold", "method=MaxEntropy")
-    IJ.run(imp, "Invert", "")
-
-
-def delete_channel(imp, channel_number):
-    """delete a channel from target imp
-
-    Parameters
-    ----------
-    imp : ImagePlus
-        the imp from which to delete target channel
-    channel_number : integer
-        the channel number to be deleted. starts at 0.
-    """
-    imp.setC(channel_number)
-    IJ.run(imp, "Delete Slice", "delete=channel")
-
-
-def run_extended_particle_analyzer( imp, eda_parameters ):
-    """identifies ROIs in target imp using the extended particle analyzer of the BioVoxxel toolbox
-    with given parameters
-
-    Parameters
-    ----------
-    imp : ImagePlus
-        the image on which to run the EPA on. Should be 8-bit thresholded
-    eda_parameters : array
-        all user defined parameters to restrict ROI identification
-    """
-    epa = Extended_Particle_Analyzer()
-    epa.readInputImageParameters(imp)
-    epa.setDefaultParameterFields()
-
-    # expose all parameters explicitly
-    epa.usePixel = False
-    epa.usePixelForOutput = False
-    epa.Area = str(eda_parameters[0]) + "-" + str(eda_parameters[1])
-    epa.Extent = "0.00-1.00"
-    epa.Perimeter = str(eda_parameters[2]) + "-" + str(eda_parameters[3])
-    epa.Circularity = str(eda_parameters[4]) + "-" + str(eda_parameters[5])
-    epa.Roundness = str(eda_parameters[6]) + "-" + str(eda_parameters[7])
-    epa.Solidity = str(eda_parameters[8]) + "-" + str(eda_parameters[9])
-    epa.Compactness = "0.00-1.00"
-    epa.AR = "0-Infinity"
-    epa.FeretAR = str(eda_parameters[10]) + "-" + str(eda_parameters[11])
-    epa.EllipsoidAngle = "0-180"
-    epa.MaxFeret = "0-Infinity"
-    epa.MinFeret = str(eda_parameters[12]) + "-" + str(eda_parameters[13])
-    epa.FeretAngle = "0-180"
-    epa.COV = "0.00-1.00"
-    epa.Output = "Nothing"
-    epa.Redirect = "None"
-    epa.Correction = "None"
-    epa.Reset = False
-    epa.DisplayResults = False
-    epa.ClearResults = False
-    epa.Summarize = False
-    epa.AddToManager = True
-    epa.ExcludeEdges = False
-    epa.IncludeHoles = False
-
-    epa.defineParticleAnalyzers()
-    epa.particleAnalysis( imp.getProcessor(), imp, imp.getTitle() )
-
-
-def measure_in_all_rois( imp, channel, rm ):
-    """measures in all ROIS on a given channel of imp all parameters that are set in IJ "Set Measurements"
-
-    Parameters
-    ----------
-    imp : ImagePlus
-        the imp to measure on
-    channel : integer
-        the channel to measure in. starts at 1.
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    """
-    imp.setC(channel)
-    rm.runCommand(imp,"Deselect")
-    rm.runCommand(imp,"Measure")
-
-
-def change_all_roi_color( rm, color ):
-    """change the color of all ROIs in the RoiManager
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    color : string
-        the desired color. e.g. "green", "red", "yellow", "magenta" ...
-    """
-    number_of_rois = rm.getCount()
-    for roi in range( number_of_rois ):
-        rm.select(roi)
-        rm.runCommand("Set Color", color)
-
-
-def change_subset_roi_color( rm, selected_rois, color ):
-    """change the color of selected ROIs in the RoiManager
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    selected_rois : array
-        ROIs in the RoiManager to change
-    color : string
-        the desired color. e.g. "green", "red", "yellow", "magenta" ...
+    binary_file : RandomAccessFile
+        the TIFF as returned by create_tiled_binary
+    data_offset : integer
+        the offset of the first pixel, as returned by create_tiled_binary
+    width : integer
+        the width of the image in pixels
+    ip : ByteProcessor
+        the binary of the tile including its overlap
+    core : Rectangle
+        the part of the image the tile is responsible for, in image coordinates
+    region : Rectangle
+        the part of the image that was segmented, in image coordinates
     """
-    rm.runCommand("Deselect")
-    rm.setSelectedIndexes(selected_rois)
-    rm.runCommand("Set Color", color)
-    rm.runCommand("Deselect")
+    pixels = ip.getPixels()
+    for row in range(core.height):
+        binary_file.seek( data_offset + (core.y + row) * width + core.x )
+        binary_file.write( pixels, (core.y - region.y + row) * region.width + core.x - region.x, core.width )
 
 
-def show_all_rois_on_image(rm, imp):
-    """shows all ROIs in the ROiManager on imp
+def identify_fibers_tiled(reader, membrane_channel, membrane_histogram, fiber_channel, model_paths, calibration, tile_size, overlap, enlarge_px, cache_size_in_mb, num_threads, binary_path):
+    """segment the membrane channel tile by tile and collect the particles of all tiles in one shape table
 
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    imp : ImagePlus
-        the imp on which to show the ROIs
-    """
-    imp.show()
-    rm.runCommand(imp,"Show All")
-
-
-def save_all_rois(rm, target):
-    """save all ROIs in the RoiManager as zip to target path
+    Only one tile (plus its overlap) is held in memory at a time. A particle is kept by the tile whose
+    core contains the center of its bounding box, and dropped if it touches a cut edge of the tile,
+    so particles on tile borders are neither duplicated nor cut, as long as the overlap is larger
+    than a fiber.
 
     Parameters
     ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    target : string
-        the path in to store the ROIs. e.g. /my-images/resulting_rois.zip
-    """
-    rm.runCommand("Save", target)
-
-
-def save_selected_rois( rm, selected_rois, target ):
-    """save selected ROIs in the RoiManager as zip to target path
+    reader : ImageProcessorReader
+        the reader as returned by open_image_reader
+    membrane_channel : integer
+        the membrane channel to segment. starts at 1.
+    membrane_histogram : array
+        the histogram of the whole membrane channel, e.g. as returned by get_channel_histogram
+    fiber_channel : integer
+        the MHC channel in which to measure the mean intensity of every particle. 0 to skip.
+    model_paths : array
+        the paths to the primary and the secondary model
+    calibration : Calibration
+        the spatial calibration of the image
+    tile_size : integer
+        the edge length of the tiles in pixels, without overlap
+    overlap : integer
+        the overlap of neighbouring tiles in pixels
+    enlarge_px : float
+        the amount of pixels by which to enlarge the particle ROIs
+    cache_size_in_mb : integer
+        size of the classifier cache in MB, see get_weka_segmentator
+    num_threads : integer
+        the number of threads to use for the classification. 0 uses all cores.
+    binary_path : string
+        where to save the stitched binary of all tiles. None to skip.
 
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    selected_rois : array
-        ROIs in the RoiManager to save
-    target : string
-        the path in to store the ROIs. e.g. /my-images/resulting_rois_subset.zip
+    Returns
+    -------
+    dict
+        the shape table as returned by build_particle_shape_table, with the ROIs in image coordinates.
+        Additionally contains the enlarged ROIs ("enlarged_rois") and, if a fiber channel is given,
+        the mean fiber channel intensity within them ("fiber_mean").
     """
-    rm.runCommand("Deselect")
-    rm.setSelectedIndexes(selected_rois)
-    rm.runCommand("save selected", target)
-    rm.runCommand("Deselect")
-
-
-def enlarge_all_rois( amount_in_um, rm, pixel_size_in_um ):
-    """enlarges all ROIs in the RoiManager by x scaled units
+    width = reader.getSizeX()
+    height = reader.getSizeY()
+
+    # the contrast of "Enhance Contrast" + "Apply LUT" + "Enhance Contrast" for the whole channel
+    display_min, display_max = get_saturated_range_from_histogram(membrane_histogram, 0.35, 0, len(membrane_histogram) - 1)
+    display_min, display_max = get_saturated_range_from_histogram(membrane_histogram, 1, display_min, display_max)
+
+    tiled_shapes = { "rois": [], "enlarged_rois": [], "fiber_mean": array("d") }
+    for column in ["Area", "Perim.", "Circ.", "Round", "Solidity", "FeretAR", "MinFeret"]:
+        tiled_shapes[column] = array("d")
+
+    if binary_path is not None:
+        binary_file, data_offset = create_tiled_binary(binary_path, width, height, calibration)
+    tiles = get_tile_grid(width, height, tile_size, overlap)
+    for tile_number, (core, region) in enumerate(tiles):
+        log( "segmenting tile " + str(tile_number + 1) + " of " + str(len(tiles)) )
+        membrane = ImagePlus( "membrane_tile", read_tile(reader, membrane_channel, region) )
+        preprocess_membrane_tile(membrane, display_min, display_max)
+        weka_result1 = apply_weka_model(model_paths[0], membrane, 1, cache_size_in_mb, num_threads )
+        membrane.close()
+        delete_channel(weka_result1, 1)
+        weka_result2 = apply_weka_model(model_paths[1], weka_result1, 1, cache_size_in_mb, num_threads )
+        weka_result1.close()
+        delete_channel(weka_result2, 1)
+        weka_result2.setCalibration(calibration)
+        process_weka_result(weka_result2)
+        if binary_path is not None:
+            write_binary_tile(binary_file, data_offset, width, weka_result2.getProcessor(), core, region)
+        tile_shapes = build_particle_shape_table(weka_result2)
+        weka_result2.close()
+
+        if fiber_channel > 0:
+            fiber_tile = read_tile(reader, fiber_channel, region)
+
+        for particle, roi in enumerate(tile_shapes["rois"]):
+            bounds = roi.getBounds()
+            center_x = region.x + bounds.x + bounds.width / 2.0
+            center_y = region.y + bounds.y + bounds.height / 2.0
+            if not core.contains(int(center_x), int(center_y)):
+                continue
+            cut_left = bounds.x == 0 and region.x > 0
+            cut_top = bounds.y == 0 and region.y > 0
+            cut_right = bounds.x + bounds.width >= region.width and region.x + region.width < width
+            cut_bottom = bounds.y + bounds.height >= region.height and region.y + region.height < height
+            if cut_left or cut_top or cut_right or cut_bottom:
+                continue
+
+            enlarged_roi = RoiEnlarger.enlarge(roi, enlarge_px)
+            if fiber_channel > 0:
+                fiber_tile.setRoi(enlarged_roi)
+                tiled_shapes["fiber_mean"].append( fiber_tile.getStats().mean )
+
+            # move the ROIs from tile to image coordinates
+            roi.setLocation(region.x + bounds.x, region.y + bounds.y)
+            enlarged_bounds = enlarged_roi.getBounds()
+            enlarged_roi.setLocation(region.x + enlarged_bounds.x, region.y + enlarged_bounds.y)
+            tiled_shapes["rois"].append(roi)
+            tiled_shapes["enlarged_rois"].append(enlarged_roi)
+            for column in ["Area", "Perim.", "Circ.", "Round", "Solidity", "FeretAR", "MinFeret"]:
+                tiled_shapes[column].append( tile_shapes[column][particle] )
+
+    if binary_path is not None:
+        binary_file.close()
+
+    return tiled_shapes
+
+
+def measure_rois_without_image(rois, calibration, rt):
+    """measures area, perimeter, shape and feret's of ROIs without the image they belong to, e.g.
+    when it is too large to be loaded. Adds one row per ROI to the ResultsTable.
 
     Parameters
     ----------
-    amount_in_um : float
-        the value by which to enlarge in scaled units, e.g 3.5
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    pixel_size_in_um : float
-        the pixel size, e.g. 0.65 px/um
+    rois : array
+        the ROIs to measure
+    calibration : Calibration
+        the spatial calibration of the image the ROIs belong to
+    rt : ResultsTable
+        a reference of the IJ-ResultsTable
     """
-    amount_px = amount_in_um / pixel_size_in_um
-    all_rois = rm.getRoisAsArray()
-    rm.reset()
-    for roi in all_rois:
-        enlarged_roi = RoiEnlarger.enlarge(roi, amount_px)
-        rm.addRoi(enlarged_roi)
+    measurements = Measurements.AREA | Measurements.PERIMETER | Measurements.SHAPE_DESCRIPTORS | Measurements.FERET
+    for roi in rois:
+        # measure on an empty image of the size of the ROI, then restore the feret start point (in pixels)
+        bounds = roi.getBounds()
+        canvas = ImagePlus( "canvas", ByteProcessor(bounds.width, bounds.height) )
+        canvas.setCalibration(calibration)
+        shifted_roi = roi.clone()
+        shifted_roi.setLocation(0, 0)
+        canvas.setRoi(shifted_roi)
+        Analyzer(canvas, measurements, rt).measure()
+        row = rt.size() - 1
+        rt.setValue("FeretX", row, rt.getValue("FeretX", row) + bounds.x)
+        rt.setValue("FeretY", row, rt.getValue("FeretY", row) + bounds.y)
 
 
 def select_positive_fibers( imp, channel, rm, min_intensity ):
     """For all ROIs in the RoiManager, select ROIs based on intensity measurement in given channel of imp.
-    See https://imagej.nih.gov/ij/developer/api/ij/process/ImageStatistics.html
+    All ROIs are measured at once, see measure_rois.
 
     Parameters
     ----------
@@ -393,218 +372,296 @@ def select_positive_fibers( imp, channel, rm, min_intensity ):
     rm : RoiManager
         a reference of the IJ-RoiManager
     min_intensity : integer
-        the selection criterion (here: intensity threshold)
+        the selection criterion (here: minimum of the mean intensity)
 
     Returns
     -------
     array
         a selection of ROIs which passed the selection criterion (are above the threshold)
     """
-    imp.setC(channel)
     all_rois = rm.getRoisAsArray()
-    selected_rois = []
-    for i, roi in enumerate(all_rois):
-        imp.setRoi(roi)
-        stats = imp.getStatistics()
-        if stats.mean > min_intensity:
-            selected_rois.append(i)
-
-    return selected_rois
-
-
-def preset_results_column( rt, column, value):
-    """pre-set all rows in given column of the IJ-ResultsTable with desired value
-
-    Parameters
-    ----------
-    rt : ResultsTable
-        a reference of the IJ-ResultsTable
-    column : string
-        the desired column. will be created if it does not yet exist
-    value : string or float or integer
-        the value to be set
-    """
-    for i in range( rt.size() ):
-        rt.setValue(column, i, value)
-
-    rt.show("Results")
-
-
-def add_results( rt, column, row, value ):
-    """adds a value in desired rows of a given column
-
-    Parameters
-    ----------
-    rt : ResultsTable
-        a reference of the IJ-ResultsTable
-    column : string
-        the column in which to add the values
-    row : array
-        the row numbers in which too add the values.
-    value : string or float or integer
-        the value to be set
-    """
-    for i in range( len( row ) ):
-        rt.setValue(column, row[i], value)
-
-    rt.show("Results")
-
-
-def enhance_contrast( imp ):
-    """use "Auto" Contrast & Brightness settings in each channel of imp
-
-    Parameters
-    ----------
-    imp : ImagePlus
-        the imp on which to change C&B
-    """
-    for channel in range( imp.getDimensions()[2] ):
-        imp.setC(channel + 1) # IJ channels start at 1
-        IJ.run(imp, "Enhance Contrast", "saturated=0.35")
-
-
-def renumber_rois(rm):
-    """rename all ROIs in the RoiManager according to their number
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    """
-    number_of_rois = rm.getCount()
-    for roi in range( number_of_rois ):
-        rm.rename( roi, str(roi + 1) )
+    imp.setC(channel)
+    stats = measure_rois( all_rois, [imp.getProcessor()], Runtime.getRuntime().availableProcessors(), 0 )[0]
 
+    return [ i for i in range( len(all_rois) ) if stats["Mean"][i] > min_intensity ]
 
-def setup_defined_ij(rm, rt):
-    """set up a clean and defined Fiji user environment
 
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    rt : ResultsTable
-        a reference of the IJ-ResultsTable
-    """
-    fix_ij_options()
-    rm.runCommand('reset')
-    rt.reset()
-    IJ.log("\\Clear")
-
-
-execution_start_time = time.time()
+# there is no window to show the ROI Manager in when running headless
+headless = GraphicsEnvironment.isHeadless()
+rm = RoiManager(True) if headless else RoiManager.getRoiManager()
+rt = ResultsTable.getResultsTable()
 
 setup_defined_ij(rm, rt)
 
 print rt.size()
 
-# open image using Bio-Formats
 path_to_image = fix_ij_dirs(path_to_image)
-raw = open_image_with_BF(path_to_image)
-
-# get image info
-raw_image_calibration = raw.getCalibration()
-raw_image_title = fix_BF_czi_imagetitle(raw)
-print("raw image title: ", str(raw_image_title))
 
 # take care of paths and directories
-output_dir = fix_ij_dirs(output_dir) + "/" + str(raw_image_title) + "/1_identify_fibers"
-print("output_dir: ", str(output_dir))
-
-if not os.path.exists( str(output_dir) ):
-    os.makedirs( str(output_dir) )
-
+output_root = fix_ij_dirs(output_dir)
+probability_cache_dir = output_root + "/probability_map_cache"
+histogram_cache_dir = output_root + "/histogram_cache"
 classifiers_dir = fix_ij_dirs(classifiers_dir)
 primary_model = classifiers_dir + "/" + "primary.model"
 secondary_model = classifiers_dir + "/" + "secondary_central_nuclei.model"
 
-# update the log for the user
-IJ.log( "Now working on " + str(raw_image_title) )
-if raw_image_calibration.scaled() == False:
-    IJ.log("Your image is not spatially calibrated! Size measurements are only possible in [px].")
-IJ.log( " -- settings used -- ")
-IJ.log( "area = " + str(minAr) + "-" + str(maxAr) )
-IJ.log( "perimeter = " + str(minPer) + "-" + str(maxPer) )
-IJ.log( "circularity = " + str(minCir) + "-" + str(maxCir) )
-IJ.log( "roundness = " + str(minRnd) + "-" + str(maxRnd) )
-IJ.log( "solidity = " + str(minSol) + "-" + str(maxSol) )
-IJ.log( "feret_ar = " + str(minFAR) + "-" + str(maxFAR) )
-IJ.log( "min_feret = " + str(minMinFer) + "-" + str(maxMinFer) )
-IJ.log( "ROI expansion [microns] = " + str(enlarge) )
-IJ.log( "Membrane channel = " + str(membrane_channel) )
-IJ.log( "MHC positive fiber channel = " + str(fiber_channel) )
-IJ.log( "sub-tiling = " + str(tiling_factor) )
-IJ.log( " -- settings used -- ")
-
-# image (pre)processing and segmentation (-> ROIs)
-membrane = Duplicator().run(raw, membrane_channel, membrane_channel, 1, 1, 1, 1) # imp, firstC, lastC, firstZ, lastZ, firstT, lastT
-preprocess_membrane_channel(membrane)
-weka_result1 = apply_weka_model(primary_model, membrane, tiling_factor )
-delete_channel(weka_result1, 1)
-weka_result2 = apply_weka_model(secondary_model, weka_result1, tiling_factor )
-delete_channel(weka_result2, 1)
-weka_result2.setCalibration(raw_image_calibration)
-process_weka_result(weka_result2)
-IJ.saveAs(weka_result2, "Tiff", output_dir + "/" + raw_image_title + "_all_fibers_binary")
-eda_parameters = [minAr, maxAr, minPer, maxPer, minCir, maxCir, minRnd, maxRnd, minSol, maxSol, minFAR, maxFAR, minMinFer, maxMinFer]
-raw.show() # EPA will not work if no image is shown
-run_extended_particle_analyzer(weka_result2, eda_parameters)
-
-# modify rois
-rm.hide()
-raw.hide()
-enlarge_all_rois( enlarge, rm, raw_image_calibration.pixelWidth )
-renumber_rois(rm)
-save_all_rois( rm, output_dir + "/" + raw_image_title + "_all_fiber_rois.zip" )
-
-# check for positive fibers
-if fiber_channel > 0:
-    if min_fiber_intensity == 0:
-        min_fiber_intensity = get_threshold_from_method(raw, fiber_channel, "Mean")[0]
-        IJ.log( "automatic intensity threshold detection: True" )
-
-    IJ.log( "fiber intensity threshold: " + str(min_fiber_intensity) )
-    change_all_roi_color(rm, "blue")
-    positive_fibers = select_positive_fibers( raw, fiber_channel, rm, min_fiber_intensity  )
-    change_subset_roi_color(rm, positive_fibers, "magenta")
-    save_selected_rois( rm, positive_fibers, output_dir + "/" + raw_image_title + "_mhc_positive_fiber_rois.zip")
-
-# measure size & shape, save
-IJ.run("Set Measurements...", "area perimeter shape feret's redirect=None decimal=4")
-IJ.run("Clear Results", "")
-measure_in_all_rois( raw, membrane_channel, rm )
-
-rt = ResultsTable.getResultsTable("Results")
-
-print rt.size()
-
-if fiber_channel > 0:
-    print rt.size()
-    preset_results_column( rt, "MHC Positive Fibers (magenta)", "NO" )
-    print rt.size()
-    add_results( rt, "MHC Positive Fibers (magenta)", positive_fibers, "YES")
-    print rt.size()
-
-rt.save(output_dir + "/" + raw_image_title + "_all_fibers_results.csv")
-print "saved the all_fibers_results.csv"
-# dress up the original image, save a overlay-png, present original to the user
-rm.show()
-raw.show()
-show_all_rois_on_image( rm, raw )
-raw.setDisplayMode(IJ.COMPOSITE)
-enhance_contrast( raw )
-IJ.run("From ROI Manager", "") # ROIs -> overlays so they show up in the saved png
-qc_duplicate = raw.duplicate()
-IJ.saveAs(qc_duplicate, "PNG", output_dir + "/" + raw_image_title + "_all_fibers")
-qc_duplicate.close()
-wm.toFront( raw.getWindow() )
-IJ.run("Remove Overlay", "")
-raw.setDisplayMode(IJ.GRAYSCALE)
-show_all_rois_on_image( rm, raw )
-total_execution_time_min = (time.time() - execution_start_time) / 60.0
-IJ.log("total time in minutes: " + str(total_execution_time_min))
-IJ.log( "~~ all done ~~" )
-IJ.selectWindow("Log")
-IJ.saveAs("Text", str(output_dir + "/" + raw_image_title + "_all_fibers_Log"))
-if close_raw == True:
-    raw.close()
\ No newline at end of file
+# whole-slide mode never loads the image completely, which the gate-only re-run needs
+if slide_tile_size > 0 and rerun_gates_only:
+    raise ValueError("the gates can not be re-run on a saved binary in whole-slide mode, set the whole-slide tile size to 0 for this")
+
+# all series of the file are read through one reader session
+reader = open_image_reader(path_to_image)
+series_count = reader.getSeriesCount()
+# the image is identified by path, size and modification time, only the classifiers are hashed
+file_hashes = dict( [(input_file, get_file_hash(input_file)) for input_file in [primary_model, secondary_model]] )
+file_hashes[path_to_image] = get_image_key(path_to_image)
+
+for series in range(series_count):
+    execution_start_time = time.time()
+    raw_image_title = get_image_title_from_path(path_to_image, series if series_count > 1 else None)
+    print("raw image title: ", str(raw_image_title))
+
+    output_dir = output_root + "/" + str(raw_image_title) + "/1_identify_fibers"
+    print("output_dir: ", str(output_dir))
+
+    if not os.path.exists( str(output_dir) ):
+        os.makedirs( str(output_dir) )
+
+    binary_path = output_dir + "/" + raw_image_title + "_all_fibers_binary.tif"
+
+    # skip the series if a previous run with the same inputs and parameters is complete
+    journal_path = output_dir + "/" + raw_image_title + "_journal.json"
+    input_hashes = dict(file_hashes)
+    if rerun_gates_only and os.path.isfile(binary_path):
+        input_hashes[binary_path] = get_file_hash(binary_path)
+    run_parameters = dict( [(name, str(value)) for name, value in [
+        ("minAr", minAr), ("maxAr", maxAr), ("minPer", minPer), ("maxPer", maxPer), ("minCir", minCir), ("maxCir", maxCir),
+        ("minRnd", minRnd), ("maxRnd", maxRnd), ("minSol", minSol), ("maxSol", maxSol), ("minFAR", minFAR), ("maxFAR", maxFAR),
+        ("minMinFer", minMinFer), ("maxMinFer", maxMinFer), ("enlarge", enlarge), ("enlarge_without_overlap", enlarge_without_overlap), ("membrane_channel", membrane_channel),
+        ("fiber_channel", fiber_channel), ("min_fiber_intensity", min_fiber_intensity), ("tiling_factor", tiling_factor),
+        ("segmentation_pixel_size", segmentation_pixel_size), ("slide_tile_size", slide_tile_size),
+        ("slide_tile_overlap", slide_tile_overlap), ("rerun_gates_only", rerun_gates_only), ("save_roi_zips", save_roi_zips), ("overview_max_size", overview_max_size), ("overview_pyramid", overview_pyramid), ("series", series)] ] )
+
+    if is_journal_complete(journal_path, input_hashes, run_parameters):
+        log( "Skipping " + str(raw_image_title) + ": already processed with the same inputs and parameters" )
+        continue
+
+    setup_defined_ij(rm, rt)
+    # wall time, CPU time and memory of every stage go to a _timings.json next to the outputs
+    stage_timer = start_stage_timer("Bio-Formats open", rm)
+    reader.setSeries(series)
+    raw_image_calibration = get_calibration_from_reader(reader)
+    if slide_tile_size > 0:
+        # whole-slide mode: only read the series tile by tile, never load it completely
+        raw = None
+    else:
+        # only the membrane and fiber channels are needed
+        loaded_channels = sorted( set( [channel for channel in [membrane_channel, fiber_channel] if channel > 0] ) )
+        raw = open_series_from_reader(reader, raw_image_title, loaded_channels)
+    artifacts = []
+
+    # update the log for the user
+    log( "Now working on " + str(raw_image_title) )
+    if raw_image_calibration.scaled() == False:
+        log("Your image is not spatially calibrated! Size measurements are only possible in [px].")
+    log( " -- settings used -- ")
+    log( "area = " + str(minAr) + "-" + str(maxAr) )
+    log( "perimeter = " + str(minPer) + "-" + str(maxPer) )
+    log( "circularity = " + str(minCir) + "-" + str(maxCir) )
+    log( "roundness = " + str(minRnd) + "-" + str(maxRnd) )
+    log( "solidity = " + str(minSol) + "-" + str(maxSol) )
+    log( "feret_ar = " + str(minFAR) + "-" + str(maxFAR) )
+    log( "min_feret = " + str(minMinFer) + "-" + str(maxMinFer) )
+    log( "ROI expansion [microns] = " + str(enlarge) )
+    log( "ROI expansion without overlap = " + str(enlarge_without_overlap) )
+    log( "Membrane channel = " + str(membrane_channel) )
+    log( "MHC positive fiber channel = " + str(fiber_channel) )
+    log( "sub-tiling = " + str(tiling_factor) )
+    log( "segmentation pixel size [um] = " + str(segmentation_pixel_size) )
+    log( "whole-slide tile size [px] = " + str(slide_tile_size) )
+    log( "whole-slide tile overlap [px] = " + str(slide_tile_overlap) )
+    log( "WEKA threads = " + str(weka_threads) )
+    log( "classifier cache size [MB] = " + str(classifier_cache_mb) )
+    log( "probability map cache size [MB] = " + str(probability_cache_mb) )
+    log( "only re-run gates on saved binary = " + str(rerun_gates_only) )
+    if slide_tile_size > 0:
+        for option, is_set in [ ("segmentation pixel size", segmentation_pixel_size > 0),
+                ("expand ROIs without overlap", enlarge_without_overlap), ("probability map cache", probability_cache_mb > 0) ]:
+            if is_set:
+                log( "whole-slide mode: \"" + option + "\" is not used" )
+    log( " -- settings used -- ")
+
+    eda_parameters = [minAr, maxAr, minPer, maxPer, minCir, maxCir, minRnd, maxRnd, minSol, maxSol, minFAR, maxFAR, minMinFer, maxMinFer]
+    if slide_tile_size > 0:
+        # segmentation, particle analysis, ROI expansion and MHC intensities tile by tile, then gate all particles
+        time_stage(stage_timer, "tiled segmentation")
+        membrane_histogram = get_cached_channel_histogram( histogram_cache_dir, input_hashes[path_to_image], series, membrane_channel,
+            reader, slide_tile_size )
+        # the stitched binary is written tile by tile. ImageJ only opens TIFFs up to 4 GB.
+        if reader.getSizeX() * reader.getSizeY() < 2 ** 32 - 2 ** 16:
+            tiled_binary_path = binary_path
+        else:
+            tiled_binary_path = None
+            log( "whole-slide mode: the image is too large for a binary TIFF, no binary is saved" )
+        particle_shapes = identify_fibers_tiled(reader, membrane_channel, membrane_histogram, fiber_channel, [primary_model, secondary_model],
+            raw_image_calibration, slide_tile_size, slide_tile_overlap, enlarge / raw_image_calibration.pixelWidth, classifier_cache_mb, weka_threads,
+            tiled_binary_path)
+        if tiled_binary_path is not None:
+            artifacts.append(tiled_binary_path)
+        time_stage(stage_timer, "particle analysis")
+        gated_particles = gate_particle_shape_table(particle_shapes, eda_parameters)
+        log( str(len(gated_particles)) + " of " + str(len(particle_shapes["rois"])) + " particles passed the morphometric gates" )
+        if not headless:
+            rm.hide()
+        for particle in gated_particles:
+            rm.addRoi( particle_shapes["enlarged_rois"][particle] )
+
+    else:
+        # image (pre)processing and segmentation (-> ROIs), or the binary of a previous run for a gate-only re-run
+        if rerun_gates_only:
+            if not os.path.exists( binary_path ):
+                raise IOError("no binary of a previous run found at " + binary_path)
+            time_stage(stage_timer, "binary open")
+            weka_result2 = IJ.openImage( binary_path )
+            if weka_result2.getWidth() == raw.getWidth():
+                weka_result2.setCalibration(raw_image_calibration)
+            # else it was segmented downsampled and keeps the calibration it was saved with
+        else:
+            time_stage(stage_timer, "preprocessing")
+            downsample_membrane = segmentation_pixel_size > raw_image_calibration.pixelWidth
+            # re-use a cached probability map if possible
+            weka_result2 = None
+            if probability_cache_mb > 0:
+                probability_cache_key = get_probability_map_cache_key(input_hashes[path_to_image], series, membrane_channel,
+                    [input_hashes[primary_model], input_hashes[secondary_model]], tiling_factor, segmentation_pixel_size if downsample_membrane else 0)
+                weka_result2 = open_cached_probability_map(probability_cache_dir, probability_cache_key)
+                if weka_result2 is not None:
+                    log( "re-using cached probability map " + probability_cache_key )
+
+            if weka_result2 is None:
+                if downsample_membrane:
+                    membrane = open_channel_downsampled(reader, membrane_channel, segmentation_pixel_size, raw_image_calibration)
+                else:
+                    raw_membrane_channel = loaded_channels.index(membrane_channel) + 1
+                    membrane = Duplicator().run(raw, raw_membrane_channel, raw_membrane_channel, 1, 1, 1, 1) # imp, firstC, lastC, firstZ, lastZ, firstT, lastT
+                    membrane.setCalibration(raw_image_calibration)
+                preprocess_membrane_channel(membrane)
+                time_stage(stage_timer, "WEKA primary")
+                weka_result1 = apply_weka_model(primary_model, membrane, tiling_factor, classifier_cache_mb, weka_threads )
+                delete_channel(weka_result1, 1)
+                time_stage(stage_timer, "WEKA secondary")
+                weka_result2 = apply_weka_model(secondary_model, weka_result1, tiling_factor, classifier_cache_mb, weka_threads )
+                delete_channel(weka_result2, 1)
+                weka_result2.setCalibration( membrane.getCalibration() )
+                if probability_cache_mb > 0:
+                    save_probability_map_to_cache(probability_cache_dir, probability_cache_key, weka_result2, probability_cache_mb)
+
+            time_stage(stage_timer, "post-processing")
+            process_weka_result(weka_result2)
+            # the full resolution size is stored with the binary, so it can be mapped back when downsampled
+            weka_result2.setProp( "raw_width", str( raw.getWidth() ) )
+            weka_result2.setProp( "raw_height", str( raw.getHeight() ) )
+            IJ.saveAs(weka_result2, "Tiff", binary_path)
+            artifacts.append(binary_path)
+
+        # identify all particles once, then apply the morphometric gates to their shape descriptors
+        time_stage(stage_timer, "particle analysis")
+        particle_shapes = build_particle_shape_table(weka_result2)
+        gated_particles = gate_particle_shape_table(particle_shapes, eda_parameters)
+        log( str(len(gated_particles)) + " of " + str(len(particle_shapes["rois"])) + " particles passed the morphometric gates" )
+
+        # modify rois, mapping them to full resolution if the segmentation was downsampled
+        time_stage(stage_timer, "enlargement")
+        if not headless:
+            rm.hide()
+        x_scale = float( raw.getWidth() ) / weka_result2.getWidth()
+        y_scale = float( raw.getHeight() ) / weka_result2.getHeight()
+        for particle in gated_particles:
+            if x_scale != 1 or y_scale != 1:
+                rm.addRoi( scale_roi(particle_shapes["rois"][particle], x_scale, y_scale) )
+            else:
+                rm.addRoi( particle_shapes["rois"][particle] )
+        if enlarge_without_overlap:
+            enlarge_all_rois_without_overlap( enlarge, rm, raw_image_calibration.pixelWidth, raw.getWidth(), raw.getHeight(),
+                weka_threads if weka_threads > 0 else Runtime.getRuntime().availableProcessors() )
+        else:
+            enlarge_all_rois( enlarge, rm, raw_image_calibration.pixelWidth )
+
+    renumber_rois(rm)
+    time_stage(stage_timer, "ROI writes")
+    if save_roi_zips:
+        save_all_rois( rm, output_dir + "/" + raw_image_title + "_all_fiber_rois.zip" )
+        artifacts.append( output_dir + "/" + raw_image_title + "_all_fiber_rois.zip" )
+
+    # check for positive fibers
+    time_stage(stage_timer, "positivity")
+    if fiber_channel > 0:
+        fiber_threshold = min_fiber_intensity
+        if fiber_threshold == 0:
+            # the histogram is cached per image, so any script can look the threshold up without reading the channel again
+            fiber_histogram = get_cached_channel_histogram( histogram_cache_dir, input_hashes[path_to_image], series, fiber_channel,
+                reader, slide_tile_size if slide_tile_size > 0 else HISTOGRAM_TILE_SIZE )
+            fiber_threshold = get_threshold_from_histogram(fiber_histogram, "Mean")
+            log( "automatic intensity threshold detection: True" )
+
+        log( "fiber intensity threshold: " + str(fiber_threshold) )
+        change_all_roi_color(rm, "blue")
+        if slide_tile_size > 0:
+            # the intensities were already measured tile by tile
+            positive_fibers = [ i for i, particle in enumerate(gated_particles) if particle_shapes["fiber_mean"][particle] > fiber_threshold ]
+        else:
+            positive_fibers = select_positive_fibers( raw, loaded_channels.index(fiber_channel) + 1, rm, fiber_threshold  )
+        change_subset_roi_color(rm, positive_fibers, "magenta")
+        if save_roi_zips:
+            save_selected_rois( rm, positive_fibers, output_dir + "/" + raw_image_title + "_mhc_positive_fiber_rois.zip")
+            artifacts.append( output_dir + "/" + raw_image_title + "_mhc_positive_fiber_rois.zip" )
+
+    # all fibers with their classes as columns in one ROI store
+    time_stage(stage_timer, "ROI writes")
+    fiber_columns = {}
+    if fiber_channel > 0:
+        fiber_columns["MHC positive"] = get_flag_column( rm.getCount(), positive_fibers )
+    write_roi_store( rm.getRoisAsArray(), fiber_columns, output_dir + "/" + raw_image_title + "_all_fiber_rois.roistore" )
+    artifacts.append( output_dir + "/" + raw_image_title + "_all_fiber_rois.roistore" )
+
+    # measure size & shape, save
+    time_stage(stage_timer, "measurement")
+    IJ.run("Set Measurements...", "area perimeter shape feret's redirect=None decimal=4")
+    IJ.run("Clear Results", "")
+    if slide_tile_size > 0:
+        measure_rois_without_image( rm.getRoisAsArray(), raw_image_calibration, ResultsTable.getResultsTable("Results") )
+    else:
+        measure_in_all_rois( raw, loaded_channels.index(membrane_channel) + 1, rm )
+
+    rt = ResultsTable.getResultsTable("Results")
+    results_columns = get_results_columns(rt)
+    if fiber_channel > 0:
+        add_yes_no_column( results_columns, "MHC Positive Fibers (magenta)", rm.getCount(), positive_fibers )
+    time_stage(stage_timer, "CSV writes")
+    write_results( rt, results_columns, output_dir + "/" + raw_image_title + "_all_fibers_results.csv" )
+    artifacts.append( output_dir + "/" + raw_image_title + "_all_fibers_results.csv" )
+    print "saved the all_fibers_results.csv"
+    # save a overlay-png, present original to the user
+    time_stage(stage_timer, "PNG writes")
+    if slide_tile_size > 0:
+        log( "whole-slide mode: no overview png is saved, the image is never loaded completely" )
+    else:
+        artifacts.extend( save_overview_png( raw, rm, output_dir + "/" + raw_image_title + "_all_fibers", overview_max_size, overview_pyramid ) )
+    if not headless and series == series_count - 1:
+        rm.show()
+        if raw is not None:
+            enhance_contrast( raw )
+            show_all_rois_on_image( rm, raw )
+    total_execution_time_min = (time.time() - execution_start_time) / 60.0
+    log("total time in minutes: " + str(total_execution_time_min))
+    log( "~~ all done ~~" )
+    artifacts.append( save_log( str(output_dir + "/" + raw_image_title + "_all_fibers_Log") ) )
+    artifacts.append( write_stage_timings( stage_timer, output_dir + "/" + raw_image_title + "_timings.json",
+        "1_identify_fibers", raw_image_title, series ) )
+    write_journal(journal_path, input_hashes, run_parameters, artifacts)
+    # only the image of the last series stays open, the others are released before the next series is read
+    if raw is not None and (close_raw == True or series < series_count - 1):
+        raw.close()
+        raw.flush()
+
+reader.close()
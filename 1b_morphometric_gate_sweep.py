@@ -0,0 +1,289 @@
+# IJ imports
+from ij import IJ
+from ij.plugin import RoiEnlarger
+from ij.measure import ResultsTable
+from ij.plugin.frame import RoiManager
+
+# Java imports
+from java.lang import Runtime
+
+# python imports
+import time
+import os
+import csv
+import itertools
+import math
+
+# shared helpers, see jars/Lib/myosoft_common.py
+from myosoft_common import (fix_ij_options, fix_ij_dirs, build_particle_shape_table,
+                            gate_particle_shape_table, scale_roi, save_rois_to_zip, log, save_log,
+                            enlarge_all_rois_without_overlap)
+
+#@ String (visibility=MESSAGE, value="<html><b> Welcome to Myosoft - morphometric gate sweep! </b></html>") msg1
+#@ File (label="Select output directory of 1_identify_fibers", description="the directory containing one folder per image", style="directory") output_dir
+#@ File (label="Select CSV file with gate sets (optional)", description="one gate set per row, columns named like the gates below, e.g. minAr,maxCir", style="file", required=false) gate_sets_csv
+#@ String (label="Gate grid (used without CSV file)", description="values to combine per gate, e.g. minAr=10,50,100; minCir=0.4,0.5", value="minAr=10,50,100; minCir=0.4,0.5,0.6") gate_grid
+#@ String (visibility=MESSAGE, value="<html><b> Morphometric Gates (defaults for gates not in the sweep) </b></html>") msg2
+#@ Integer (label="Min Area [um²]", value=10) minAr
+#@ Integer (label="Max Area [um²]", value=6000) maxAr
+#@ Float (label="Min Circularity", value=0.5) minCir
+#@ Float (label="Max Circularity", value=1) maxCir
+#@ Float (label="Min solidity", value=0.0) minSol
+#@ Float (label="Max solidity", value=1) maxSol
+#@ Integer (label="Min perimeter [um]", value=5) minPer
+#@ Integer (label="Max perimeter [um]", value=300) maxPer
+#@ Integer (label="Min min ferret [um]", value=0.1) minMinFer
+#@ Integer (label="Max min ferret [um]", value=100) maxMinFer
+#@ Integer (label="Min ferret AR", value=0) minFAR
+#@ Integer (label="Max ferret AR", value=8) maxFAR
+#@ Float (label="Min roundess", value=0.2) minRnd
+#@ Float (label="Max roundess", value=1) maxRnd
+#@ String (visibility=MESSAGE, value="<html><b> Outputs </b></html>") msg3
+#@ Float (label="ROI expansion [microns]", value=1) enlarge
+#@ Boolean (label="expand ROIs without overlap", description="as in 1_identify_fibers.py: grow the fibers of each gate set at once, pixels between fibers go to the nearest fiber", value=False) enlarge_without_overlap
+#@ Boolean (label="save ROI zips for each gate set", value=True) save_roi_zips
+
+
+# the gate names in the order of the eda_parameters of 1_identify_fibers.py
+GATE_NAMES = ["minAr", "maxAr", "minPer", "maxPer", "minCir", "maxCir", "minRnd", "maxRnd",
+    "minSol", "maxSol", "minFAR", "maxFAR", "minMinFer", "maxMinFer"]
+
+
+def find_fiber_binaries(path):
+    """find the _all_fibers_binary.tif written by 1_identify_fibers.py for every image folder in path
+
+    Parameters
+    ----------
+    path : string
+        the output directory used for 1_identify_fibers.py
+
+    Returns
+    -------
+    array
+        (image title, path to the binary) for every image that has a binary
+    """
+    binaries = []
+    for image_title in sorted( os.listdir(path) ):
+        binary_path = path + "/" + image_title + "/1_identify_fibers/" + image_title + "_all_fibers_binary.tif"
+        if os.path.isfile( binary_path ):
+            binaries.append( (image_title, binary_path) )
+
+    return binaries
+
+
+def read_gate_sets_from_csv(path, default_gates):
+    """read gate sets from a CSV file with one gate set per row
+
+    Parameters
+    ----------
+    path : string
+        path to the CSV file. The header names the gates, e.g. minAr,maxAr,minCir
+    default_gates : dict
+        the gate values used for gates that are not a column of the CSV
+
+    Returns
+    -------
+    array
+        one dict per gate set, mapping all gate names to their value
+    """
+    gate_sets = []
+    with open(path, "rb") as csv_file:
+        for row in csv.DictReader(csv_file):
+            gate_set = dict(default_gates)
+            for gate_name, value in row.items():
+                gate_name = gate_name.strip()
+                if gate_name not in GATE_NAMES:
+                    raise ValueError("unknown gate '" + gate_name + "' in " + path)
+                gate_set[gate_name] = float(value)
+            gate_sets.append(gate_set)
+
+    return gate_sets
+
+
+def expand_gate_grid(grid, default_gates):
+    """build all combinations of the gate values given in a grid string
+
+    Parameters
+    ----------
+    grid : string
+        the values per gate, e.g. "minAr=10,50,100; minCir=0.4,0.5"
+    default_gates : dict
+        the gate values used for gates that are not part of the grid
+
+    Returns
+    -------
+    array
+        one dict per gate set, mapping all gate names to their value
+    """
+    grid_names = []
+    grid_values = []
+    for entry in grid.split(";"):
+        if not entry.strip():
+            continue
+        gate_name, values = entry.split("=")
+        gate_name = gate_name.strip()
+        if gate_name not in GATE_NAMES:
+            raise ValueError("unknown gate '" + gate_name + "' in the gate grid")
+        grid_names.append(gate_name)
+        grid_values.append( [float(value) for value in values.split(",")] )
+
+    gate_sets = []
+    for combination in itertools.product(*grid_values):
+        gate_set = dict(default_gates)
+        gate_set.update( zip(grid_names, combination) )
+        gate_sets.append(gate_set)
+
+    return gate_sets
+
+
+def get_raw_scale(binary):
+    """get the factors mapping a fiber binary to the image it was segmented from, which differ from
+    1 if 1_identify_fibers.py segmented at a lower "segmentation pixel size"
+
+    Parameters
+    ----------
+    binary : ImagePlus
+        the _all_fibers_binary.tif
+
+    Returns
+    -------
+    tuple
+        the x and y scale. 1 for binaries without the size of the image, i.e. from before it was stored.
+    """
+    raw_width = binary.getProp("raw_width")
+    raw_height = binary.getProp("raw_height")
+    if not raw_width or not raw_height:
+        return 1.0, 1.0
+
+    return float(raw_width) / binary.getWidth(), float(raw_height) / binary.getHeight()
+
+
+def get_distribution_summary(values):
+    """summarize a distribution of values
+
+    Parameters
+    ----------
+    values : array
+        the values, e.g. all fiber areas of an image
+
+    Returns
+    -------
+    dict
+        the mean, standard deviation, minimum, median and maximum of the values (0 if empty)
+    """
+    if len(values) == 0:
+        return {"mean": 0.0, "sd": 0.0, "min": 0.0, "median": 0.0, "max": 0.0}
+
+    sorted_values = sorted(values)
+    count = len(sorted_values)
+    mean = sum(sorted_values) / count
+    variance = sum([ (value - mean) ** 2 for value in sorted_values ]) / max(count - 1, 1)
+    if count % 2 == 1:
+        median = sorted_values[count // 2]
+    else:
+        median = (sorted_values[count // 2 - 1] + sorted_values[count // 2]) / 2.0
+
+    return {"mean": mean, "sd": math.sqrt(variance), "min": sorted_values[0], "median": median, "max": sorted_values[-1]}
+
+
+execution_start_time = time.time()
+fix_ij_options()
+log("\\Clear")
+
+output_dir = fix_ij_dirs(output_dir)
+default_gates = dict( zip(GATE_NAMES, [minAr, maxAr, minPer, maxPer, minCir, maxCir, minRnd, maxRnd,
+    minSol, maxSol, minFAR, maxFAR, minMinFer, maxMinFer]) )
+if gate_sets_csv is not None and os.path.isfile( str(gate_sets_csv) ):
+    gate_sets = read_gate_sets_from_csv( fix_ij_dirs(gate_sets_csv), default_gates )
+else:
+    gate_sets = expand_gate_grid( gate_grid, default_gates )
+fiber_binaries = find_fiber_binaries(output_dir)
+
+# update the log for the user
+log( "Gate sweep over " + str(len(fiber_binaries)) + " images in " + output_dir )
+log( " -- settings used -- ")
+if gate_sets_csv is not None and os.path.isfile( str(gate_sets_csv) ):
+    log( "gate sets CSV = " + fix_ij_dirs(gate_sets_csv) )
+else:
+    log( "gate grid = " + gate_grid )
+log( "number of gate sets = " + str(len(gate_sets)) )
+log( "ROI expansion [microns] = " + str(enlarge) )
+log( "ROI expansion without overlap = " + str(enlarge_without_overlap) )
+log( " -- settings used -- ")
+
+# the expansion without overlap works on the ROIs in a RoiManager, like in 1_identify_fibers.py
+rm = RoiManager(True)
+num_threads = Runtime.getRuntime().availableProcessors()
+summary_rt = ResultsTable()
+for image_title, binary_path in fiber_binaries:
+    log( "Now working on " + image_title )
+    sweep_dir = output_dir + "/" + image_title + "/1b_morphometric_gate_sweep"
+    if not os.path.exists( sweep_dir ):
+        os.makedirs( sweep_dir )
+
+    # trace the particles once, every gate set is then only a filter on the shape table
+    binary = IJ.openImage(binary_path)
+    particle_shapes = build_particle_shape_table(binary)
+    pixel_width = binary.getCalibration().pixelWidth
+    x_scale, y_scale = get_raw_scale(binary)
+    raw_width = int( round(binary.getWidth() * x_scale) )
+    raw_height = int( round(binary.getHeight() * y_scale) )
+    binary.close()
+    all_gated_particles = [ gate_particle_shape_table( particle_shapes, [gate_set[name] for name in GATE_NAMES] )
+        for gate_set in gate_sets ]
+
+    # per particle areas with one membership column per gate set, i.e. the area distributions
+    areas_rt = ResultsTable()
+    memberships = [ set(gated_particles) for gated_particles in all_gated_particles ]
+    for particle, area in enumerate( particle_shapes["Area"] ):
+        areas_rt.incrementCounter()
+        areas_rt.addValue("Area", area)
+        for gate_set_index, membership in enumerate(memberships):
+            areas_rt.addValue("gate set " + str(gate_set_index + 1), 1 if particle in membership else 0)
+    areas_rt.save(sweep_dir + "/" + image_title + "_gate_sweep_areas.csv")
+
+    # like 1_identify_fibers.py, map the ROIs to full resolution first if the binary was segmented
+    # downsampled. Without overlap, the expansion of a fiber depends on its neighbours, so it is done
+    # per gate set. Otherwise each particle is enlarged only once, even if it passes several gate sets.
+    if save_roi_zips:
+        full_resolution_rois = {}
+        for particle in set().union(*memberships):
+            roi = particle_shapes["rois"][particle]
+            if x_scale != 1 or y_scale != 1:
+                roi = scale_roi(roi, x_scale, y_scale)
+            full_resolution_rois[particle] = roi
+        if not enlarge_without_overlap:
+            enlarged_rois = dict( [ (particle, RoiEnlarger.enlarge( full_resolution_roi, enlarge * x_scale / pixel_width ))
+                for particle, full_resolution_roi in full_resolution_rois.items() ] )
+
+    for gate_set_index, gated_particles in enumerate(all_gated_particles):
+        areas = [ particle_shapes["Area"][particle] for particle in gated_particles ]
+        area_summary = get_distribution_summary(areas)
+        summary_rt.incrementCounter()
+        summary_rt.addValue("image", image_title)
+        summary_rt.addValue("gate set", gate_set_index + 1)
+        for gate_name in GATE_NAMES:
+            summary_rt.addValue(gate_name, gate_sets[gate_set_index][gate_name])
+        summary_rt.addValue("particles", len( particle_shapes["rois"] ))
+        summary_rt.addValue("fibers", len(gated_particles))
+        for statistic in ["mean", "sd", "min", "median", "max"]:
+            summary_rt.addValue("area " + statistic, area_summary[statistic])
+
+        if save_roi_zips and enlarge_without_overlap:
+            rm.reset()
+            for particle in gated_particles:
+                rm.addRoi( full_resolution_rois[particle].clone() )
+            enlarge_all_rois_without_overlap( enlarge, rm, pixel_width / x_scale, raw_width, raw_height, num_threads )
+            save_rois_to_zip( rm.getRoisAsArray(),
+                sweep_dir + "/" + image_title + "_gate_set_" + str(gate_set_index + 1) + "_fiber_rois.zip" )
+        elif save_roi_zips:
+            save_rois_to_zip( [ enlarged_rois[particle] for particle in gated_particles ],
+                sweep_dir + "/" + image_title + "_gate_set_" + str(gate_set_index + 1) + "_fiber_rois.zip" )
+
+    log( "fibers per gate set: " + ", ".join( [ str(len(gated_particles)) for gated_particles in all_gated_particles ] ) )
+
+summary_rt.save(output_dir + "/gate_sweep_summary.csv")
+total_execution_time_min = (time.time() - execution_start_time) / 60.0
+log("total time in minutes: " + str(total_execution_time_min))
+log( "~~ all done ~~" )
+save_log( str(output_dir + "/gate_sweep_Log") )
@@ -0,0 +1,171 @@
+# IJ imports
+from ij.measure import ResultsTable
+
+# python imports
+import time
+import os
+import json
+from array import array
+
+# shared helpers, see jars/Lib/myosoft_common.py
+from myosoft_common import (fix_ij_dirs, get_image_key, open_image_reader,
+                            get_image_title_from_path, get_threshold_from_histogram,
+                            get_cached_channel_histogram, save_log, get_channel_histogram,
+                            list_images, log)
+
+#@ String (visibility=MESSAGE, value="<html><b> Welcome to Myosoft - dataset thresholds! </b></html>") msg1
+#@ File (label="Select directory with images", style="directory") input_dir
+#@ String (label="File extension of the images", value=".czi") file_extension
+#@ File (label="Select manifest instead (optional)", description="a text file with one image path per line, replaces the image directory", style="file", required=false) manifest_file
+#@ File (label="Select directory for output", description="use the output directory of scripts 2a) to 2c) to share the histogram cache with them", style="directory") output_dir
+#@ String (visibility=MESSAGE, value="<html><b> Thresholds </b></html>") msg2
+#@ String (label="Channels to threshold", description="comma separated, e.g. the MHC channel for 2a), the nucleus channel for 2b), the fiber staining channels for 2c)", value="3") threshold_channels
+#@ String (label="AutoThreshold method", choices={"Mean", "Default", "Huang", "Intermodes", "IsoData", "Li", "MaxEntropy", "MinError", "Minimum", "Moments", "Otsu", "Percentile", "RenyiEntropy", "Shanbhag", "Triangle", "Yen"}, value="Mean") threshold_method
+#@ Integer (label="pyramid level (0=full resolution, -1=lowest)", description="lower levels of the resolution pyramid are read much faster, full resolution histograms are cached for scripts 1) to 2c)", value=0) pyramid_level
+#@ Integer (label="tile size [px]", description="the edge length of the tiles that are read at once", value=4096) tile_size
+
+
+def set_pyramid_level(reader, pyramid_level):
+    """set the reader to a level of the resolution pyramid of its current series
+
+    Parameters
+    ----------
+    reader : ImageProcessorReader
+        the reader as returned by open_image_reader, set to the series to read
+    pyramid_level : integer
+        the level to read, 0 for full resolution. Negative values count from the lowest resolution,
+        levels beyond the pyramid are limited to the lowest resolution.
+
+    Returns
+    -------
+    integer
+        the level that was set
+    """
+    level_count = reader.getResolutionCount()
+    if pyramid_level < 0:
+        pyramid_level = max(0, level_count + pyramid_level)
+    pyramid_level = min(pyramid_level, level_count - 1)
+    reader.setResolution(pyramid_level)
+
+    return pyramid_level
+
+
+def merge_histograms(merged_histogram, histogram):
+    """add the pixel counts of a histogram to a merged histogram
+
+    Parameters
+    ----------
+    merged_histogram : array
+        the merged histogram so far, or None for the first histogram
+    histogram : array
+        the pixel count of every intensity value
+
+    Returns
+    -------
+    array
+        the merged histogram
+    """
+    if merged_histogram is None:
+        return array("l", histogram)
+    if len(merged_histogram) != len(histogram):
+        raise ValueError("cannot merge histograms of " + str(len(merged_histogram)) + " and " + str(len(histogram))
+            + " bins, all images need the same bit depth")
+    for value, count in enumerate(histogram):
+        if count > 0:
+            merged_histogram[value] += count
+
+    return merged_histogram
+
+
+def write_dataset_thresholds(target, images, method, pyramid_level, merged_histograms):
+    """save the dataset-wide threshold of every channel as read by scripts 2a), 2b) and 2c)
+
+    Parameters
+    ----------
+    target : string
+        the path of the JSON file to write
+    images : array
+        the paths of all images the histograms were merged from
+    method : string
+        the AutoThreshold method
+    pyramid_level : integer
+        the requested pyramid level
+    merged_histograms : dict
+        the merged histogram of every channel, keyed by channel
+
+    Returns
+    -------
+    dict
+        the threshold of every channel, keyed by channel
+    """
+    thresholds = dict( [ (channel, get_threshold_from_histogram(histogram, method))
+        for channel, histogram in merged_histograms.items() ] )
+    with open(target, "w") as thresholds_file:
+        json.dump( {
+            "method": method,
+            "pyramid_level": pyramid_level,
+            "images": images,
+            "thresholds": dict( [ (str(channel), threshold) for channel, threshold in thresholds.items() ] ),
+            "pixel_counts": dict( [ (str(channel), sum(histogram)) for channel, histogram in merged_histograms.items() ] )
+        }, thresholds_file, indent=2, sort_keys=True )
+
+    return thresholds
+
+
+execution_start_time = time.time()
+log("\\Clear")
+
+output_dir = fix_ij_dirs(output_dir)
+histogram_cache_dir = output_dir + "/histogram_cache"
+manifest = fix_ij_dirs(manifest_file) if manifest_file is not None and os.path.isfile( str(manifest_file) ) else None
+images = list_images( fix_ij_dirs(input_dir), file_extension, manifest )
+channels = [ int(channel) for channel in threshold_channels.split(",") if channel.strip() ]
+if not os.path.exists( output_dir ):
+    os.makedirs( output_dir )
+
+# update the log for the user
+log( "Merging the channel histograms of " + str(len(images)) + " images" )
+log( " -- settings used -- ")
+log( "channels = " + str(channels) )
+log( "AutoThreshold method = " + threshold_method )
+log( "pyramid level = " + str(pyramid_level) )
+log( "tile size [px] = " + str(tile_size) )
+log( " -- settings used -- ")
+
+# stream every channel of every series tile by tile, only the merged histograms are kept
+merged_histograms = {}
+image_rt = ResultsTable()
+for image_path in images:
+    log( "reading " + os.path.basename(image_path) )
+    reader = open_image_reader(image_path)
+    series_count = reader.getSeriesCount()
+    # full resolution histograms are the ones scripts 1) to 2c) look up, lower levels are not cached
+    image_hash = get_image_key(image_path) if pyramid_level == 0 else None
+    for series in range(series_count):
+        reader.setSeries(series)
+        level = set_pyramid_level(reader, pyramid_level)
+        image_rt.incrementCounter()
+        image_rt.addValue( "image", get_image_title_from_path(image_path, series if series_count > 1 else None) )
+        image_rt.addValue( "path", image_path )
+        image_rt.addValue( "series", series )
+        image_rt.addValue( "pyramid level", level )
+        for channel in channels:
+            if image_hash is not None:
+                histogram = get_cached_channel_histogram( histogram_cache_dir, image_hash, series, channel,
+                    reader, tile_size )
+            else:
+                histogram = get_channel_histogram(reader, channel, tile_size)
+            merged_histograms[channel] = merge_histograms( merged_histograms.get(channel), histogram )
+            # the per image thresholds show how much the images of the dataset vary
+            image_rt.addValue( "channel " + str(channel) + " image threshold", get_threshold_from_histogram(histogram, threshold_method) )
+    reader.close()
+
+thresholds = write_dataset_thresholds( output_dir + "/dataset_thresholds.json", images, threshold_method, pyramid_level, merged_histograms )
+image_rt.save( output_dir + "/dataset_thresholds_per_image.csv" )
+for channel in channels:
+    log( "channel " + str(channel) + " dataset threshold: " + str(thresholds[channel]) )
+
+total_execution_time_min = (time.time() - execution_start_time) / 60.0
+log("total time in minutes: " + str(total_execution_time_min))
+log( "~~ all done ~~" )
+save_log( output_dir + "/dataset_thresholds_Log" )
@@ -3,21 +3,36 @@
 
 # IJ imports
 # TODO: are the imports RoiManager and ResultsTable needed when using the services?
-from ij import IJ, WindowManager as wm
-from ij.plugin import Duplicator, RoiEnlarger, RoiScaler
+from ij import IJ
+from ij.plugin import Duplicator, RoiEnlarger
+from ij.measure import ResultsTable
+from ij.plugin.frame import RoiManager
 from trainableSegmentation import WekaSegmentation
 from de.biovoxxel.toolbox import Extended_Particle_Analyzer
 
-# Bio-formats imports
-from loci.plugins import BF
-from loci.plugins.in import ImporterOptions
+# Java imports
+from java.awt import GraphicsEnvironment
+from java.lang import Runtime
 
 # python imports
 import time
 import os
 
+# shared helpers, see jars/Lib/myosoft_common.py
+from myosoft_common import (HISTOGRAM_TILE_SIZE, fix_ij_dirs, get_file_hash, get_image_key,
+                            is_journal_complete, write_journal, open_image_reader,
+                            open_series_from_reader, get_image_title_from_path,
+                            get_threshold_from_histogram, get_cached_channel_histogram,
+                            read_dataset_thresholds, measure_in_all_rois, change_subset_roi_color,
+                            show_all_rois_on_image, write_roi_store, get_flag_column, save_all_rois,
+                            save_selected_rois, save_rois_to_zip, get_central_rois,
+                            select_central_nuclei, get_results_columns, add_yes_no_column,
+                            write_results, enhance_contrast, save_overview_png, start_stage_timer,
+                            time_stage, write_stage_timings, save_log, setup_defined_ij,
+                            open_rois_from_file, get_series_roi_zip, log)
+
 #@ String (visibility=MESSAGE, value="<html><b> Welcome to Myosoft - centralized nuclei counter! </b></html>") msg1
-#@ File (label="Select fiber-ROIs zip-file", style="file") roi_zip
+#@ File (label="Select fiber-ROIs zip-file or ROI store", style="file") roi_zip
 #@ File (label="Select image file", description="select your image") path_to_image
 #@ File (label="Select directory for output", style="directory") output_dir
 #@ String (visibility=MESSAGE, value="<html><b> shrink ROIs to find nuclei </b></html>") msg3
@@ -25,415 +40,155 @@ import os
 #@ String (visibility=MESSAGE, value="<html><b> channel positions in the hyperstack </b></html>") msg5
 #@ Integer (label="Nucleus staining channel number", style="slider", min=1, max=5, value=3) nucleus_channel
 #@ Integer (label="minimum nucleus intensity (0=auto)", description="0 = automatic threshold detection", value=0) min_nucleus_intensity
-#@ ResultsTable rt
-#@ RoiManager rm
-
-
-def fix_ij_options():
-    """put IJ into a defined state
-    """
-    # disable inverting LUT
-    IJ.run("Appearance...", " menu=0 16-bit=Automatic")
-    # set foreground color to be white, background black
-    IJ.run("Colors...", "foreground=white background=black selection=red")
-    # black BG for binary images and pad edges when eroding
-    IJ.run("Options...", "black pad")
-    # set saving format to .txt files
-    IJ.run("Input/Output...", "file=.txt save_column save_row")
-    # ============= DON’T MOVE UPWARDS =============
-    # set "Black Background" in "Binary Options"
-    IJ.run("Options...", "black")
-    # scale when converting = checked
-    IJ.run("Conversions...", "scale")
-
-
-def fix_ij_dirs(path):
-    """use forward slashes in directory paths
-
-    Parameters
-    ----------
-    path : string
-        a directory path obtained from dialogue or script parameter
-
-    Returns
-    -------
-    string
-        a more robust path with forward slashes as separators
-    """
-
-    fixed_path = str(path).replace("\\", "/")
-    # fixed_path = fixed_path + "/"
-
-    return fixed_path
-
-
-def open_image_with_BF(path_to_file):
-    """ use Bio-Formats to opens the first image from an image file path
-
-    Parameters
-    ----------
-    path_to_file : string
-        path to the image file
-
-    Returns
-    -------
-    ImagePlus
-        the first imp stored in a give file
-    """
-    options = ImporterOptions()
-    options.setColorMode(ImporterOptions.COLOR_MODE_GRAYSCALE)
-    options.setAutoscale(True)
-    options.setId(path_to_file)
-    imps = BF.openImagePlus(options) # is an array of ImagePlus
-
-    return imps[0]
-
-
-def fix_BF_czi_imagetitle(imp):
-    image_title = os.path.basename( imp.getShortTitle() )
-    image_title = image_title.replace(".czi", "")
-    image_title = image_title.replace(" ", "_")
-    image_title = image_title.replace("_-_", "")
-    image_title = image_title.replace("__", "_")
-    image_title = image_title.replace("#", "Series")
-
-    return image_title
-
-
-def clear_ij_roi_manager(rm):
-    """delete all ROIs from the RoiManager
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    """
-    rm.runCommand('reset')
-
-
-def get_threshold_from_method(imp, channel, method):
-    """returns the threshold value of chosen IJ AutoThreshold method in desired channel
-
-    Parameters
-    ----------
-    imp : ImagePlus
-        the imp from which to get the threshold value
-    channel : integer
-        the channel in which to get the treshold
-    method : string
-        the AutoThreshold method to use
-
-    Returns
-    -------
-    list
-        the upper and the lower threshold (integer values)
-    """
-    imp.setC(channel) # starts at 1
-    ip = imp.getProcessor()
-    ip.setAutoThreshold(method + " dark")
-    lower_thr = ip.getMinThreshold()
-    upper_thr = ip.getMaxThreshold()
-    ip.resetThreshold()
-
-    return lower_thr, upper_thr
-
-
-def measure_in_all_rois( imp, channel, rm ):
-    """measures in all ROIS on a given channel of imp all parameters that are set in IJ "Set Measurements"
-
-    Parameters
-    ----------
-    imp : ImagePlus
-        the imp to measure on
-    channel : integer
-        the channel to measure in. starts at 1.
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    """
-    imp.setC(channel)
-    rm.runCommand(imp,"Deselect")
-    rm.runCommand(imp,"Measure")
-
-
-def change_subset_roi_color( rm, selected_rois, color ):
-    """change the color of selected ROIs in the RoiManager
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    selected_rois : array
-        ROIs in the RoiManager to change
-    color : string
-        the desired color. e.g. "green", "red", "yellow", "magenta" ...
-    """
-    rm.runCommand("Deselect")
-    rm.setSelectedIndexes(selected_rois)
-    rm.runCommand("Set Color", color)
-    rm.runCommand("Deselect")
-
-
-def show_all_rois_on_image(rm, imp):
-    """shows all ROIs in the ROiManager on imp
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    imp : ImagePlus
-        the imp on which to show the ROIs
-    """
-    imp.show()
-    rm.runCommand(imp,"Show All")
-
-
-def save_all_rois(rm, target):
-    """save all ROIs in the RoiManager as zip to target path
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    target : string
-        the path in to store the ROIs. e.g. /my-images/resulting_rois.zip
-    """
-    rm.runCommand("Save", target)
+#@ File (label="dataset thresholds (optional)", description="the dataset_thresholds.json of 2_dataset_thresholds.py, replaces the automatic threshold of each image", style="file", required=false) dataset_thresholds_file
+#@ Boolean (label="also save ROI-zips", description="all ROIs and their classes are saved in one .roistore, tick this for RoiManager compatible zips, e.g. for manual curation", value=True) save_roi_zips
+#@ Integer (label="overview PNG maximum size [px] (0=full resolution)", description="the overview PNG is downsampled so that its longer side is at most this size", value=4096) overview_max_size
+#@ Boolean (label="save a zoomable full resolution overview", description="a Deep Zoom pyramid of PNG tiles next to the overview PNG, e.g. for OpenSeadragon", value=False) overview_pyramid
 
 
-def save_selected_rois( rm, selected_rois, target ):
-    """save selected ROIs in the RoiManager as zip to target path
+# there is no window to show the ROI Manager in when running headless
+headless = GraphicsEnvironment.isHeadless()
+rm = RoiManager(True) if headless else RoiManager.getRoiManager()
+rt = ResultsTable.getResultsTable()
 
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    selected_rois : array
-        ROIs in the RoiManager to save
-    target : string
-        the path in to store the ROIs. e.g. /my-images/resulting_rois_subset.zip
-    """
-    rm.runCommand("Deselect")
-    rm.setSelectedIndexes(selected_rois)
-    rm.runCommand("save selected", target)
-    rm.runCommand("Deselect")
-
-
-def scale_all_rois( rm, scaling_factor ):
-    """inflate or shrink all ROIs in the RoiManager
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    scaling_factor : float
-        the scaling factor by which to inflate (if > 1) or shrink (if < 1 )
-    """
-    all_rois = rm.getRoisAsArray()
-    rm.reset()
-    for roi in all_rois:
-        scaled_roi = RoiScaler.scale(roi, scaling_factor, scaling_factor, True)
-        rm.addRoi(scaled_roi)
-
-
-def select_central_nuclei( imp, channel, rm, min_intensity ):
-    """For all ROIs in the RoiManager, select ROIs based on intensity measurement in given channel of imp.
-    See https://imagej.nih.gov/ij/developer/api/ij/process/ImageStatistics.html
-
-    Parameters
-    ----------
-    imp : ImagePlus
-        the imp on which to measure
-    channel : integer
-        the channel on which to measure. starts at 1
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    min_intensity : integer
-        the selection criterion (here: intensity threshold)
-
-    Returns
-    -------
-    array
-        a selection of ROIs which passed the selection criterion (are above the threshold)
-    """
-    imp.setC(channel)
-    all_rois = rm.getRoisAsArray()
-    selected_rois = []
-    for i, roi in enumerate(all_rois):
-        imp.setRoi(roi)
-        stats = imp.getStatistics()
-        if stats.max > min_intensity:
-            selected_rois.append(i)
-
-    return selected_rois
-
-
-def open_rois_from_zip( rm, path ):
-    """open RoiManager ROIs from zip and adds them to the RoiManager
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    path : string
-        path to the ROI zip file
-    """
-    rm.runCommand("Open", path)
-
-
-def preset_results_column( rt, column, value):
-    """pre-set all rows in given column of the IJ-ResultsTable with desired value
-
-    Parameters
-    ----------
-    rt : ResultsTable
-        a reference of the IJ-ResultsTable
-    column : string
-        the desired column. will be created if it does not yet exist
-    value : string or float or integer
-        the value to be set
-    """
-    for i in range( rt.size() ):
-        rt.setValue(column, i, value)
-
-    rt.show("Results")
-
-
-def add_results( rt, column, row, value ):
-    """adds a value in desired rows of a given column
-
-    Parameters
-    ----------
-    rt : ResultsTable
-        a reference of the IJ-ResultsTable
-    column : string
-        the column in which to add the values
-    row : array
-        the row numbers in which too add the values.
-    value : string or float or integer
-        the value to be set
-    """
-    for i in range( len( row ) ):
-        rt.setValue(column, row[i], value)
-
-    rt.show("Results")
-
-
-def enhance_contrast( imp ):
-    """use "Auto" Contrast & Brightness settings in each channel of imp
-
-    Parameters
-    ----------
-    imp : ImagePlus
-        the imp on which to change C&B
-    """
-    for channel in range( imp.getDimensions()[2] ):
-        imp.setC(channel + 1) # IJ channels start at 1
-        IJ.run(imp, "Enhance Contrast", "saturated=0.35")
-
-
-def renumber_rois(rm):
-    """rename all ROIs in the RoiManager according to their number
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    """
-    number_of_rois = rm.getCount()
-    for roi in range( number_of_rois ):
-        rm.rename( roi, str(roi + 1) )
-
-
-def setup_defined_ij(rm, rt):
-    """set up a clean and defined Fiji user environment
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    rt : ResultsTable
-        a reference of the IJ-ResultsTable
-    """
-    fix_ij_options()
-    rm.runCommand('reset')
-    rt.reset()
-    IJ.log("\\Clear")
-
-
-execution_start_time = time.time()
 setup_defined_ij(rm, rt)
 
-# open image using Bio-Formats
 path_to_image = fix_ij_dirs(path_to_image)
-raw = open_image_with_BF(path_to_image)
-
-# get image info
-raw_image_calibration = raw.getCalibration()
-raw_image_title = fix_BF_czi_imagetitle(raw)
 
 # take care of paths and directories
 input_rois_path = fix_ij_dirs( roi_zip )
+histogram_cache_dir = fix_ij_dirs(output_dir) + "/histogram_cache"
 output_dir = fix_ij_dirs(output_dir) + "/2b_central_nuclei_counter"
 
 if not os.path.exists( str(output_dir) ):
     os.makedirs( str(output_dir) )
 
-# open ROIS and show on image
-open_rois_from_zip( rm, input_rois_path )
-show_all_rois_on_image( rm, raw )
-
-# update the log for the user
-IJ.log( "Now working on " + str(raw_image_title) )
-if raw_image_calibration.scaled() == False:
-    IJ.log("Your image is not spatially calibrated! Size measurements are only possible in [px].")
-IJ.log( " -- settings used -- ")
-IJ.log( "ROI Shrinking factor = " + str(shrink) )
-IJ.log( "Selected fiber-ROIs zip-file = " + str(input_rois_path) )
-IJ.log( " -- settings used -- ")
-
-# shrink ROIs and look for nuclei
-rm.hide()
-raw.hide()
-scale_all_rois( rm, shrink )
-renumber_rois(rm)
-save_all_rois( rm, output_dir + "/" + raw_image_title + "_all_fiber_rois_shrunk.zip" )
-
-if min_nucleus_intensity == 0:
-    min_nucleus_intensity = get_threshold_from_method(raw, nucleus_channel, "Mean")[0]
-    IJ.log( "automatic intensity threshold detection: True" )
-
-IJ.log( "nucleus intensity threshold: " + str(min_nucleus_intensity) )
-central_nuclei_fibers = select_central_nuclei( raw, nucleus_channel, rm, min_nucleus_intensity )
-clear_ij_roi_manager(rm)
-open_rois_from_zip( rm, input_rois_path )
-change_subset_roi_color(rm, central_nuclei_fibers, "yellow")
-save_selected_rois( rm, central_nuclei_fibers, output_dir + "/" + raw_image_title + "_central_nuclei_fiber_rois.zip")
-save_all_rois( rm, output_dir + "/" + raw_image_title + "_all_fiber_rois_central_nuclei_color-coded.zip" )
-
-# measure size & shape, add column for pos nuclei and fiber findings, save
-IJ.run("Set Measurements...", "area perimeter shape feret's redirect=None decimal=4")
-IJ.run("Clear Results", "")
-measure_in_all_rois( raw, nucleus_channel, rm )
-preset_results_column( rt, "Centralized Nuclei (yellow)" , "NO" )
-add_results( rt, "Centralized Nuclei (yellow)", central_nuclei_fibers, "YES")
-rt.save(output_dir + "/" + raw_image_title + "_centralized_nuclei_results.csv")
-
-# dress up the original image, save a overlay-png, present original to the user
-rm.show()
-raw.show()
-show_all_rois_on_image( rm, raw )
-raw.setDisplayMode(IJ.COMPOSITE)
-enhance_contrast( raw )
-IJ.run("From ROI Manager", "") # ROIs -> overlays so they show up in the saved png
-qc_duplicate = raw.duplicate()
-IJ.saveAs(qc_duplicate, "PNG", output_dir + "/" + raw_image_title + "_centralized_nuclei")
-qc_duplicate.close()
-wm.toFront( raw.getWindow() )
-IJ.run("Remove Overlay", "")
-raw.setDisplayMode(IJ.GRAYSCALE)
-show_all_rois_on_image( rm, raw )
-total_execution_time_min = (time.time() - execution_start_time) / 60.0
-IJ.log("total time in minutes: " + str(total_execution_time_min))
-IJ.log( "~~ all done ~~" )
-IJ.selectWindow("Log")
-IJ.saveAs("Text", str(output_dir + "/" + raw_image_title + "_centralized_nuclei_Log"))
\ No newline at end of file
+# all series of the file are read through one reader session
+reader = open_image_reader(path_to_image)
+series_count = reader.getSeriesCount()
+series_titles = [ get_image_title_from_path(path_to_image, series if series_count > 1 else None) for series in range(series_count) ]
+if get_series_roi_zip(input_rois_path, series_titles, 0) is None:
+    raise ValueError(path_to_image + " has " + str(series_count) + " series, but " + input_rois_path + " belongs to none of them")
+image_hash = get_image_key(path_to_image)
+# one threshold per channel for the whole dataset replaces the automatic threshold of each image
+dataset_thresholds = None
+if dataset_thresholds_file is not None and os.path.isfile( str(dataset_thresholds_file) ):
+    dataset_thresholds_path = fix_ij_dirs(dataset_thresholds_file)
+    dataset_thresholds = read_dataset_thresholds( dataset_thresholds_path, [nucleus_channel] if min_nucleus_intensity == 0 else [] )
+    dataset_thresholds_hash = get_file_hash(dataset_thresholds_path)
+
+for series in range(series_count):
+    execution_start_time = time.time()
+    raw_image_title = series_titles[series]
+    series_rois_path = get_series_roi_zip(input_rois_path, series_titles, series)
+    if not os.path.isfile(series_rois_path):
+        log( "Skipping " + str(raw_image_title) + ": no ROI-zip found at " + series_rois_path )
+        continue
+
+    # skip the series if a previous run with the same inputs and parameters is complete
+    journal_path = output_dir + "/" + raw_image_title + "_journal.json"
+    input_hashes = { path_to_image: image_hash, series_rois_path: get_file_hash(series_rois_path) }
+    if dataset_thresholds is not None:
+        input_hashes[dataset_thresholds_path] = dataset_thresholds_hash
+    run_parameters = dict( [(name, str(value)) for name, value in [
+        ("shrink", shrink), ("nucleus_channel", nucleus_channel), ("min_nucleus_intensity", min_nucleus_intensity), ("save_roi_zips", save_roi_zips), ("overview_max_size", overview_max_size), ("overview_pyramid", overview_pyramid), ("series", series)]] )
+
+    if is_journal_complete(journal_path, input_hashes, run_parameters):
+        log( "Skipping " + str(raw_image_title) + ": already processed with the same inputs and parameters" )
+        continue
+
+    setup_defined_ij(rm, rt)
+    # wall time, CPU time and memory of every stage go to a _timings.json next to the outputs
+    stage_timer = start_stage_timer("Bio-Formats open", rm)
+    reader.setSeries(series)
+    raw = open_series_from_reader(reader, raw_image_title, [nucleus_channel]) # the only channel needed
+    raw_image_calibration = raw.getCalibration()
+    artifacts = []
+
+    # open ROIS and show on image
+    time_stage(stage_timer, "ROI open")
+    open_rois_from_file( rm, series_rois_path )
+    if not headless and series == series_count - 1:
+        show_all_rois_on_image( rm, raw )
+
+    # update the log for the user
+    log( "Now working on " + str(raw_image_title) )
+    if raw_image_calibration.scaled() == False:
+        log("Your image is not spatially calibrated! Size measurements are only possible in [px].")
+    log( " -- settings used -- ")
+    log( "ROI Shrinking factor = " + str(shrink) )
+    log( "Selected fiber-ROIs zip-file = " + str(series_rois_path) )
+    log( "dataset thresholds = " + (dataset_thresholds_path if dataset_thresholds is not None else "none") )
+    log( " -- settings used -- ")
+
+    time_stage(stage_timer, "central regions")
+    # shrink the fibers to their central region and look for nuclei there, the original ROIs stay
+    # in the RoiManager
+    if not headless:
+        rm.hide()
+        raw.hide()
+    num_threads = Runtime.getRuntime().availableProcessors()
+    fiber_rois = rm.getRoisAsArray()
+    shrunk_rois = get_central_rois(fiber_rois, shrink, num_threads)
+    write_roi_store( shrunk_rois, {}, output_dir + "/" + raw_image_title + "_all_fiber_rois_shrunk.roistore" )
+    artifacts.append( output_dir + "/" + raw_image_title + "_all_fiber_rois_shrunk.roistore" )
+    if save_roi_zips:
+        save_rois_to_zip( shrunk_rois, output_dir + "/" + raw_image_title + "_all_fiber_rois_shrunk.zip" )
+        artifacts.append( output_dir + "/" + raw_image_title + "_all_fiber_rois_shrunk.zip" )
+
+    time_stage(stage_timer, "positivity")
+    nucleus_threshold = min_nucleus_intensity
+    if nucleus_threshold == 0 and dataset_thresholds is not None:
+        nucleus_threshold = dataset_thresholds[nucleus_channel]
+        log( "dataset intensity threshold: True" )
+    elif nucleus_threshold == 0:
+        nucleus_histogram = get_cached_channel_histogram( histogram_cache_dir, image_hash, series, nucleus_channel,
+            reader, HISTOGRAM_TILE_SIZE )
+        nucleus_threshold = get_threshold_from_histogram(nucleus_histogram, "Mean")
+        log( "automatic intensity threshold detection: True" )
+
+    log( "nucleus intensity threshold: " + str(nucleus_threshold) )
+    central_nuclei_fibers = select_central_nuclei( raw, 1, rm, nucleus_threshold, shrunk_rois )
+    change_subset_roi_color(rm, central_nuclei_fibers, "yellow")
+    time_stage(stage_timer, "ROI writes")
+    if save_roi_zips:
+        save_selected_rois( rm, central_nuclei_fibers, output_dir + "/" + raw_image_title + "_central_nuclei_fiber_rois.zip")
+        artifacts.append( output_dir + "/" + raw_image_title + "_central_nuclei_fiber_rois.zip" )
+    if save_roi_zips:
+        save_all_rois( rm, output_dir + "/" + raw_image_title + "_all_fiber_rois_central_nuclei_color-coded.zip" )
+        artifacts.append( output_dir + "/" + raw_image_title + "_all_fiber_rois_central_nuclei_color-coded.zip" )
+    write_roi_store( rm.getRoisAsArray(), { "central nuclei": get_flag_column( rm.getCount(), central_nuclei_fibers ) },
+        output_dir + "/" + raw_image_title + "_central_nuclei_fibers.roistore" )
+    artifacts.append( output_dir + "/" + raw_image_title + "_central_nuclei_fibers.roistore" )
+
+    # measure size & shape, add column for pos nuclei and fiber findings, save
+    time_stage(stage_timer, "measurement")
+    IJ.run("Set Measurements...", "area perimeter shape feret's redirect=None decimal=4")
+    IJ.run("Clear Results", "")
+    measure_in_all_rois( raw, 1, rm )
+    results_columns = get_results_columns(rt)
+    add_yes_no_column( results_columns, "Centralized Nuclei (yellow)", rm.getCount(), central_nuclei_fibers )
+    time_stage(stage_timer, "CSV writes")
+    write_results( rt, results_columns, output_dir + "/" + raw_image_title + "_centralized_nuclei_results.csv" )
+    artifacts.append( output_dir + "/" + raw_image_title + "_centralized_nuclei_results.csv" )
+
+    # save a overlay-png, present original to the user
+    time_stage(stage_timer, "PNG writes")
+    artifacts.extend( save_overview_png( raw, rm, output_dir + "/" + raw_image_title + "_centralized_nuclei", overview_max_size, overview_pyramid ) )
+    if not headless and series == series_count - 1:
+        rm.show()
+        enhance_contrast( raw )
+        show_all_rois_on_image( rm, raw )
+    total_execution_time_min = (time.time() - execution_start_time) / 60.0
+    log("total time in minutes: " + str(total_execution_time_min))
+    log( "~~ all done ~~" )
+    artifacts.append( save_log( str(output_dir + "/" + raw_image_title + "_centralized_nuclei_Log") ) )
+    artifacts.append( write_stage_timings( stage_timer, output_dir + "/" + raw_image_title + "_timings.json",
+        "2b_central_nuclei_counter", raw_image_title, series ) )
+    write_journal(journal_path, input_hashes, run_parameters, artifacts)
+    # only the image of the last series stays open, the others are released before the next series is read
+    if raw is not None and series < series_count - 1:
+        raw.close()
+        raw.flush()
+
+reader.close()
@@ -3,21 +3,38 @@
 
 # IJ imports
 # TODO: are the imports RoiManager and ResultsTable needed when using the services?
-from ij import IJ, WindowManager as wm
-from ij.plugin import Duplicator, RoiEnlarger, RoiScaler
+from ij import IJ
+from ij.plugin import Duplicator, RoiEnlarger
+from ij.measure import ResultsTable
+from ij.plugin.frame import RoiManager
 from trainableSegmentation import WekaSegmentation
 from de.biovoxxel.toolbox import Extended_Particle_Analyzer
 
-# Bio-formats imports
-from loci.plugins import BF
-from loci.plugins.in import ImporterOptions
+# Java imports
+from java.awt import GraphicsEnvironment
+from java.lang import Runtime
 
 # python imports
 import time
 import os
 
+# shared helpers, see jars/Lib/myosoft_common.py
+from myosoft_common import (FIBER_HISTOGRAM_BINS, HISTOGRAM_TILE_SIZE, fix_ij_dirs, get_file_hash,
+                            get_file_signature, get_image_key, is_journal_complete, write_journal,
+                            open_image_reader, open_series_from_reader, get_image_title_from_path,
+                            get_threshold_from_histogram, get_cached_channel_histogram,
+                            read_dataset_thresholds, measure_in_all_rois, change_all_roi_color,
+                            change_subset_roi_color, show_all_rois_on_image, write_roi_store,
+                            get_flag_column, save_all_rois, save_selected_rois, measure_rois,
+                            get_fiber_stats_cache_entry, get_fiber_stats_cache_path,
+                            read_fiber_stats_cache, write_fiber_stats_cache, get_results_columns,
+                            set_results_columns, add_yes_no_column, write_results, enhance_contrast,
+                            save_overview_png, start_stage_timer, time_stage, write_stage_timings,
+                            save_log, setup_defined_ij, open_rois_from_file, get_series_roi_zip,
+                            log)
+
 #@ String (visibility=MESSAGE, value="<html><b> Welcome to Myosoft! </b></html>") msg1
-#@ File (label="Select fiber-ROIs zip-file", style="file") roi_zip
+#@ File (label="Select fiber-ROIs zip-file or ROI store", style="file") roi_zip
 #@ File (label="Select image file", description="select your image") path_to_image
 #@ File (label="Select directory for output", style="directory") output_dir
 #@ Boolean (label="close image after processing", description="tick this box when using batch mode", value=False) close_raw
@@ -28,455 +45,238 @@ import os
 #@ Integer (label="minimum fiber intensity (0=auto)", description="0 = automatic threshold detection", value=0) min_fiber_intensity_1
 #@ Integer (label="minimum fiber intensity (0=auto)", description="0 = automatic threshold detection", value=0) min_fiber_intensity_2
 #@ Integer (label="minimum fiber intensity (0=auto)", description="0 = automatic threshold detection", value=0) min_fiber_intensity_3
-#@ ResultsTable rt
-#@ RoiManager rm
-
-
-def fix_ij_options():
-    """put IJ into a defined state
-    """
-    # disable inverting LUT
-    IJ.run("Appearance...", " menu=0 16-bit=Automatic")
-    # set foreground color to be white, background black
-    IJ.run("Colors...", "foreground=white background=black selection=red")
-    # black BG for binary images and pad edges when eroding
-    IJ.run("Options...", "black pad")
-    # set saving format to .txt files
-    IJ.run("Input/Output...", "file=.txt save_column save_row")
-    # ============= DON’T MOVE UPWARDS =============
-    # set "Black Background" in "Binary Options"
-    IJ.run("Options...", "black")
-    # scale when converting = checked
-    IJ.run("Conversions...", "scale")
-
-
-def fix_ij_dirs(path):
-    """use forward slashes in directory paths
-
-    Parameters
-    ----------
-    path : string
-        a directory path obtained from dialogue or script parameter
-
-    Returns
-    -------
-    string
-        a more robust path with forward slashes as separators
-    """
-
-    fixed_path = str(path).replace("\\", "/")
-    # fixed_path = fixed_path + "/"
-
-    return fixed_path
-
-
-def open_image_with_BF(path_to_file):
-    """ use Bio-Formats to opens the first image from an image file path
-
-    Parameters
-    ----------
-    path_to_file : string
-        path to the image file
-
-    Returns
-    -------
-    ImagePlus
-        the first imp stored in a give file
-    """
-    options = ImporterOptions()
-    options.setColorMode(ImporterOptions.COLOR_MODE_GRAYSCALE)
-    options.setAutoscale(True)
-    options.setId(path_to_file)
-    imps = BF.openImagePlus(options) # is an array of ImagePlus
-
-    return imps[0]
-
-
-def fix_BF_czi_imagetitle(imp):
-    image_title = os.path.basename( imp.getShortTitle() )
-    image_title = image_title.replace(".czi", "")
-    image_title = image_title.replace(" ", "_")
-    image_title = image_title.replace("_-_", "")
-    image_title = image_title.replace("__", "_")
-    image_title = image_title.replace("#", "Series")
-
-    return image_title
-
-
-def clear_ij_roi_manager(rm):
-    """delete all ROIs from the RoiManager
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    """
-    rm.runCommand('reset')
-
-
-def get_threshold_from_method(imp, channel, method):
-    """returns the threshold value of chosen IJ AutoThreshold method in desired channel
-
-    Parameters
-    ----------
-    imp : ImagePlus
-        the imp from which to get the threshold value
-    channel : integer
-        the channel in which to get the treshold
-    method : string
-        the AutoThreshold method to use
-
-    Returns
-    -------
-    list
-        the upper and the lower threshold (integer values)
-    """
-    imp.setC(channel) # starts at 1
-    ip = imp.getProcessor()
-    ip.setAutoThreshold(method + " dark")
-    lower_thr = ip.getMinThreshold()
-    upper_thr = ip.getMaxThreshold()
-    ip.resetThreshold()
-
-    return lower_thr, upper_thr
-
-
-def measure_in_all_rois( imp, channel, rm ):
-    """measures in all ROIS on a given channel of imp all parameters that are set in IJ "Set Measurements"
-
-    Parameters
-    ----------
-    imp : ImagePlus
-        the imp to measure on
-    channel : integer
-        the channel to measure in. starts at 1.
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    """
-    imp.setC(channel)
-    rm.runCommand(imp,"Deselect")
-    rm.runCommand(imp,"Measure")
-
-
-def change_all_roi_color( rm, color ):
-    """change the color of all ROIs in the RoiManager
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    color : string
-        the desired color. e.g. "green", "red", "yellow", "magenta" ...
-    """
-    number_of_rois = rm.getCount()
-    for roi in range( number_of_rois ):
-        rm.select(roi)
-        rm.runCommand("Set Color", color)
-
-
-def change_subset_roi_color( rm, selected_rois, color ):
-    """change the color of selected ROIs in the RoiManager
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    selected_rois : array
-        ROIs in the RoiManager to change
-    color : string
-        the desired color. e.g. "green", "red", "yellow", "magenta" ...
-    """
-    rm.runCommand("Deselect")
-    rm.setSelectedIndexes(selected_rois)
-    rm.runCommand("Set Color", color)
-    rm.runCommand("Deselect")
-
-
-def show_all_rois_on_image(rm, imp):
-    """shows all ROIs in the ROiManager on imp
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    imp : ImagePlus
-        the imp on which to show the ROIs
-    """
-    imp.show()
-    rm.runCommand(imp,"Show All")
-
-
-def save_all_rois(rm, target):
-    """save all ROIs in the RoiManager as zip to target path
+#@ File (label="dataset thresholds (optional)", description="the dataset_thresholds.json of 2_dataset_thresholds.py, replaces the automatic threshold of each image", style="file", required=false) dataset_thresholds_file
+#@ Boolean (label="re-threshold from the fiber statistics of a previous run", description="classify the fibers from the _fiber_stats.json next to the ROI-zip without opening the image", value=False) rethreshold_only
+#@ Boolean (label="also save ROI-zips", description="all ROIs and their classes are saved in one .roistore, tick this for RoiManager compatible zips, e.g. for manual curation", value=True) save_roi_zips
+#@ Integer (label="overview PNG maximum size [px] (0=full resolution)", description="the overview PNG is downsampled so that its longer side is at most this size", value=4096) overview_max_size
+#@ Boolean (label="save a zoomable full resolution overview", description="a Deep Zoom pyramid of PNG tiles next to the overview PNG, e.g. for OpenSeadragon", value=False) overview_pyramid
 
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    target : string
-        the path in to store the ROIs. e.g. /my-images/resulting_rois.zip
-    """
-    rm.runCommand("Save", target)
 
+# there is no window to show the ROI Manager in when running headless
+headless = GraphicsEnvironment.isHeadless()
+rm = RoiManager(True) if headless else RoiManager.getRoiManager()
+rt = ResultsTable.getResultsTable()
 
-def save_selected_rois( rm, selected_rois, target ):
-    """save selected ROIs in the RoiManager as zip to target path
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    selected_rois : array
-        ROIs in the RoiManager to save
-    target : string
-        the path in to store the ROIs. e.g. /my-images/resulting_rois_subset.zip
-    """
-    rm.runCommand("Deselect")
-    rm.setSelectedIndexes(selected_rois)
-    rm.runCommand("save selected", target)
-    rm.runCommand("Deselect")
-
-
-def select_positive_fibers( imp, channel, rm, min_intensity ):
-    """For all ROIs in the RoiManager, select ROIs based on intensity measurement in given channel of imp.
-    See https://imagej.nih.gov/ij/developer/api/ij/process/ImageStatistics.html
-
-    Parameters
-    ----------
-    imp : ImagePlus
-        the imp on which to measure
-    channel : integer
-        the channel on which to measure. starts at 1
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    min_intensity : integer
-        the selection criterion (here: intensity threshold)
-    
-    Returns
-    -------
-    array
-        a selection of ROIs which passed the selection criterion (are above the threshold)
-    """
-    imp.setC(channel)
-    all_rois = rm.getRoisAsArray()
-    selected_rois = []
-    for i, roi in enumerate(all_rois):
-        imp.setRoi(roi)
-        stats = imp.getStatistics()
-        if stats.mean > min_intensity:
-            selected_rois.append(i)
-
-    return selected_rois 
-
-
-def open_rois_from_zip( rm, path ):
-    """open RoiManager ROIs from zip and adds them to the RoiManager
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    path : string
-        path to the ROI zip file
-    """
-    rm.runCommand("Open", path)
-
-
-def preset_results_column( rt, column, value):
-    """pre-set all rows in given column of the IJ-ResultsTable with desired value
-
-    Parameters
-    ----------
-    rt : ResultsTable
-        a reference of the IJ-ResultsTable
-    column : string
-        the desired column. will be created if it does not yet exist
-    value : string or float or integer
-        the value to be set
-    """
-    for i in range( rt.size() ):
-        rt.setValue(column, i, value)
-
-    rt.show("Results")
-
-
-def add_results( rt, column, row, value ):
-    """adds a value in desired rows of a given column
-
-    Parameters
-    ----------
-    rt : ResultsTable
-        a reference of the IJ-ResultsTable
-    column : string
-        the column in which to add the values
-    row : array
-        the row numbers in which too add the values.
-    value : string or float or integer
-        the value to be set
-    """
-    for i in range( len( row ) ):
-        rt.setValue(column, row[i], value)
-
-    rt.show("Results")
-
-
-def enhance_contrast( imp ):
-    """use "Auto" Contrast & Brightness settings in each channel of imp
-
-    Parameters
-    ----------
-    imp : ImagePlus
-        the imp on which to change C&B
-    """
-    for channel in range( imp.getDimensions()[2] ):
-        imp.setC(channel + 1) # IJ channels start at 1
-        IJ.run(imp, "Enhance Contrast", "saturated=0.35")
-
-
-def renumber_rois(rm):
-    """rename all ROIs in the RoiManager according to their number
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    """
-    number_of_rois = rm.getCount()
-    for roi in range( number_of_rois ):
-        rm.rename( roi, str(roi + 1) )
-
-
-def setup_defined_ij(rm, rt):
-    """set up a clean and defined Fiji user environment
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    rt : ResultsTable
-        a reference of the IJ-ResultsTable
-    """
-    fix_ij_options()
-    rm.runCommand('reset')
-    rt.reset()
-    IJ.log("\\Clear")
-
-
-execution_start_time = time.time()
 setup_defined_ij(rm, rt)
 
-# open image using Bio-Formats
 path_to_image = fix_ij_dirs(path_to_image)
-raw = open_image_with_BF(path_to_image)
-
-# get image info
-raw_image_calibration = raw.getCalibration()
-raw_image_title = fix_BF_czi_imagetitle(raw)
 
 # take care of paths and directories
 input_rois_path = fix_ij_dirs( roi_zip )
+histogram_cache_dir = fix_ij_dirs(output_dir) + "/histogram_cache"
 output_dir = fix_ij_dirs(output_dir) + "/2c_fibertyping"
 
 if not os.path.exists( str(output_dir) ):
     os.makedirs( str(output_dir) )
 
-# open ROIS and show on image
-open_rois_from_zip( rm, str(input_rois_path) )
-change_all_roi_color(rm, "blue")
-show_all_rois_on_image( rm, raw )
-
-# update the log for the user
-IJ.log( "Now working on " + str(raw_image_title) )
-if raw_image_calibration.scaled() == False:
-    IJ.log("Your image is not spatially calibrated! Size measurements are only possible in [px].")
-IJ.log( " -- settings used -- ")
-IJ.log( "Selected fiber-ROIs zip-file = " + str(input_rois_path) )
-IJ.log( "Fiber staining 1 channel number = " + str(fiber_channel_1) )
-IJ.log( "Fiber staining 2 channel number = " + str(fiber_channel_2) )
-IJ.log( "Fiber staining 3 channel number = " + str(fiber_channel_3) )
-IJ.log( " -- settings used -- ")
-
-# measure size & shape,
-IJ.run("Set Measurements...", "area perimeter shape feret's redirect=None decimal=4")
-IJ.run("Clear Results", "")
-measure_in_all_rois( raw, fiber_channel_1, rm )
-
-# loop through the fiber channels, check if positive, add info to results table
-all_fiber_channels = [fiber_channel_1, fiber_channel_2, fiber_channel_3]
-all_min_fiber_intensities = [min_fiber_intensity_1, min_fiber_intensity_2, min_fiber_intensity_3]
-roi_colors = ["green", "orange", "red"]
-all_fiber_subsets =[ [], [], [] ]
-
-for index, fiber_channel in enumerate(all_fiber_channels):
-    if fiber_channel > 0:
-        preset_results_column( rt, "channel " + str(fiber_channel) + " positive (" + roi_colors[fiber_channel-1] + ")", "NO" )
-        if all_min_fiber_intensities[index] == 0:
-            all_min_fiber_intensities[index] = get_threshold_from_method(raw, fiber_channel, "Mean")[0]
-        IJ.log( "fiber channel " + str(fiber_channel) + " intensity threshold: " + str(all_min_fiber_intensities[index]) ) 
-        positive_fibers = select_positive_fibers( raw, fiber_channel, rm, all_min_fiber_intensities[index] )
-        all_fiber_subsets[index] = positive_fibers
-        if len(positive_fibers) > 0:
-            change_subset_roi_color(rm, positive_fibers, roi_colors[index])
-            save_selected_rois( rm, positive_fibers, output_dir + "/" + raw_image_title + "_positive_fiber_rois_c" + str( fiber_channel ) + ".zip")
-            add_results( rt, "channel " + str(fiber_channel) + " positive (" + roi_colors[fiber_channel-1] + ")", positive_fibers, "YES")
-
-# single positive
-positive_c1 = all_fiber_subsets[0]
-positive_c2 = all_fiber_subsets[1]
-positive_c3 = all_fiber_subsets[2]
-# double positive
-positive_c1_c2 = list( set(all_fiber_subsets[0]).intersection(all_fiber_subsets[1]) )
-positive_c1_c3 = list( set(all_fiber_subsets[0]).intersection(all_fiber_subsets[2]) )
-positive_c2_c3 = list( set(all_fiber_subsets[1]).intersection(all_fiber_subsets[2]) )
-# triple positive
-positive_c1_c2_c3 = list( set(positive_c1_c2).intersection(all_fiber_subsets[2]) )
-
-# update ROI color & results table for double and triple positives
-if len(positive_c1_c2) > 0:
-    preset_results_column( rt, "channel 1,2 positive (magenta)", "NO" )
-    change_subset_roi_color(rm, positive_c1_c2, "magenta")
-    save_selected_rois( rm, positive_c1_c2, output_dir + "/" + raw_image_title + "_positive_fiber_rois_c1_c2.zip")
-    add_results( rt, "channel 1,2 positive (magenta)", positive_c1_c2, "YES")
-
-if len(positive_c1_c3) > 0:
-    preset_results_column( rt, "channel 1,3 positive (yellow)", "NO" )
-    change_subset_roi_color(rm, positive_c1_c3, "yellow")
-    save_selected_rois( rm, positive_c1_c3, output_dir + "/" + raw_image_title + "_positive_fiber_rois_c1_c3.zip")
-    add_results( rt, "channel 1,3 positive (yellow)", positive_c1_c3, "YES")
-
-if len(positive_c2_c3) > 0:
-    preset_results_column( rt, "channel 2,3 positive (cyan)", "NO" )
-    change_subset_roi_color(rm, positive_c2_c3, "cyan")
-    save_selected_rois( rm, positive_c2_c3, output_dir + "/" + raw_image_title + "_positive_fiber_rois_c2_c3.zip")
-    add_results( rt, "channel 2,3 positive (cyan)", positive_c2_c3, "YES")
-
-if len(positive_c1_c2_c3) > 0:
-    preset_results_column( rt, "channel 1,2,3 positive (white)", "NO" )
-    change_subset_roi_color(rm, positive_c1_c2_c3, "white")
-    save_selected_rois( rm, positive_c1_c2_c3, output_dir + "/" + raw_image_title + "_positive_fiber_rois_c1_c2_c3.zip")
-    add_results( rt, "channel 1,2,3 positive (white)", positive_c1_c2_c3, "YES")
-
-# save all results together
-save_all_rois( rm, output_dir + "/" + raw_image_title + "_all_fiber_type_rois_color-coded.zip" )
-rt.save(output_dir + "/" + raw_image_title + "_fibertyping_results.csv")
-
-# dress up the original image, save a overlay-png, present original to the user
-raw.show()
-show_all_rois_on_image( rm, raw )
-raw.setDisplayMode(IJ.COMPOSITE)
-enhance_contrast( raw )
-IJ.run("From ROI Manager", "") # ROIs -> overlays so they show up in the saved png
-qc_duplicate = raw.duplicate()
-IJ.saveAs(qc_duplicate, "PNG", output_dir + "/" + raw_image_title + "_fibertyping")
-qc_duplicate.close()
-wm.toFront( raw.getWindow() )
-IJ.run("Remove Overlay", "")
-raw.setDisplayMode(IJ.GRAYSCALE)
-show_all_rois_on_image( rm, raw )
-total_execution_time_min = (time.time() - execution_start_time) / 60.0
-IJ.log("total time in minutes: " + str(total_execution_time_min))
-IJ.log( "~~ all done ~~" )
-IJ.selectWindow("Log")
-IJ.saveAs("Text", str(output_dir + "/" + raw_image_title + "_fibertyping_Log"))
-if close_raw == True:
-    raw.close()
\ No newline at end of file
+# all series of the file are read through one reader session
+reader = open_image_reader(path_to_image)
+series_count = reader.getSeriesCount()
+series_titles = [ get_image_title_from_path(path_to_image, series if series_count > 1 else None) for series in range(series_count) ]
+if get_series_roi_zip(input_rois_path, series_titles, 0) is None:
+    raise ValueError(path_to_image + " has " + str(series_count) + " series, but " + input_rois_path + " belongs to none of them")
+image_hash = get_image_key(path_to_image)
+image_signature = get_file_signature(path_to_image)
+# one threshold per channel for the whole dataset replaces the automatic threshold of each image
+dataset_thresholds = None
+if dataset_thresholds_file is not None and os.path.isfile( str(dataset_thresholds_file) ):
+    dataset_thresholds_path = fix_ij_dirs(dataset_thresholds_file)
+    dataset_thresholds = read_dataset_thresholds( dataset_thresholds_path, [ channel for channel, min_intensity in
+        zip( [fiber_channel_1, fiber_channel_2, fiber_channel_3], [min_fiber_intensity_1, min_fiber_intensity_2, min_fiber_intensity_3] )
+        if channel > 0 and min_intensity == 0 ] )
+    dataset_thresholds_hash = get_file_hash(dataset_thresholds_path)
+# only the fiber staining channels are needed
+loaded_channels = sorted( set( [channel for channel in [fiber_channel_1, fiber_channel_2, fiber_channel_3] if channel > 0] ) ) or [1]
+
+for series in range(series_count):
+    execution_start_time = time.time()
+    raw_image_title = series_titles[series]
+    series_rois_path = get_series_roi_zip(input_rois_path, series_titles, series)
+    if not os.path.isfile(series_rois_path):
+        log( "Skipping " + str(raw_image_title) + ": no ROI-zip found at " + series_rois_path )
+        continue
+    rois_hash = get_file_hash(series_rois_path)
+
+    # the fiber statistics of a previous run replace the image when only re-thresholding
+    fiber_stats_path = get_fiber_stats_cache_path(series_rois_path)
+    fiber_stats_cache = None
+    if rethreshold_only:
+        fiber_stats_cache = read_fiber_stats_cache(fiber_stats_path, rois_hash, image_signature, series, loaded_channels)
+        if fiber_stats_cache is None:
+            log( "No valid fiber statistics for " + str(raw_image_title) + " at " + fiber_stats_path + ", measuring the image" )
+
+    # skip the series if a previous run with the same inputs and parameters is complete
+    journal_path = output_dir + "/" + raw_image_title + "_journal.json"
+    if fiber_stats_cache is None:
+        input_hashes = { path_to_image: image_hash, series_rois_path: rois_hash }
+    else:
+        input_hashes = { fiber_stats_path: get_file_hash(fiber_stats_path), series_rois_path: rois_hash }
+    if dataset_thresholds is not None:
+        input_hashes[dataset_thresholds_path] = dataset_thresholds_hash
+    run_parameters = dict( [(name, str(value)) for name, value in [
+        ("fiber_channel_1", fiber_channel_1), ("fiber_channel_2", fiber_channel_2), ("fiber_channel_3", fiber_channel_3),
+        ("min_fiber_intensity_1", min_fiber_intensity_1), ("min_fiber_intensity_2", min_fiber_intensity_2), ("min_fiber_intensity_3", min_fiber_intensity_3),
+        ("save_roi_zips", save_roi_zips), ("overview_max_size", overview_max_size), ("overview_pyramid", overview_pyramid), ("series", series)]] )
+
+    if is_journal_complete(journal_path, input_hashes, run_parameters):
+        log( "Skipping " + str(raw_image_title) + ": already processed with the same inputs and parameters" )
+        continue
+
+    setup_defined_ij(rm, rt)
+    # wall time, CPU time and memory of every stage go to a _timings.json next to the outputs
+    stage_timer = start_stage_timer("Bio-Formats open", rm)
+    artifacts = []
+    raw = None
+    if fiber_stats_cache is None:
+        reader.setSeries(series)
+        raw = open_series_from_reader(reader, raw_image_title, loaded_channels)
+
+    # open ROIS and show on image
+    time_stage(stage_timer, "ROI open")
+    open_rois_from_file( rm, str(series_rois_path) )
+    change_all_roi_color(rm, "blue")
+    if not headless and raw is not None and series == series_count - 1:
+        show_all_rois_on_image( rm, raw )
+
+    # update the log for the user
+    log( "Now working on " + str(raw_image_title) )
+    if raw is not None and raw.getCalibration().scaled() == False:
+        log("Your image is not spatially calibrated! Size measurements are only possible in [px].")
+    log( " -- settings used -- ")
+    log( "Selected fiber-ROIs zip-file = " + str(series_rois_path) )
+    log( "Fiber staining 1 channel number = " + str(fiber_channel_1) )
+    log( "Fiber staining 2 channel number = " + str(fiber_channel_2) )
+    log( "Fiber staining 3 channel number = " + str(fiber_channel_3) )
+    log( "re-threshold from fiber statistics = " + str(fiber_stats_cache is not None) )
+    log( "dataset thresholds = " + (dataset_thresholds_path if dataset_thresholds is not None else "none") )
+    log( " -- settings used -- ")
+
+    # measure all fiber channels in all fiber ROIs and size & shape, cache them next to the ROI-zip
+    time_stage(stage_timer, "measurement")
+    if fiber_stats_cache is None:
+        channel_processors = [ raw.getStack().getProcessor( raw.getStackIndex(position, 1, 1) ) for position in range(1, len(loaded_channels) + 1) ]
+        fiber_stats = measure_rois( rm.getRoisAsArray(), channel_processors, Runtime.getRuntime().availableProcessors(),
+            FIBER_HISTOGRAM_BINS )
+        IJ.run("Set Measurements...", "area perimeter shape feret's redirect=None decimal=4")
+        IJ.run("Clear Results", "")
+        measure_in_all_rois( raw, 1, rm ) # only size & shape are measured
+        channel_entries = {}
+        for position, channel in enumerate(loaded_channels):
+            channel_histogram = get_cached_channel_histogram( histogram_cache_dir, image_hash, series, channel,
+                reader, HISTOGRAM_TILE_SIZE )
+            auto_threshold = get_threshold_from_histogram(channel_histogram, "Mean")
+            channel_entries[channel] = get_fiber_stats_cache_entry(fiber_stats[position], auto_threshold, FIBER_HISTOGRAM_BINS)
+        fiber_stats_cache = write_fiber_stats_cache( fiber_stats_path, rois_hash, image_signature, series, get_results_columns(rt), channel_entries )
+        artifacts.append(fiber_stats_path)
+    else:
+        set_results_columns( rt, fiber_stats_cache["shape"] )
+
+    # loop through the fiber channels, check if positive, add info to results table
+    time_stage(stage_timer, "positivity")
+    all_fiber_channels = [fiber_channel_1, fiber_channel_2, fiber_channel_3]
+    all_min_fiber_intensities = [min_fiber_intensity_1, min_fiber_intensity_2, min_fiber_intensity_3]
+    roi_colors = ["green", "orange", "red"]
+    all_fiber_subsets =[ [], [], [] ]
+    # the results are collected column by column and written to the ResultsTable once
+    fiber_count = rm.getCount()
+    results_columns = get_results_columns(rt)
+
+    for index, fiber_channel in enumerate(all_fiber_channels):
+        if fiber_channel > 0:
+            channel_stats = fiber_stats_cache["channels"][str(fiber_channel)]
+            if all_min_fiber_intensities[index] == 0 and dataset_thresholds is not None:
+                all_min_fiber_intensities[index] = dataset_thresholds[fiber_channel]
+            elif all_min_fiber_intensities[index] == 0:
+                all_min_fiber_intensities[index] = channel_stats["auto_threshold"]
+            log( "fiber channel " + str(fiber_channel) + " intensity threshold: " + str(all_min_fiber_intensities[index]) ) 
+            positive_fibers = [ fiber for fiber, mean in enumerate(channel_stats["mean"]) if mean > all_min_fiber_intensities[index] ]
+            all_fiber_subsets[index] = positive_fibers
+            add_yes_no_column( results_columns, "channel " + str(fiber_channel) + " positive (" + roi_colors[fiber_channel-1] + ")", fiber_count, positive_fibers )
+            if len(positive_fibers) > 0:
+                change_subset_roi_color(rm, positive_fibers, roi_colors[index])
+                if save_roi_zips:
+                    save_selected_rois( rm, positive_fibers, output_dir + "/" + raw_image_title + "_positive_fiber_rois_c" + str( fiber_channel ) + ".zip")
+                    artifacts.append( output_dir + "/" + raw_image_title + "_positive_fiber_rois_c" + str( fiber_channel ) + ".zip" )
+
+    # single positive
+    positive_c1 = all_fiber_subsets[0]
+    positive_c2 = all_fiber_subsets[1]
+    positive_c3 = all_fiber_subsets[2]
+    # double positive
+    positive_c1_c2 = list( set(all_fiber_subsets[0]).intersection(all_fiber_subsets[1]) )
+    positive_c1_c3 = list( set(all_fiber_subsets[0]).intersection(all_fiber_subsets[2]) )
+    positive_c2_c3 = list( set(all_fiber_subsets[1]).intersection(all_fiber_subsets[2]) )
+    # triple positive
+    positive_c1_c2_c3 = list( set(positive_c1_c2).intersection(all_fiber_subsets[2]) )
+
+    # update ROI color & results table for double and triple positives
+    if len(positive_c1_c2) > 0:
+        change_subset_roi_color(rm, positive_c1_c2, "magenta")
+        if save_roi_zips:
+            save_selected_rois( rm, positive_c1_c2, output_dir + "/" + raw_image_title + "_positive_fiber_rois_c1_c2.zip")
+            artifacts.append( output_dir + "/" + raw_image_title + "_positive_fiber_rois_c1_c2.zip" )
+        add_yes_no_column( results_columns, "channel 1,2 positive (magenta)", fiber_count, positive_c1_c2 )
+
+    if len(positive_c1_c3) > 0:
+        change_subset_roi_color(rm, positive_c1_c3, "yellow")
+        if save_roi_zips:
+            save_selected_rois( rm, positive_c1_c3, output_dir + "/" + raw_image_title + "_positive_fiber_rois_c1_c3.zip")
+            artifacts.append( output_dir + "/" + raw_image_title + "_positive_fiber_rois_c1_c3.zip" )
+        add_yes_no_column( results_columns, "channel 1,3 positive (yellow)", fiber_count, positive_c1_c3 )
+
+    if len(positive_c2_c3) > 0:
+        change_subset_roi_color(rm, positive_c2_c3, "cyan")
+        if save_roi_zips:
+            save_selected_rois( rm, positive_c2_c3, output_dir + "/" + raw_image_title + "_positive_fiber_rois_c2_c3.zip")
+            artifacts.append( output_dir + "/" + raw_image_title + "_positive_fiber_rois_c2_c3.zip" )
+        add_yes_no_column( results_columns, "channel 2,3 positive (cyan)", fiber_count, positive_c2_c3 )
+
+    if len(positive_c1_c2_c3) > 0:
+        change_subset_roi_color(rm, positive_c1_c2_c3, "white")
+        if save_roi_zips:
+            save_selected_rois( rm, positive_c1_c2_c3, output_dir + "/" + raw_image_title + "_positive_fiber_rois_c1_c2_c3.zip")
+            artifacts.append( output_dir + "/" + raw_image_title + "_positive_fiber_rois_c1_c2_c3.zip" )
+        add_yes_no_column( results_columns, "channel 1,2,3 positive (white)", fiber_count, positive_c1_c2_c3 )
+
+    # save all results together, the fiber types are columns of one ROI store
+    time_stage(stage_timer, "ROI writes")
+    fiber_type_columns = {}
+    for index, fiber_channel in enumerate(all_fiber_channels):
+        if fiber_channel > 0:
+            fiber_type_columns["channel " + str(fiber_channel) + " positive"] = get_flag_column( fiber_count, all_fiber_subsets[index] )
+    for column_name, fibers in [ ("channel 1,2 positive", positive_c1_c2), ("channel 1,3 positive", positive_c1_c3),
+            ("channel 2,3 positive", positive_c2_c3), ("channel 1,2,3 positive", positive_c1_c2_c3) ]:
+        if len(fibers) > 0:
+            fiber_type_columns[column_name] = get_flag_column(fiber_count, fibers)
+    write_roi_store( rm.getRoisAsArray(), fiber_type_columns, output_dir + "/" + raw_image_title + "_fibertyping.roistore" )
+    artifacts.append( output_dir + "/" + raw_image_title + "_fibertyping.roistore" )
+    if save_roi_zips:
+        save_all_rois( rm, output_dir + "/" + raw_image_title + "_all_fiber_type_rois_color-coded.zip" )
+        artifacts.append( output_dir + "/" + raw_image_title + "_all_fiber_type_rois_color-coded.zip" )
+    time_stage(stage_timer, "CSV writes")
+    write_results( rt, results_columns, output_dir + "/" + raw_image_title + "_fibertyping_results.csv" )
+    artifacts.append( output_dir + "/" + raw_image_title + "_fibertyping_results.csv" )
+
+    # save a overlay-png, present original to the user
+    time_stage(stage_timer, "PNG writes")
+    if raw is not None:
+        artifacts.extend( save_overview_png( raw, rm, output_dir + "/" + raw_image_title + "_fibertyping", overview_max_size, overview_pyramid ) )
+        if not headless and series == series_count - 1:
+            rm.show()
+            enhance_contrast( raw )
+            show_all_rois_on_image( rm, raw )
+    else:
+        log( "re-thresholded without the image, the overview png is not updated" )
+    total_execution_time_min = (time.time() - execution_start_time) / 60.0
+    log("total time in minutes: " + str(total_execution_time_min))
+    log( "~~ all done ~~" )
+    artifacts.append( save_log( str(output_dir + "/" + raw_image_title + "_fibertyping_Log") ) )
+    artifacts.append( write_stage_timings( stage_timer, output_dir + "/" + raw_image_title + "_timings.json",
+        "2c_fibertyping", raw_image_title, series ) )
+    write_journal(journal_path, input_hashes, run_parameters, artifacts)
+    # only the image of the last series stays open, the others are released before the next series is read
+    if raw is not None and (close_raw == True or series < series_count - 1):
+        raw.close()
+        raw.flush()
+
+reader.close()
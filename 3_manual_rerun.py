@@ -1,73 +1,23 @@
-from ij import IJ, WindowManager as wm
+from ij import IJ
 from ij.gui import WaitForUserDialog
+from ij.measure import ResultsTable
+from ij.plugin.frame import RoiManager
+from loci.plugins import BF
+from java.awt import GraphicsEnvironment
 import os
 
-#@ ImagePlus raw
-#@ RoiManager rm
-#@ ResultsTable rt
+# shared helpers, see jars/Lib/myosoft_common.py
+from myosoft_common import (fix_ij_dirs, fix_BF_czi_imagetitle, measure_in_all_rois,
+                            show_all_rois_on_image, save_all_rois, get_results_columns,
+                            add_results_column, write_results, enhance_contrast, renumber_rois,
+                            save_overview_png, open_rois_from_file)
+
 #@ File (label="Select directory for output", style="directory") output_dir
+#@ File (label="Select image file (headless only)", description="only used when running headless, otherwise the current image is measured", required=false) path_to_image
+#@ File (label="Select fiber-ROIs zip-file or ROI store (headless only)", description="only used when running headless, otherwise the ROIs in the ROI Manager are measured", style="file", required=false) roi_zip
 #@ Integer (label="Measure in this channel", style="slider", min=1, max=5, value=1) measurement_channel
-
-
-def fix_ij_dirs(path):
-    """use forward slashes in directory paths
-
-    Parameters
-    ----------
-    path : string
-        a directory path obtained from dialogue or script parameter
-
-    Returns
-    -------
-    string
-        a more robust path with forward slashes as 
-    """
-
-    fixed_path = str(path).replace("\\", "/")
-    # fixed_path = fixed_path + "/"
-
-    return fixed_path
-
-
-def fix_BF_czi_imagetitle(imp):
-    image_title = os.path.basename( imp.getShortTitle() )
-    image_title = image_title.replace(".czi", "")
-    image_title = image_title.replace(" ", "_")
-    image_title = image_title.replace("_-_", "")
-    image_title = image_title.replace("__", "_")
-    image_title = image_title.replace("#", "Series")
-
-    return image_title
-
-
-def renumber_rois(rm):
-    """rename all ROIs in the RoiManager according to their number
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    """
-    number_of_rois = rm.getCount()
-    for roi in range( number_of_rois ):
-        rm.rename( roi, str(roi + 1) )
-
-
-def measure_in_all_rois( imp, channel, rm ):
-    """measures in all ROIS on a given channel of imp all parameters that are set in IJ "Set Measurements"
-
-    Parameters
-    ----------
-    imp : ImagePlus
-        the imp to measure on
-    channel : integer
-        the channel to measure in. starts at 1.
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    """
-    imp.setC(channel)
-    rm.runCommand(imp,"Deselect")
-    rm.runCommand(imp,"Measure")
+#@ Integer (label="overview PNG maximum size [px] (0=full resolution)", description="the overview PNG is downsampled so that its longer side is at most this size", value=4096) overview_max_size
+#@ Boolean (label="save a zoomable full resolution overview", description="a Deep Zoom pyramid of PNG tiles next to the overview PNG, e.g. for OpenSeadragon", value=False) overview_pyramid
 
 
 def extract_color_of_all_rois(rm):
@@ -106,63 +56,16 @@ def extract_color_of_all_rois(rm):
     return roi_colors
 
 
-def save_all_rois(rm, target):
-    """save all ROIs in the RoiManager as zip to target path
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    target : string
-        the path in to store the ROIs. e.g. /my-images/resulting_rois.zip
-    """
-    rm.runCommand("Save", target)
-
-
-def add_results_to_resultstable( rt, column, values ):
-    """add values to the ResultsTable starting from row 0 of a given column
-
-    Parameters
-    ----------
-    rt : ResultsTable
-        a reference of the IJ-ResultsTable
-    column : string
-        the column in which to add the values
-    values : array
-        tarray with values to be added
-    """
-    for i in range( len( values ) ):
-        rt.setValue(column, i, values[i])
-
-    rt.show("Results")
-
-
-def enhance_contrast( imp ):
-    """use "Auto" Contrast & Brightness settings in each channel of imp
-
-    Parameters
-    ----------
-    imp : ImagePlus
-        the imp on which to change C&B
-    """
-    for channel in range( imp.getDimensions()[2] ):
-        imp.setC(channel + 1) # IJ channels start at 1
-        IJ.run(imp, "Enhance Contrast", "saturated=0.35")
-
-
-def show_all_rois_on_image(rm, imp):
-    """shows all ROIs in the ROiManager on imp
-
-    Parameters
-    ----------
-    rm : RoiManager
-        a reference of the IJ-RoiManager
-    imp : ImagePlus
-        the imp on which to show the ROIs
-    """
-    imp.show()
-    rm.runCommand(imp,"Show All")
-
+# there is no current image, ROI Manager or dialog when running headless
+headless = GraphicsEnvironment.isHeadless()
+rt = ResultsTable.getResultsTable()
+if headless:
+    raw = BF.openImagePlus( fix_ij_dirs(path_to_image) )[0]
+    rm = RoiManager(True)
+    open_rois_from_file( rm, fix_ij_dirs(roi_zip) )
+else:
+    raw = IJ.getImage()
+    rm = RoiManager.getRoiManager()
 
 output_dir = fix_ij_dirs(output_dir) + "/3_manual_rerun"
 if not os.path.exists( str(output_dir) ):
@@ -173,21 +76,15 @@ raw_image_title = fix_BF_czi_imagetitle(raw)
 renumber_rois(rm)
 save_all_rois( rm, output_dir + "/" + raw_image_title + "_manual_rerun_all_fiber_rois_color-coded.zip" )
 roi_colors = extract_color_of_all_rois(rm)
-WaitForUserDialog("Choose measurements", "Set measurements in Analyze > Set Measurements, then click OK").show()
+if not headless: # else the measurements last set in Analyze > Set Measurements are used
+    WaitForUserDialog("Choose measurements", "Set measurements in Analyze > Set Measurements, then click OK").show()
 measure_in_all_rois(raw, measurement_channel, rm)
-add_results_to_resultstable(rt, "ROI color", roi_colors )
-rt.save(output_dir + "/" + raw_image_title + "_manual_rerun_results.csv")
-
-# dress up the original image, save a overlay-png, present original to the user
-raw.show()
-show_all_rois_on_image( rm, raw )
-raw.setDisplayMode(IJ.COMPOSITE)
-enhance_contrast( raw )
-IJ.run("From ROI Manager", "") # ROIs -> overlays so they show up in the saved png
-qc_duplicate = raw.duplicate()
-IJ.saveAs(qc_duplicate, "PNG", output_dir + "/" + raw_image_title + "_manual_rerun")
-qc_duplicate.close()
-wm.toFront( raw.getWindow() )
-IJ.run("Remove Overlay", "")
-raw.setDisplayMode(IJ.GRAYSCALE)
-show_all_rois_on_image( rm, raw )
\ No newline at end of file
+results_columns = get_results_columns(rt)
+add_results_column( results_columns, "ROI color", roi_colors )
+write_results( rt, results_columns, output_dir + "/" + raw_image_title + "_manual_rerun_results.csv" )
+
+# save a overlay-png, present original to the user
+save_overview_png( raw, rm, output_dir + "/" + raw_image_title + "_manual_rerun", overview_max_size, overview_pyramid )
+if not headless:
+    enhance_contrast( raw )
+    show_all_rois_on_image( rm, raw )
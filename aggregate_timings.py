@@ -0,0 +1,126 @@
+# IJ imports
+from ij import IJ
+from ij.measure import ResultsTable
+
+# python imports
+import os
+import json
+
+# shared helpers, see jars/Lib/myosoft_common.py
+from myosoft_common import fix_ij_dirs
+
+#@ String (visibility=MESSAGE, value="<html><b> Welcome to Myosoft - aggregate timings! </b></html>") msg1
+#@ File (label="Select directory with results", description="e.g. the output directory of batch_runner.py, searched including all subfolders", style="directory") input_dir
+#@ File (label="Select directory for output", style="directory") output_dir
+
+
+def find_timings_files(directory):
+    """find the timing sidecars written by the scripts in a directory and all its subfolders
+
+    Parameters
+    ----------
+    directory : string
+        the directory to search
+
+    Returns
+    -------
+    array
+        the paths of all files ending with _timings.json, sorted
+    """
+    timings_files = []
+    for folder, _, names in os.walk(directory):
+        timings_files.extend( [ fix_ij_dirs( os.path.join(folder, name) ) for name in names if name.endswith("_timings.json") ] )
+
+    return sorted(timings_files)
+
+
+def aggregate_stages(all_timings):
+    """sum up the timings of every stage of every script over all images
+
+    Parameters
+    ----------
+    all_timings : array
+        the content of the timing sidecars
+
+    Returns
+    -------
+    list
+        the totals per (script, stage) as dict, and the order in which the stages first occurred
+    """
+    totals = {}
+    order = []
+    for timings in all_timings:
+        images_with_stage = set()
+        for stage in timings["stages"]:
+            key = ( timings["script"], stage["stage"] )
+            if key not in totals:
+                totals[key] = { "images": 0, "wall_time_s": 0.0, "max_wall_time_s": 0.0, "cpu_time_s": 0.0,
+                    "gc_time_s": 0.0, "heap_peak_mb": 0.0 }
+                order.append(key)
+            total = totals[key]
+            if key not in images_with_stage:
+                images_with_stage.add(key)
+                total["images"] += 1
+            total["wall_time_s"] += stage["wall_time_s"]
+            total["max_wall_time_s"] = max( total["max_wall_time_s"], stage["wall_time_s"] )
+            total["cpu_time_s"] += stage["cpu_time_s"]
+            total["gc_time_s"] += stage["gc_time_s"]
+            total["heap_peak_mb"] = max( total["heap_peak_mb"], stage["heap_peak_mb"] )
+
+    return totals, order
+
+
+IJ.log("\\Clear")
+
+input_dir = fix_ij_dirs(input_dir)
+output_dir = fix_ij_dirs(output_dir)
+timings_files = find_timings_files(input_dir)
+all_timings = []
+for timings_path in timings_files:
+    with open(timings_path) as timings_file:
+        all_timings.append( json.load(timings_file) )
+IJ.log( "Aggregating " + str(len(all_timings)) + " timing files found in " + input_dir )
+
+# one row per image
+image_rt = ResultsTable()
+for timings_path, timings in zip(timings_files, all_timings):
+    slowest_stage = max( timings["stages"], key=lambda stage: stage["wall_time_s"] ) if timings["stages"] else None
+    image_rt.incrementCounter()
+    image_rt.addValue( "script", timings["script"] )
+    image_rt.addValue( "image", timings["image"] )
+    image_rt.addValue( "series", timings["series"] )
+    image_rt.addValue( "wall time [s]", timings["wall_time_s"] )
+    image_rt.addValue( "CPU time [s]", timings["cpu_time_s"] )
+    image_rt.addValue( "heap peak [MB]", max( [stage["heap_peak_mb"] for stage in timings["stages"]] or [0] ) )
+    image_rt.addValue( "heap max [MB]", timings["heap_max_mb"] )
+    image_rt.addValue( "slowest stage", slowest_stage["stage"] if slowest_stage is not None else "" )
+    image_rt.addValue( "slowest stage wall time [s]", slowest_stage["wall_time_s"] if slowest_stage is not None else 0 )
+    image_rt.addValue( "timings file", timings_path )
+image_rt.save( output_dir + "/timings_per_image.csv" )
+
+# one row per stage of each script, in the order the stages run
+totals, order = aggregate_stages(all_timings)
+script_wall_times = {}
+for (script, _), total in totals.items():
+    script_wall_times[script] = script_wall_times.get(script, 0.0) + total["wall_time_s"]
+stage_rt = ResultsTable()
+for script, stage in order:
+    total = totals[(script, stage)]
+    stage_rt.incrementCounter()
+    stage_rt.addValue( "script", script )
+    stage_rt.addValue( "stage", stage )
+    stage_rt.addValue( "images", total["images"] )
+    stage_rt.addValue( "total wall time [h]", total["wall_time_s"] / 3600.0 )
+    stage_rt.addValue( "share of script wall time [%]", 100.0 * total["wall_time_s"] / script_wall_times[script] if script_wall_times[script] > 0 else 0 )
+    stage_rt.addValue( "mean wall time per image [s]", total["wall_time_s"] / total["images"] )
+    stage_rt.addValue( "max wall time [s]", total["max_wall_time_s"] )
+    stage_rt.addValue( "total CPU time [h]", total["cpu_time_s"] / 3600.0 )
+    stage_rt.addValue( "CPU / wall time", total["cpu_time_s"] / total["wall_time_s"] if total["wall_time_s"] > 0 else 0 )
+    stage_rt.addValue( "total GC time [s]", total["gc_time_s"] )
+    stage_rt.addValue( "heap peak [MB]", total["heap_peak_mb"] )
+stage_rt.save( output_dir + "/timings_per_stage.csv" )
+
+# where the time goes, longest stages first
+for script, stage in sorted( order, key=lambda key: -totals[key]["wall_time_s"] )[:10]:
+    IJ.log( script + " / " + stage + ": " + str( round(totals[(script, stage)]["wall_time_s"] / 3600.0, 2) ) + " h" )
+IJ.log( "~~ all done ~~" )
@@ -0,0 +1,308 @@
+# IJ imports
+from ij.measure import ResultsTable
+
+# Java imports
+from java.io import File, IOException
+from java.lang import ProcessBuilder, Runtime, System
+from java.lang.management import ManagementFactory
+
+# python imports
+import time
+import os
+import threading
+import Queue
+import re
+
+# shared helpers, see jars/Lib/myosoft_common.py
+from myosoft_common import fix_ij_dirs, get_image_title_from_path, list_images, log, save_log
+
+#@ String (visibility=MESSAGE, value="<html><b> Welcome to Myosoft - batch runner! </b></html>") msg1
+#@ File (label="Select script to run on every image", style="file", description="e.g. 1_identify_fibers.py") script_file
+#@ File (label="Select directory with images", style="directory") input_dir
+#@ String (label="File extension of the images", value=".czi") file_extension
+#@ File (label="Select manifest instead (optional)", description="a text file with one image path per line, replaces the image directory", style="file", required=false) manifest_file
+#@ File (label="Select directory for output", style="directory") output_dir
+#@ String (label="Further script parameters", description="in macro syntax, e.g. classifiers_dir='/path/to/classifiers',membrane_channel=1", value="") script_parameters
+#@ String (visibility=MESSAGE, value="<html><b> Workers </b></html>") msg2
+#@ File (label="Select Fiji executable (optional)", description="defaults to the executable of this Fiji", style="file", required=false) fiji_executable
+#@ Integer (label="Number of parallel workers (0=auto)", value=0) worker_count
+#@ Integer (label="Memory per worker [MB] (0=auto)", value=0) worker_memory_mb
+#@ Integer (label="Minimum memory per worker for auto sizing [MB]", value=8192) min_worker_memory_mb
+
+
+def get_fiji_executable(fiji_executable):
+    """find the Fiji launcher to start the workers with
+
+    Parameters
+    ----------
+    fiji_executable : File
+        the executable chosen by the user or None to use the one of the running Fiji
+
+    Returns
+    -------
+    string
+        path to the Fiji launcher
+    """
+    if fiji_executable is not None:
+        return fix_ij_dirs(fiji_executable)
+
+    for system_property in ["ij.executable", "fiji.executable"]:
+        if System.getProperty(system_property):
+            return fix_ij_dirs( System.getProperty(system_property) )
+
+    raise ValueError("could not find the Fiji executable, please select it")
+
+
+def get_script_parameter_names(script):
+    """read the names of the input parameters a script declares in its #@ lines
+
+    Parameters
+    ----------
+    script : string
+        path to the script
+
+    Returns
+    -------
+    set
+        the parameter names, e.g. "path_to_image" for "#@ File (label="Select image file") path_to_image"
+    """
+    names = set()
+    with open(script) as script_source:
+        for line in script_source:
+            declaration = line.strip()
+            # "#@output" declares what the script returns, not a parameter
+            if not declaration.startswith("#@") or declaration.startswith("#@output"):
+                continue
+            name = declaration[2:].split()[-1] if declaration[2:].split() else ""
+            if re.match(r"^[A-Za-z_]\w*$", name):
+                names.add(name)
+
+    return names
+
+
+def find_fiber_rois(output_dir, image_path):
+    """find the ROIs script 1) saved for an image in an output directory, as input for scripts 2a) to 3)
+
+    Parameters
+    ----------
+    output_dir : string
+        the output directory script 1) was run with
+    image_path : string
+        path to the image file
+
+    Returns
+    -------
+    string
+        path to the ROI store (or the ROI-zip if there is no store) of the image, of its first series for
+        multi-series files. None if script 1) saved no ROIs for the image.
+    """
+    for series in [None, 0]:
+        title = get_image_title_from_path(image_path, series)
+        for extension in [".roistore", ".zip"]:
+            rois_path = output_dir + "/" + title + "/1_identify_fibers/" + title + "_all_fiber_rois" + extension
+            if os.path.isfile(rois_path):
+                return rois_path
+
+    return None
+
+
+def get_worker_layout(worker_count, worker_memory_mb, min_worker_memory_mb):
+    """size the worker pool from the number of cores and the physical memory of this machine
+
+    Parameters
+    ----------
+    worker_count : integer
+        the number of workers. 0 to derive it from cores and memory.
+    worker_memory_mb : integer
+        the heap size of each worker in MB. 0 to split the memory evenly.
+    min_worker_memory_mb : integer
+        the minimum heap size a worker needs when deriving the number of workers
+
+    Returns
+    -------
+    list
+        the number of workers, the heap size per worker in MB and the WEKA threads per worker
+    """
+    cores = Runtime.getRuntime().availableProcessors()
+    # leave some memory for the OS and this Fiji
+    usable_memory_mb = int( ManagementFactory.getOperatingSystemMXBean().getTotalPhysicalMemorySize() * 0.8 / (1024 * 1024) )
+
+    if worker_count <= 0:
+        memory_per_worker = worker_memory_mb if worker_memory_mb > 0 else min_worker_memory_mb
+        # WEKA scales well to a few threads per image, more workers beat more threads per worker
+        worker_count = max( 1, min( cores // 4, usable_memory_mb // memory_per_worker ) )
+    if worker_memory_mb <= 0:
+        worker_memory_mb = usable_memory_mb // worker_count
+    weka_threads = max( 1, cores // worker_count )
+
+    return worker_count, worker_memory_mb, weka_threads
+
+
+def build_worker_command(fiji, script, memory_mb, parameters):
+    """build the command line of a headless Fiji worker running a script
+
+    Parameters
+    ----------
+    fiji : string
+        path to the Fiji launcher
+    script : string
+        path to the script to run
+    memory_mb : integer
+        the heap size of the worker in MB
+    parameters : string
+        the script parameters in macro syntax, e.g. "path_to_image='/my-images/image.czi',membrane_channel=1"
+
+    Returns
+    -------
+    array
+        the command line
+    """
+    return [ fiji, "--mem=" + str(memory_mb) + "m", "--headless", "--console", "--run", script, parameters ]
+
+
+def run_worker(command, log_path):
+    """run a worker process and wait for it to finish
+
+    Parameters
+    ----------
+    command : array
+        the command line as returned by build_worker_command
+    log_path : string
+        the file to write the console output of the worker to
+
+    Returns
+    -------
+    integer
+        the exit code of the worker
+    """
+    process_builder = ProcessBuilder(command)
+    process_builder.redirectErrorStream(True)
+    process_builder.redirectOutput( File(log_path) )
+
+    return process_builder.start().waitFor()
+
+
+def process_image_queue(image_queue, status, status_lock, fiji, script, memory_mb, shared_parameters, log_dir, rois_dir):
+    """let a worker process images from the queue until it is empty
+
+    Parameters
+    ----------
+    image_queue : Queue
+        the paths of the images still to process
+    status : array
+        the list to which the status of each processed image is appended, with an exit code of None for
+        skipped images
+    status_lock : Lock
+        the lock guarding the status list
+    fiji : string
+        path to the Fiji launcher
+    script : string
+        path to the script to run
+    memory_mb : integer
+        the heap size of a worker in MB
+    shared_parameters : string
+        the script parameters used for every image, in macro syntax
+    log_dir : string
+        the directory to store the console output of the workers in
+    rois_dir : string
+        the output directory of script 1) to take the ROIs of each image from, see find_fiber_rois.
+        None for scripts without ROI input.
+    """
+    while True:
+        try:
+            image_path = image_queue.get_nowait()
+        except Queue.Empty:
+            return
+
+        image_name = os.path.basename(image_path)
+        log_path = log_dir + "/" + image_name + ".log"
+        parameters = "path_to_image='" + image_path + "'," + shared_parameters
+        if rois_dir is not None:
+            rois_path = find_fiber_rois(rois_dir, image_path)
+            if rois_path is None:
+                with status_lock:
+                    status.append( (image_path, None, 0.0, "") )
+                    log( "SKIPPED: " + image_name + ", script 1) saved no ROIs for it in " + rois_dir )
+                continue
+            parameters += ",roi_zip='" + rois_path + "'"
+        start_time = time.time()
+        try:
+            exit_code = run_worker( build_worker_command(fiji, script, memory_mb, parameters), log_path )
+        except IOException, error:
+            log( "could not start worker for " + image_name + ": " + str(error) )
+            exit_code = -1
+        duration_min = (time.time() - start_time) / 60.0
+
+        with status_lock:
+            status.append( (image_path, exit_code, duration_min, log_path) )
+            log( ("done: " if exit_code == 0 else "FAILED: ") + image_name + " (" + str(len(status)) + " finished)" )
+
+
+execution_start_time = time.time()
+log("\\Clear")
+
+output_dir = fix_ij_dirs(output_dir)
+script = fix_ij_dirs(script_file)
+manifest = fix_ij_dirs(manifest_file) if manifest_file is not None and os.path.isfile( str(manifest_file) ) else None
+images = list_images( fix_ij_dirs(input_dir), file_extension, manifest )
+fiji = get_fiji_executable(fiji_executable)
+worker_count, worker_memory_mb, weka_threads = get_worker_layout(worker_count, worker_memory_mb, min_worker_memory_mb)
+log_dir = output_dir + "/batch_logs"
+if not os.path.exists( log_dir ):
+    os.makedirs( log_dir )
+
+# parameters for every image, only those the script declares
+parameter_names = get_script_parameter_names(script)
+if "path_to_image" not in parameter_names:
+    raise ValueError( os.path.basename(script) + " does not take an image (path_to_image), it can not be run per image" )
+shared_parameters = ",".join( [ parameter for name, parameter in [ ("output_dir", "output_dir='" + output_dir + "'"),
+    ("close_raw", "close_raw=true"), ("weka_threads", "weka_threads=" + str(weka_threads)) ] if name in parameter_names ] )
+# scripts 2a) to 3) take the ROIs script 1) saved for the same image in the same output directory
+rois_dir = output_dir if "roi_zip" in parameter_names else None
+if script_parameters.strip():
+    shared_parameters += "," + script_parameters.strip()
+
+# update the log for the user
+log( "Batch processing " + str(len(images)) + " images with " + os.path.basename(script) )
+log( " -- settings used -- ")
+log( "Fiji executable = " + fiji )
+log( "parallel workers = " + str(worker_count) )
+log( "memory per worker [MB] = " + str(worker_memory_mb) )
+log( "WEKA threads per worker = " + str(weka_threads) )
+log( "script parameters = " + shared_parameters )
+if rois_dir is not None:
+    log( "ROIs of script 1) from = " + rois_dir )
+log( " -- settings used -- ")
+
+image_queue = Queue.Queue()
+for image_path in images:
+    image_queue.put(image_path)
+
+status = []
+status_lock = threading.Lock()
+workers = [ threading.Thread( target=process_image_queue,
+    args=(image_queue, status, status_lock, fiji, script, worker_memory_mb, shared_parameters, log_dir, rois_dir) )
+    for _ in range(worker_count) ]
+for worker in workers:
+    worker.start()
+for worker in workers:
+    worker.join()
+
+status_rt = ResultsTable()
+for image_path, exit_code, duration_min, log_path in sorted(status):
+    status_rt.incrementCounter()
+    status_rt.addValue("image", image_path)
+    status_rt.addValue("status", "skipped" if exit_code is None else "done" if exit_code == 0 else "failed")
+    status_rt.addValue("exit code", exit_code if exit_code is not None else float("nan"))
+    status_rt.addValue("time in minutes", duration_min)
+    status_rt.addValue("log", log_path)
+status_rt.save(output_dir + "/batch_status.csv")
+
+failed_images = [ image_path for image_path, exit_code, _, _ in status if exit_code is not None and exit_code != 0 ]
+skipped_images = [ image_path for image_path, exit_code, _, _ in status if exit_code is None ]
+total_execution_time_min = (time.time() - execution_start_time) / 60.0
+log( str(len(status) - len(failed_images) - len(skipped_images)) + " images done, " + str(len(failed_images)) + " failed, "
+    + str(len(skipped_images)) + " skipped" )
+log("total time in minutes: " + str(total_execution_time_min))
+log( "~~ all done ~~" )
+save_log( str(output_dir + "/batch_Log") )
@@ -0,0 +1,124 @@
+# IJ imports
+from ij.measure import ResultsTable, Measurements
+from ij.plugin.frame import RoiManager
+
+# Java imports
+from java.awt import GraphicsEnvironment
+from java.lang import Runtime
+
+# python imports
+import time
+import os
+
+# shared helpers, see jars/Lib/myosoft_common.py
+from myosoft_common import (fix_ij_dirs, open_image_reader, open_series_from_reader,
+                            get_image_title_from_path, open_rois_from_file, measure_rois, save_log,
+                            setup_defined_ij, log)
+
+#@ String (visibility=MESSAGE, value="<html><b> Welcome to Myosoft - benchmark the fiber measurement! </b></html>") msg1
+#@ File (label="Select image file", description="select your image") path_to_image
+#@ File (label="Select fiber-ROIs zip-file or ROI store", description="of the first series of the image", style="file") roi_zip
+#@ File (label="Select directory for output", style="directory") output_dir
+#@ Integer (label="Measure in this channel", style="slider", min=1, max=5, value=1) measurement_channel
+#@ Integer (label="repetitions", description="every method and thread count is timed this many times, the fastest run counts", value=3) repetitions
+
+
+def measure_rois_one_by_one(imp, rois):
+    """measure the mean, min and max of every ROI with imp.setRoi and imp.getStatistics, the way the
+    scripts did before measure_rois
+
+    Parameters
+    ----------
+    imp : ImagePlus
+        the image to measure
+    rois : array
+        the ROIs to measure
+
+    Returns
+    -------
+    array
+        the mean of every ROI
+    """
+    means = []
+    for roi in rois:
+        imp.setRoi(roi)
+        means.append( imp.getStatistics(Measurements.MEAN | Measurements.MIN_MAX).mean )
+    imp.killRoi()
+
+    return means
+
+
+def time_fastest(measure, repetitions):
+    """run a measurement several times and keep the fastest run
+
+    Parameters
+    ----------
+    measure : function
+        the measurement, called without arguments
+    repetitions : integer
+        how often to run it
+
+    Returns
+    -------
+    list
+        the wall time of the fastest run in seconds and the result of the last run
+    """
+    fastest = None
+    for repetition in range( max(1, repetitions) ):
+        start = time.time()
+        result = measure()
+        duration = time.time() - start
+        fastest = duration if fastest is None else min(fastest, duration)
+
+    return fastest, result
+
+
+# there is no window to show the ROI Manager in when running headless
+headless = GraphicsEnvironment.isHeadless()
+rm = RoiManager(True) if headless else RoiManager.getRoiManager()
+rt = ResultsTable.getResultsTable()
+setup_defined_ij(rm, rt)
+
+path_to_image = fix_ij_dirs(path_to_image)
+output_dir = fix_ij_dirs(output_dir)
+if not os.path.exists(output_dir):
+    os.makedirs(output_dir)
+
+reader = open_image_reader(path_to_image)
+raw_image_title = get_image_title_from_path(path_to_image, 0 if reader.getSeriesCount() > 1 else None)
+raw = open_series_from_reader(reader, raw_image_title, [measurement_channel])
+reader.close()
+open_rois_from_file( rm, fix_ij_dirs(roi_zip) )
+rois = rm.getRoisAsArray()
+num_threads = Runtime.getRuntime().availableProcessors()
+
+log( "benchmarking the measurement of " + str( len(rois) ) + " ROIs in " + raw_image_title + " ("
+    + str( raw.getWidth() ) + " x " + str( raw.getHeight() ) + " px, " + str( raw.getBitDepth() ) + "-bit)" )
+baseline_time, baseline_means = time_fastest( lambda: measure_rois_one_by_one(raw, rois), repetitions )
+timings = [ ("setRoi and getStatistics per ROI", 1, baseline_time) ]
+# the threads measure without sharing any state, so the time should drop with every doubling of the threads
+thread_counts = sorted( set( [ 2 ** power for power in range(num_threads.bit_length()) ] + [num_threads] ) )
+for threads in thread_counts:
+    new_time, new_stats = time_fastest( lambda: measure_rois( rois, [raw.getProcessor()], threads, 0 )[0], repetitions )
+    timings.append( ("measure_rois", threads, new_time) )
+single_thread_time = timings[1][2]
+
+# both methods must agree before their times are compared
+largest_difference = max( [0] + [ abs(mean - new_stats["Mean"][index]) for index, mean in enumerate(baseline_means) ] )
+log( "largest difference of the means: " + str(largest_difference) )
+
+benchmark_rt = ResultsTable()
+for method, threads, seconds in timings:
+    benchmark_rt.incrementCounter()
+    benchmark_rt.addValue("method", method)
+    benchmark_rt.addValue("threads", threads)
+    benchmark_rt.addValue("ROIs", len(rois))
+    benchmark_rt.addValue("seconds", seconds)
+    benchmark_rt.addValue("speedup", baseline_time / seconds if seconds > 0 else 0)
+    benchmark_rt.addValue("parallel speedup", single_thread_time / seconds if method == "measure_rois" and seconds > 0 else 0)
+    log( method + " with " + str(threads) + " threads: " + str(seconds) + " s" )
+benchmark_rt.saveAs(output_dir + "/" + raw_image_title + "_measurement_benchmark.csv")
+
+log( "~~ all done ~~" )
+save_log(output_dir + "/" + raw_image_title + "_measurement_benchmark_Log")
+raw.close()
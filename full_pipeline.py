@@ -0,0 +1,577 @@
+# IJ imports
+from ij import IJ
+from ij.gui import Overlay
+from ij.plugin import Duplicator
+from ij.measure import ResultsTable
+from ij.plugin.frame import RoiManager
+
+# Java imports
+from java.awt import GraphicsEnvironment
+from java.lang import Runtime
+
+# python imports
+import time
+import os
+
+# shared helpers, see jars/Lib/myosoft_common.py
+from myosoft_common import (FIBER_HISTOGRAM_BINS, HISTOGRAM_TILE_SIZE, fix_ij_dirs,
+                            preprocess_membrane_channel, apply_weka_model, get_file_hash,
+                            get_file_signature, get_image_key, get_probability_map_cache_key,
+                            open_cached_probability_map, save_probability_map_to_cache,
+                            is_journal_complete, write_journal, process_weka_result, delete_channel,
+                            build_particle_shape_table, gate_particle_shape_table,
+                            open_image_reader, get_calibration_from_reader, open_series_from_reader,
+                            get_image_title_from_path, get_threshold_from_histogram,
+                            get_cached_channel_histogram, read_dataset_thresholds,
+                            open_channel_downsampled, scale_roi, measure_in_all_rois,
+                            change_all_roi_color, change_subset_roi_color, show_all_rois_on_image,
+                            write_roi_store, get_flag_column, save_all_rois, save_selected_rois,
+                            save_rois_to_zip, enlarge_all_rois, enlarge_all_rois_without_overlap,
+                            measure_rois, get_central_rois, select_central_nuclei,
+                            get_fiber_stats_cache_entry, get_fiber_stats_cache_path,
+                            write_fiber_stats_cache, get_results_columns, add_yes_no_column,
+                            write_results, enhance_contrast, renumber_rois, create_composite,
+                            save_overview_png, start_stage_timer, time_stage, write_stage_timings,
+                            save_log, setup_defined_ij, log)
+
+#@ String (visibility=MESSAGE, value="<html><b> Welcome to Myosoft - full pipeline! </b></html>") msg1
+#@ File (label="Select directory with classifiers", style="directory") classifiers_dir
+#@ File (label="Select directory for output", style="directory") output_dir
+#@ File (label="Select image file", description="select your image")  path_to_image
+#@ Boolean (label="close image after processing", description="tick this box when using batch mode", value=False) close_raw
+#@ String (visibility=MESSAGE, value="<html><b> Morphometric Gates </b></html>") msg2
+#@ Integer (label="Min Area [um²]", value=10) minAr
+#@ Integer (label="Max Area [um²]", value=6000) maxAr
+#@ Float (label="Min Circularity", value=0.5) minCir
+#@ Float (label="Max Circularity", value=1) maxCir
+#@ Float (label="Min solidity", value=0.0) minSol
+#@ Float (label="Max solidity", value=1) maxSol
+#@ Integer (label="Min perimeter [um]", value=5) minPer
+#@ Integer (label="Max perimeter [um]", value=300) maxPer
+#@ Integer (label="Min min ferret [um]", value=0.1) minMinFer
+#@ Integer (label="Max min ferret [um]", value=100) maxMinFer
+#@ Integer (label="Min ferret AR", value=0) minFAR
+#@ Integer (label="Max ferret AR", value=8) maxFAR
+#@ Float (label="Min roundess", value=0.2) minRnd
+#@ Float (label="Max roundess", value=1) maxRnd
+#@ String (visibility=MESSAGE, value="<html><b> Expand ROIS to match fibers </b></html>") msg3
+#@ Float (label="ROI expansion [microns]", value=1) enlarge
+#@ Boolean (label="expand ROIs without overlap", description="grow all ROIs at once on a distance map, pixels between fibers go to the nearest fiber", value=False) enlarge_without_overlap
+#@ String (visibility=MESSAGE, value="<html><b> channel positions in the hyperstack (0=skip the stage) </b></html>") msg5
+#@ Integer (label="Membrane staining channel number", style="slider", min=1, max=5, value=1) membrane_channel
+#@ Integer (label="Fiber staining (MHC) channel number (0=skip)", style="slider", min=0, max=5, value=3) fiber_channel
+#@ Integer (label="minimum fiber intensity (0=auto)", description="0 = automatic threshold detection", value=0) min_fiber_intensity
+#@ Integer (label="Nucleus staining channel number (0=skip)", style="slider", min=0, max=5, value=0) nucleus_channel
+#@ Integer (label="minimum nucleus intensity (0=auto)", description="0 = automatic threshold detection", value=0) min_nucleus_intensity
+#@ Float (label="ROI Shrinking factor", value=0.7) shrink
+#@ Integer (label="Fiber typing staining 1 channel number (0=n.a.)", style="slider", min=0, max=5, value=0) fiber_channel_1
+#@ Integer (label="Fiber typing staining 2 channel number (0=n.a.)", style="slider", min=0, max=5, value=0) fiber_channel_2
+#@ Integer (label="Fiber typing staining 3 channel number (0=n.a.)", style="slider", min=0, max=5, value=0) fiber_channel_3
+#@ Integer (label="minimum fiber typing intensity 1 (0=auto)", description="0 = automatic threshold detection", value=0) min_fiber_intensity_1
+#@ Integer (label="minimum fiber typing intensity 2 (0=auto)", description="0 = automatic threshold detection", value=0) min_fiber_intensity_2
+#@ Integer (label="minimum fiber typing intensity 3 (0=auto)", description="0 = automatic threshold detection", value=0) min_fiber_intensity_3
+#@ File (label="dataset thresholds (optional)", description="the dataset_thresholds.json of 2_dataset_thresholds.py, replaces the automatic threshold of each image", style="file", required=false) dataset_thresholds_file
+#@ String (visibility=MESSAGE, value="<html><b> performance </b></html>") msg6
+#@ Integer (label="sub-tiling to economize RAM", style="slider", min=1, max=8, value=4) tiling_factor
+#@ Float (label="segmentation pixel size [um] (0=full resolution)", description="segment the membrane channel downsampled to this pixel size (using the resolution pyramid if present), the ROIs are scaled back to full resolution", value=0) segmentation_pixel_size
+#@ Integer (label="WEKA threads (0=all cores)", description="limit this when running several images in parallel, see batch_runner.py", value=0) weka_threads
+#@ Integer (label="classifier cache size [MB] (0=off)", description="keep loaded classifiers in memory for the next image, useful in batch mode", value=256) classifier_cache_mb
+#@ Integer (label="probability map cache size [MB] (0=off)", description="store WEKA results in the output directory, re-running the morphometric gates then skips the segmentation", value=4096) probability_cache_mb
+#@ Boolean (label="also save ROI-zips", description="all ROIs and their classes are saved in one .roistore, tick this for RoiManager compatible zips, e.g. for manual curation", value=True) save_roi_zips
+#@ Integer (label="overview PNG maximum size [px] (0=full resolution)", description="the overview PNG is downsampled so that its longer side is at most this size", value=4096) overview_max_size
+#@ Boolean (label="save a zoomable full resolution overview", description="a Deep Zoom pyramid of PNG tiles next to the overview PNG, e.g. for OpenSeadragon", value=False) overview_pyramid
+
+
+def get_loaded_channel_processor(imp, loaded_channels, channel):
+    """get the processor of a channel of an image that holds only some of the channels of the file
+
+    Parameters
+    ----------
+    imp : ImagePlus
+        the image as returned by open_series_from_reader
+    loaded_channels : array
+        the channels of the file that were loaded, in their order in imp. starts at 1.
+    channel : integer
+        the channel of the file. starts at 1.
+
+    Returns
+    -------
+    ImageProcessor
+        the pixels of the channel, shared with imp
+    """
+    return imp.getStack().getProcessor( imp.getStackIndex(loaded_channels.index(channel) + 1, 1, 1) )
+
+
+def get_intensity_threshold(min_intensity, channel, dataset_thresholds, auto_thresholds):
+    """returns the intensity threshold to apply to a channel
+
+    Parameters
+    ----------
+    min_intensity : integer
+        the minimum intensity set by the user, 0 for an automatic threshold
+    channel : integer
+        the channel. starts at 1.
+    dataset_thresholds : dict
+        the dataset-wide thresholds as returned by read_dataset_thresholds, or None
+    auto_thresholds : dict
+        the automatic threshold of every channel of the image
+
+    Returns
+    -------
+    float
+        the minimum intensity if set, else the dataset threshold if given, else the automatic threshold
+    """
+    if min_intensity > 0:
+        return min_intensity
+    if dataset_thresholds is not None:
+        log( "dataset intensity threshold: True" )
+        return dataset_thresholds[channel]
+    log( "automatic intensity threshold detection: True" )
+
+    return auto_thresholds[channel]
+
+
+def restore_rois(rm, rois):
+    """replace the ROIs of the RoiManager by copies of the given ROIs, so each stage starts from the
+    uncolored fibers
+
+    Parameters
+    ----------
+    rm : RoiManager
+        a reference of the IJ-RoiManager
+    rois : array
+        the ROIs to put into the RoiManager
+    """
+    rm.reset()
+    # fill the RoiManager at once instead of ROI by ROI
+    overlay = Overlay()
+    for roi in rois:
+        overlay.add( roi.clone() )
+    rm.setOverlay(overlay)
+
+
+def copy_results_columns(columns):
+    """copy results columns as returned by get_results_columns, so they can be extended independently
+
+    Parameters
+    ----------
+    columns : array
+        the columns, each a list of the heading and the values
+
+    Returns
+    -------
+    array
+        the copied columns
+    """
+    return [ [ heading, list(values) ] for heading, values in columns ]
+
+
+def finish_stage(stage_dir, raw_image_title, log_name, stage_start_time, artifacts):
+    """log the time a stage took and save the log of the stage in its output folder
+
+    Parameters
+    ----------
+    stage_dir : string
+        the output folder of the stage
+    raw_image_title : string
+        the title of the image
+    log_name : string
+        the suffix of the log file, as used by the script of the stage, e.g. "all_fibers_Log"
+    stage_start_time : float
+        the time the stage was started at, as returned by time.time()
+    artifacts : array
+        the list to which the path of the saved log is appended
+    """
+    log( "stage time in minutes: " + str( (time.time() - stage_start_time) / 60.0 ) )
+    log( "~~ all done ~~" )
+    artifacts.append( save_log( str(stage_dir + "/" + raw_image_title + "_" + log_name) ) )
+    log("\\Clear")
+
+
+# there is no window to show the ROI Manager in when running headless
+headless = GraphicsEnvironment.isHeadless()
+rm = RoiManager(True) if headless else RoiManager.getRoiManager()
+rt = ResultsTable.getResultsTable()
+
+setup_defined_ij(rm, rt)
+
+path_to_image = fix_ij_dirs(path_to_image)
+
+# take care of paths and directories, the stages write to the same folders as scripts 1) to 2c)
+output_root = fix_ij_dirs(output_dir)
+probability_cache_dir = output_root + "/probability_map_cache"
+histogram_cache_dir = output_root + "/histogram_cache"
+classifiers_dir = fix_ij_dirs(classifiers_dir)
+primary_model = classifiers_dir + "/" + "primary.model"
+secondary_model = classifiers_dir + "/" + "secondary_central_nuclei.model"
+
+# the channels every stage needs are read once and shared by all stages
+typing_channels = [fiber_channel_1, fiber_channel_2, fiber_channel_3]
+typing_min_intensities = [min_fiber_intensity_1, min_fiber_intensity_2, min_fiber_intensity_3]
+fiber_stat_channels = sorted( set( [channel for channel in [fiber_channel] + typing_channels if channel > 0] ) )
+loaded_channels = sorted( set( [channel for channel in [membrane_channel, nucleus_channel] + fiber_stat_channels if channel > 0] ) )
+threshold_channels = sorted( set( fiber_stat_channels + ([nucleus_channel] if nucleus_channel > 0 else []) ) )
+
+# all series of the file are read through one reader session
+reader = open_image_reader(path_to_image)
+series_count = reader.getSeriesCount()
+# the image is identified by path, size and modification time, only the classifiers are hashed
+file_hashes = dict( [(input_file, get_file_hash(input_file)) for input_file in [primary_model, secondary_model]] )
+file_hashes[path_to_image] = get_image_key(path_to_image)
+image_signature = get_file_signature(path_to_image)
+# one threshold per channel for the whole dataset replaces the automatic threshold of each image
+dataset_thresholds = None
+if dataset_thresholds_file is not None and os.path.isfile( str(dataset_thresholds_file) ):
+    dataset_thresholds_path = fix_ij_dirs(dataset_thresholds_file)
+    dataset_thresholds = read_dataset_thresholds( dataset_thresholds_path, [ channel for channel, min_intensity in
+        zip( [fiber_channel, nucleus_channel] + typing_channels, [min_fiber_intensity, min_nucleus_intensity] + typing_min_intensities )
+        if channel > 0 and min_intensity == 0 ] )
+    file_hashes[dataset_thresholds_path] = get_file_hash(dataset_thresholds_path)
+
+for series in range(series_count):
+    execution_start_time = time.time()
+    raw_image_title = get_image_title_from_path(path_to_image, series if series_count > 1 else None)
+    print("raw image title: ", str(raw_image_title))
+
+    series_dir = output_root + "/" + str(raw_image_title)
+    identify_dir = series_dir + "/1_identify_fibers"
+    mhc_dir = series_dir + "/2a_identify_MHC_positive_fibers"
+    central_nuclei_dir = series_dir + "/2b_central_nuclei_counter"
+    fibertyping_dir = series_dir + "/2c_fibertyping"
+    for stage_dir, stage_channel in [ (identify_dir, 1), (mhc_dir, fiber_channel), (central_nuclei_dir, nucleus_channel),
+            (fibertyping_dir, max(typing_channels)) ]:
+        if stage_channel > 0 and not os.path.exists( stage_dir ):
+            os.makedirs( stage_dir )
+
+    # skip the series if a previous run with the same inputs and parameters is complete
+    journal_path = series_dir + "/" + raw_image_title + "_pipeline_journal.json"
+    input_hashes = dict(file_hashes)
+    run_parameters = dict( [(name, str(value)) for name, value in [
+        ("minAr", minAr), ("maxAr", maxAr), ("minPer", minPer), ("maxPer", maxPer), ("minCir", minCir), ("maxCir", maxCir),
+        ("minRnd", minRnd), ("maxRnd", maxRnd), ("minSol", minSol), ("maxSol", maxSol), ("minFAR", minFAR), ("maxFAR", maxFAR),
+        ("minMinFer", minMinFer), ("maxMinFer", maxMinFer), ("enlarge", enlarge), ("enlarge_without_overlap", enlarge_without_overlap),
+        ("membrane_channel", membrane_channel), ("fiber_channel", fiber_channel), ("min_fiber_intensity", min_fiber_intensity),
+        ("nucleus_channel", nucleus_channel), ("min_nucleus_intensity", min_nucleus_intensity), ("shrink", shrink),
+        ("fiber_channel_1", fiber_channel_1), ("fiber_channel_2", fiber_channel_2), ("fiber_channel_3", fiber_channel_3),
+        ("min_fiber_intensity_1", min_fiber_intensity_1), ("min_fiber_intensity_2", min_fiber_intensity_2), ("min_fiber_intensity_3", min_fiber_intensity_3),
+        ("tiling_factor", tiling_factor), ("segmentation_pixel_size", segmentation_pixel_size), ("save_roi_zips", save_roi_zips),
+        ("overview_max_size", overview_max_size), ("overview_pyramid", overview_pyramid), ("series", series)] ] )
+
+    if is_journal_complete(journal_path, input_hashes, run_parameters):
+        log( "Skipping " + str(raw_image_title) + ": already processed with the same inputs and parameters" )
+        continue
+
+    setup_defined_ij(rm, rt)
+    # wall time, CPU time and memory of every stage go to a _pipeline_timings.json next to the outputs
+    stage_timer = start_stage_timer("Bio-Formats open", rm)
+    reader.setSeries(series)
+    raw_image_calibration = get_calibration_from_reader(reader)
+    raw = open_series_from_reader(reader, raw_image_title, loaded_channels)
+    num_threads = weka_threads if weka_threads > 0 else Runtime.getRuntime().availableProcessors()
+    artifacts = []
+
+    # ---- stage 1: identify fibers ----
+    stage_start_time = time.time()
+    log( "Now working on " + str(raw_image_title) )
+    if raw_image_calibration.scaled() == False:
+        log("Your image is not spatially calibrated! Size measurements are only possible in [px].")
+    log( " -- settings used -- ")
+    log( "area = " + str(minAr) + "-" + str(maxAr) )
+    log( "perimeter = " + str(minPer) + "-" + str(maxPer) )
+    log( "circularity = " + str(minCir) + "-" + str(maxCir) )
+    log( "roundness = " + str(minRnd) + "-" + str(maxRnd) )
+    log( "solidity = " + str(minSol) + "-" + str(maxSol) )
+    log( "feret_ar = " + str(minFAR) + "-" + str(maxFAR) )
+    log( "min_feret = " + str(minMinFer) + "-" + str(maxMinFer) )
+    log( "ROI expansion [microns] = " + str(enlarge) )
+    log( "ROI expansion without overlap = " + str(enlarge_without_overlap) )
+    log( "Membrane channel = " + str(membrane_channel) )
+    log( "MHC positive fiber channel = " + str(fiber_channel) )
+    log( "sub-tiling = " + str(tiling_factor) )
+    log( "segmentation pixel size [um] = " + str(segmentation_pixel_size) )
+    log( "WEKA threads = " + str(weka_threads) )
+    log( "dataset thresholds = " + (dataset_thresholds_path if dataset_thresholds is not None else "none") )
+    log( " -- settings used -- ")
+
+    # image (pre)processing and segmentation (-> ROIs), re-using a cached probability map if possible
+    time_stage(stage_timer, "preprocessing")
+    downsample_membrane = segmentation_pixel_size > raw_image_calibration.pixelWidth
+    weka_result2 = None
+    if probability_cache_mb > 0:
+        probability_cache_key = get_probability_map_cache_key(input_hashes[path_to_image], series, membrane_channel,
+            [input_hashes[primary_model], input_hashes[secondary_model]], tiling_factor, segmentation_pixel_size if downsample_membrane else 0)
+        weka_result2 = open_cached_probability_map(probability_cache_dir, probability_cache_key)
+        if weka_result2 is not None:
+            log( "re-using cached probability map " + probability_cache_key )
+
+    if weka_result2 is None:
+        if downsample_membrane:
+            membrane = open_channel_downsampled(reader, membrane_channel, segmentation_pixel_size, raw_image_calibration)
+        else:
+            raw_membrane_channel = loaded_channels.index(membrane_channel) + 1
+            membrane = Duplicator().run(raw, raw_membrane_channel, raw_membrane_channel, 1, 1, 1, 1) # imp, firstC, lastC, firstZ, lastZ, firstT, lastT
+            membrane.setCalibration(raw_image_calibration)
+        preprocess_membrane_channel(membrane)
+        time_stage(stage_timer, "WEKA primary")
+        weka_result1 = apply_weka_model(primary_model, membrane, tiling_factor, classifier_cache_mb, weka_threads )
+        delete_channel(weka_result1, 1)
+        time_stage(stage_timer, "WEKA secondary")
+        weka_result2 = apply_weka_model(secondary_model, weka_result1, tiling_factor, classifier_cache_mb, weka_threads )
+        delete_channel(weka_result2, 1)
+        weka_result2.setCalibration( membrane.getCalibration() )
+        if probability_cache_mb > 0:
+            save_probability_map_to_cache(probability_cache_dir, probability_cache_key, weka_result2, probability_cache_mb)
+
+    time_stage(stage_timer, "post-processing")
+    process_weka_result(weka_result2)
+    binary_path = identify_dir + "/" + raw_image_title + "_all_fibers_binary.tif"
+    # the full resolution size is stored with the binary, so it can be mapped back when downsampled
+    weka_result2.setProp( "raw_width", str( raw.getWidth() ) )
+    weka_result2.setProp( "raw_height", str( raw.getHeight() ) )
+    IJ.saveAs(weka_result2, "Tiff", binary_path)
+    artifacts.append(binary_path)
+
+    time_stage(stage_timer, "particle analysis")
+    # identify all particles once, then apply the morphometric gates to their shape descriptors
+    eda_parameters = [minAr, maxAr, minPer, maxPer, minCir, maxCir, minRnd, maxRnd, minSol, maxSol, minFAR, maxFAR, minMinFer, maxMinFer]
+    particle_shapes = build_particle_shape_table(weka_result2)
+    gated_particles = gate_particle_shape_table(particle_shapes, eda_parameters)
+    log( str(len(gated_particles)) + " of " + str(len(particle_shapes["rois"])) + " particles passed the morphometric gates" )
+
+    time_stage(stage_timer, "enlargement")
+    # modify rois, mapping them to full resolution if the segmentation was downsampled
+    if not headless:
+        rm.hide()
+    x_scale = float( raw.getWidth() ) / weka_result2.getWidth()
+    y_scale = float( raw.getHeight() ) / weka_result2.getHeight()
+    for particle in gated_particles:
+        if x_scale != 1 or y_scale != 1:
+            rm.addRoi( scale_roi(particle_shapes["rois"][particle], x_scale, y_scale) )
+        else:
+            rm.addRoi( particle_shapes["rois"][particle] )
+    weka_result2.close()
+    if enlarge_without_overlap:
+        enlarge_all_rois_without_overlap( enlarge, rm, raw_image_calibration.pixelWidth, raw.getWidth(), raw.getHeight(), num_threads )
+    else:
+        enlarge_all_rois( enlarge, rm, raw_image_calibration.pixelWidth )
+    renumber_rois(rm)
+    time_stage(stage_timer, "ROI writes")
+    if save_roi_zips:
+        save_all_rois( rm, identify_dir + "/" + raw_image_title + "_all_fiber_rois.zip" )
+        artifacts.append( identify_dir + "/" + raw_image_title + "_all_fiber_rois.zip" )
+
+    time_stage(stage_timer, "measurement")
+    # the fiber set of all later stages: the uncolored ROIs and their size & shape
+    fiber_rois = [ roi.clone() for roi in rm.getRoisAsArray() ]
+    fiber_count = len(fiber_rois)
+    IJ.run("Set Measurements...", "area perimeter shape feret's redirect=None decimal=4")
+    IJ.run("Clear Results", "")
+    measure_in_all_rois( raw, loaded_channels.index(membrane_channel) + 1, rm )
+    rt = ResultsTable.getResultsTable("Results")
+    shape_columns = get_results_columns(rt)
+
+    # intensity statistics of all fiber channels at once, automatic thresholds from the histogram cache
+    fiber_stats = dict( zip( fiber_stat_channels, measure_rois( fiber_rois,
+        [ get_loaded_channel_processor(raw, loaded_channels, channel) for channel in fiber_stat_channels ],
+        num_threads, FIBER_HISTOGRAM_BINS ) ) )
+    auto_thresholds = {}
+    for channel in threshold_channels:
+        channel_histogram = get_cached_channel_histogram( histogram_cache_dir, input_hashes[path_to_image], series, channel,
+            reader, HISTOGRAM_TILE_SIZE )
+        auto_thresholds[channel] = get_threshold_from_histogram(channel_histogram, "Mean")
+
+    time_stage(stage_timer, "positivity")
+    # check for positive fibers
+    if fiber_channel > 0:
+        fiber_threshold = get_intensity_threshold(min_fiber_intensity, fiber_channel, dataset_thresholds, auto_thresholds)
+        log( "fiber intensity threshold: " + str(fiber_threshold) )
+        positive_fibers = [ fiber for fiber, mean in enumerate(fiber_stats[fiber_channel]["Mean"]) if mean > fiber_threshold ]
+        change_all_roi_color(rm, "blue")
+        change_subset_roi_color(rm, positive_fibers, "magenta")
+        if save_roi_zips:
+            save_selected_rois( rm, positive_fibers, identify_dir + "/" + raw_image_title + "_mhc_positive_fiber_rois.zip")
+            artifacts.append( identify_dir + "/" + raw_image_title + "_mhc_positive_fiber_rois.zip" )
+
+    time_stage(stage_timer, "ROI writes")
+    # all fibers with their classes as columns in one ROI store, with the fiber statistics next to it
+    # so that 2a) and 2c) can re-threshold them later
+    fiber_columns = {}
+    if fiber_channel > 0:
+        fiber_columns["MHC positive"] = get_flag_column( fiber_count, positive_fibers )
+    fiber_store_path = identify_dir + "/" + raw_image_title + "_all_fiber_rois.roistore"
+    write_roi_store( rm.getRoisAsArray(), fiber_columns, fiber_store_path )
+    artifacts.append( fiber_store_path )
+    if len(fiber_stat_channels) > 0:
+        fiber_stats_path = get_fiber_stats_cache_path(fiber_store_path)
+        write_fiber_stats_cache( fiber_stats_path, get_file_hash(fiber_store_path), image_signature, series, shape_columns,
+            dict( [ (channel, get_fiber_stats_cache_entry(fiber_stats[channel], auto_thresholds[channel], FIBER_HISTOGRAM_BINS))
+                for channel in fiber_stat_channels ] ) )
+        artifacts.append(fiber_stats_path)
+
+    time_stage(stage_timer, "CSV writes")
+    results_columns = copy_results_columns(shape_columns)
+    if fiber_channel > 0:
+        add_yes_no_column( results_columns, "MHC Positive Fibers (magenta)", fiber_count, positive_fibers )
+    write_results( rt, results_columns, identify_dir + "/" + raw_image_title + "_all_fibers_results.csv" )
+    artifacts.append( identify_dir + "/" + raw_image_title + "_all_fibers_results.csv" )
+    time_stage(stage_timer, "PNG writes")
+    overview_channels = [channel for channel in [membrane_channel, fiber_channel] if channel > 0]
+    overview = create_composite( [ get_loaded_channel_processor(raw, loaded_channels, channel) for channel in overview_channels ], raw_image_title )
+    artifacts.extend( save_overview_png( overview, rm, identify_dir + "/" + raw_image_title + "_all_fibers", overview_max_size, overview_pyramid ) )
+    finish_stage(identify_dir, raw_image_title, "all_fibers_Log", stage_start_time, artifacts)
+
+    # ---- stage 2a: MHC positive fibers ----
+    if fiber_channel > 0:
+        stage_start_time = time.time()
+        log( "Now working on " + str(raw_image_title) + ": MHC positive fibers" )
+        log( " -- settings used -- ")
+        log( "MHC positive fiber channel = " + str(fiber_channel) )
+        log( " -- settings used -- ")
+        time_stage(stage_timer, "2a positivity")
+        restore_rois(rm, fiber_rois)
+        log( "fiber intensity threshold: " + str(fiber_threshold) )
+        change_all_roi_color(rm, "blue")
+        change_subset_roi_color(rm, positive_fibers, "magenta")
+        time_stage(stage_timer, "2a ROI writes")
+        if save_roi_zips:
+            save_selected_rois( rm, positive_fibers, mhc_dir + "/" + raw_image_title + "_mhc_positive_fiber_rois.zip")
+            artifacts.append( mhc_dir + "/" + raw_image_title + "_mhc_positive_fiber_rois.zip" )
+        write_roi_store( rm.getRoisAsArray(), { "MHC positive": get_flag_column( fiber_count, positive_fibers ) },
+            mhc_dir + "/" + raw_image_title + "_mhc_positive_fibers.roistore" )
+        artifacts.append( mhc_dir + "/" + raw_image_title + "_mhc_positive_fibers.roistore" )
+
+        time_stage(stage_timer, "2a CSV writes")
+        results_columns = copy_results_columns(shape_columns)
+        add_yes_no_column( results_columns, "MHC Positive Fibers (magenta)", fiber_count, positive_fibers )
+        write_results( rt, results_columns, mhc_dir + "/" + raw_image_title + "_mhc_positive_fibers_results.csv" )
+        artifacts.append( mhc_dir + "/" + raw_image_title + "_mhc_positive_fibers_results.csv" )
+        time_stage(stage_timer, "2a PNG writes")
+        overview = create_composite( [ get_loaded_channel_processor(raw, loaded_channels, fiber_channel) ], raw_image_title )
+        artifacts.extend( save_overview_png( overview, rm, mhc_dir + "/" + raw_image_title + "_mhc_positive_fibers", overview_max_size, overview_pyramid ) )
+        finish_stage(mhc_dir, raw_image_title, "mhc_positive_fibers_Log", stage_start_time, artifacts)
+
+    # ---- stage 2b: central nuclei ----
+    if nucleus_channel > 0:
+        stage_start_time = time.time()
+        log( "Now working on " + str(raw_image_title) + ": central nuclei" )
+        log( " -- settings used -- ")
+        log( "ROI Shrinking factor = " + str(shrink) )
+        log( "Nucleus channel = " + str(nucleus_channel) )
+        log( " -- settings used -- ")
+        restore_rois(rm, fiber_rois)
+
+        time_stage(stage_timer, "2b central regions")
+        # shrink the fibers to their central region and look for nuclei there
+        shrunk_rois = get_central_rois(fiber_rois, shrink, num_threads)
+        write_roi_store( shrunk_rois, {}, central_nuclei_dir + "/" + raw_image_title + "_all_fiber_rois_shrunk.roistore" )
+        artifacts.append( central_nuclei_dir + "/" + raw_image_title + "_all_fiber_rois_shrunk.roistore" )
+        if save_roi_zips:
+            save_rois_to_zip( shrunk_rois, central_nuclei_dir + "/" + raw_image_title + "_all_fiber_rois_shrunk.zip" )
+            artifacts.append( central_nuclei_dir + "/" + raw_image_title + "_all_fiber_rois_shrunk.zip" )
+
+        time_stage(stage_timer, "2b positivity")
+        nucleus_threshold = get_intensity_threshold(min_nucleus_intensity, nucleus_channel, dataset_thresholds, auto_thresholds)
+        log( "nucleus intensity threshold: " + str(nucleus_threshold) )
+        central_nuclei_fibers = select_central_nuclei( raw, loaded_channels.index(nucleus_channel) + 1, rm, nucleus_threshold, shrunk_rois )
+        change_subset_roi_color(rm, central_nuclei_fibers, "yellow")
+        time_stage(stage_timer, "2b ROI writes")
+        if save_roi_zips:
+            save_selected_rois( rm, central_nuclei_fibers, central_nuclei_dir + "/" + raw_image_title + "_central_nuclei_fiber_rois.zip")
+            artifacts.append( central_nuclei_dir + "/" + raw_image_title + "_central_nuclei_fiber_rois.zip" )
+            save_all_rois( rm, central_nuclei_dir + "/" + raw_image_title + "_all_fiber_rois_central_nuclei_color-coded.zip" )
+            artifacts.append( central_nuclei_dir + "/" + raw_image_title + "_all_fiber_rois_central_nuclei_color-coded.zip" )
+        write_roi_store( rm.getRoisAsArray(), { "central nuclei": get_flag_column( fiber_count, central_nuclei_fibers ) },
+            central_nuclei_dir + "/" + raw_image_title + "_central_nuclei_fibers.roistore" )
+        artifacts.append( central_nuclei_dir + "/" + raw_image_title + "_central_nuclei_fibers.roistore" )
+
+        time_stage(stage_timer, "2b CSV writes")
+        results_columns = copy_results_columns(shape_columns)
+        add_yes_no_column( results_columns, "Centralized Nuclei (yellow)", fiber_count, central_nuclei_fibers )
+        write_results( rt, results_columns, central_nuclei_dir + "/" + raw_image_title + "_centralized_nuclei_results.csv" )
+        artifacts.append( central_nuclei_dir + "/" + raw_image_title + "_centralized_nuclei_results.csv" )
+        time_stage(stage_timer, "2b PNG writes")
+        overview = create_composite( [ get_loaded_channel_processor(raw, loaded_channels, nucleus_channel) ], raw_image_title )
+        artifacts.extend( save_overview_png( overview, rm, central_nuclei_dir + "/" + raw_image_title + "_centralized_nuclei", overview_max_size, overview_pyramid ) )
+        finish_stage(central_nuclei_dir, raw_image_title, "centralized_nuclei_Log", stage_start_time, artifacts)
+
+    # ---- stage 2c: fiber typing ----
+    if max(typing_channels) > 0:
+        stage_start_time = time.time()
+        log( "Now working on " + str(raw_image_title) + ": fiber typing" )
+        log( " -- settings used -- ")
+        log( "Fiber staining 1 channel number = " + str(fiber_channel_1) )
+        log( "Fiber staining 2 channel number = " + str(fiber_channel_2) )
+        log( "Fiber staining 3 channel number = " + str(fiber_channel_3) )
+        log( " -- settings used -- ")
+        restore_rois(rm, fiber_rois)
+
+        time_stage(stage_timer, "2c positivity")
+        # check every fiber channel for positive fibers, then for double and triple positives
+        roi_colors = ["green", "orange", "red"]
+        all_fiber_subsets = [ [], [], [] ]
+        results_columns = copy_results_columns(shape_columns)
+        for index, typing_channel in enumerate(typing_channels):
+            if typing_channel > 0:
+                typing_threshold = get_intensity_threshold(typing_min_intensities[index], typing_channel, dataset_thresholds, auto_thresholds)
+                log( "fiber channel " + str(typing_channel) + " intensity threshold: " + str(typing_threshold) )
+                positive_fibers = [ fiber for fiber, mean in enumerate(fiber_stats[typing_channel]["Mean"]) if mean > typing_threshold ]
+                all_fiber_subsets[index] = positive_fibers
+                add_yes_no_column( results_columns, "channel " + str(typing_channel) + " positive (" + roi_colors[typing_channel-1] + ")", fiber_count, positive_fibers )
+                if len(positive_fibers) > 0:
+                    change_subset_roi_color(rm, positive_fibers, roi_colors[index])
+                    if save_roi_zips:
+                        save_selected_rois( rm, positive_fibers, fibertyping_dir + "/" + raw_image_title + "_positive_fiber_rois_c" + str( typing_channel ) + ".zip")
+                        artifacts.append( fibertyping_dir + "/" + raw_image_title + "_positive_fiber_rois_c" + str( typing_channel ) + ".zip" )
+
+        positive_c1_c2 = list( set(all_fiber_subsets[0]).intersection(all_fiber_subsets[1]) )
+        positive_c1_c3 = list( set(all_fiber_subsets[0]).intersection(all_fiber_subsets[2]) )
+        positive_c2_c3 = list( set(all_fiber_subsets[1]).intersection(all_fiber_subsets[2]) )
+        positive_c1_c2_c3 = list( set(positive_c1_c2).intersection(all_fiber_subsets[2]) )
+        combinations = [ ("c1_c2", "channel 1,2 positive", "magenta", positive_c1_c2), ("c1_c3", "channel 1,3 positive", "yellow", positive_c1_c3),
+            ("c2_c3", "channel 2,3 positive", "cyan", positive_c2_c3), ("c1_c2_c3", "channel 1,2,3 positive", "white", positive_c1_c2_c3) ]
+        for file_suffix, column_name, color, fibers in combinations:
+            if len(fibers) > 0:
+                change_subset_roi_color(rm, fibers, color)
+                if save_roi_zips:
+                    save_selected_rois( rm, fibers, fibertyping_dir + "/" + raw_image_title + "_positive_fiber_rois_" + file_suffix + ".zip")
+                    artifacts.append( fibertyping_dir + "/" + raw_image_title + "_positive_fiber_rois_" + file_suffix + ".zip" )
+                add_yes_no_column( results_columns, column_name + " (" + color + ")", fiber_count, fibers )
+
+        time_stage(stage_timer, "2c ROI writes")
+        # save all results together, the fiber types are columns of one ROI store
+        fiber_type_columns = {}
+        for index, typing_channel in enumerate(typing_channels):
+            if typing_channel > 0:
+                fiber_type_columns["channel " + str(typing_channel) + " positive"] = get_flag_column( fiber_count, all_fiber_subsets[index] )
+        for _, column_name, _, fibers in combinations:
+            if len(fibers) > 0:
+                fiber_type_columns[column_name] = get_flag_column(fiber_count, fibers)
+        write_roi_store( rm.getRoisAsArray(), fiber_type_columns, fibertyping_dir + "/" + raw_image_title + "_fibertyping.roistore" )
+        artifacts.append( fibertyping_dir + "/" + raw_image_title + "_fibertyping.roistore" )
+        if save_roi_zips:
+            save_all_rois( rm, fibertyping_dir + "/" + raw_image_title + "_all_fiber_type_rois_color-coded.zip" )
+            artifacts.append( fibertyping_dir + "/" + raw_image_title + "_all_fiber_type_rois_color-coded.zip" )
+        time_stage(stage_timer, "2c CSV writes")
+        write_results( rt, results_columns, fibertyping_dir + "/" + raw_image_title + "_fibertyping_results.csv" )
+        artifacts.append( fibertyping_dir + "/" + raw_image_title + "_fibertyping_results.csv" )
+        time_stage(stage_timer, "2c PNG writes")
+        overview = create_composite( [ get_loaded_channel_processor(raw, loaded_channels, channel) for channel in typing_channels if channel > 0 ], raw_image_title )
+        artifacts.extend( save_overview_png( overview, rm, fibertyping_dir + "/" + raw_image_title + "_fibertyping", overview_max_size, overview_pyramid ) )
+        finish_stage(fibertyping_dir, raw_image_title, "fibertyping_Log", stage_start_time, artifacts)
+
+    # present original to the user, with the ROIs of the last stage
+    if not headless and series == series_count - 1:
+        rm.show()
+        enhance_contrast( raw )
+        show_all_rois_on_image( rm, raw )
+    total_execution_time_min = (time.time() - execution_start_time) / 60.0
+    log("total time in minutes: " + str(total_execution_time_min))
+    artifacts.append( write_stage_timings( stage_timer, series_dir + "/" + raw_image_title + "_pipeline_timings.json",
+        "full_pipeline", raw_image_title, series ) )
+    write_journal(journal_path, input_hashes, run_parameters, artifacts)
+    # only the image of the last series stays open, the others are released before the next series is read
+    if raw is not None and (close_raw == True or series < series_count - 1):
+        raw.close()
+        raw.flush()
+
+reader.close()
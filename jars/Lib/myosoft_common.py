@@ -0,0 +1,2285 @@
+# helper functions shared by the Myosoft scripts. Copy this file to the
+# jars/Lib folder of Fiji (e.g. Fiji.app/jars/Lib/myosoft_common.py) so the
+# scripts can import it, and restart Fiji after updating it.
+
+# IJ imports
+from ij import IJ, ImagePlus, ImageStack, CompositeImage, WindowManager
+from ij.gui import PolygonRoi, Roi, Overlay
+from ij.plugin import RoiEnlarger, RoiScaler, Colors
+from trainableSegmentation import WekaSegmentation
+from ij.measure import ResultsTable, Measurements, Calibration
+from ij.plugin.filter import ParticleAnalyzer, EDM, ThresholdToSelection, MaximumFinder
+from ij.plugin.frame import RoiManager
+from ij.io import RoiEncoder
+from ij.process import ImageProcessor, ImageStatistics, ByteProcessor, ShortProcessor, FloatProcessor, AutoThresholder, FloatPolygon, Blitter, FloodFiller
+
+# Bio-formats imports
+from loci.plugins.util import ImageProcessorReader, LociPrefs
+from loci.formats import ChannelSeparator, MetadataTools
+from ome.units import UNITS
+
+# Java imports
+from java.awt import Color, Rectangle, GraphicsEnvironment
+from java.io import File, BufferedOutputStream, DataOutputStream, FileOutputStream, RandomAccessFile
+from java.nio import ByteBuffer
+from java.nio.channels import FileChannel
+from java.lang import Double, Runtime, System, String
+from java.lang.management import ManagementFactory, MemoryType
+from java.util import LinkedHashMap
+from java.nio.file import Files, StandardCopyOption
+from java.util.zip import ZipEntry, ZipOutputStream
+
+# python imports
+import time
+import os
+import hashlib
+import json
+import jarray
+import math
+import threading
+from array import array
+
+
+# the number of histogram bins per fiber and channel in the fiber statistics cache
+FIBER_HISTOGRAM_BINS = 64
+# the first bytes of a ROI store, see write_roi_store
+ROI_STORE_MAGIC = "MYOROIS1"
+# the edge length of the tiles read for a channel histogram, see get_cached_channel_histogram
+HISTOGRAM_TILE_SIZE = 4096
+# the messages logged since the log was last cleared, see log
+LOG_LINES = []
+
+
+def fix_ij_options():
+    """put IJ into a defined state
+    """
+    # disable inverting LUT. There are no menus when running headless.
+    if not GraphicsEnvironment.isHeadless():
+        IJ.run("Appearance...", " menu=0 16-bit=Automatic")
+    # set foreground color to be white, background black
+    IJ.run("Colors...", "foreground=white background=black selection=red")
+    # black BG for binary images and pad edges when eroding
+    IJ.run("Options...", "black pad")
+    # set saving format to .txt files
+    IJ.run("Input/Output...", "file=.txt save_column save_row")
+    # ============= DON’T MOVE UPWARDS =============
+    # set "Black Background" in "Binary Options"
+    IJ.run("Options...", "black")
+    # scale when converting = checked
+    IJ.run("Conversions...", "scale")
+
+
+def fix_ij_dirs(path):
+    """use forward slashes in directory paths
+
+    Parameters
+    ----------
+    path : string
+        a directory path obtained from dialogue or script parameter
+
+    Returns
+    -------
+    string
+        a more robust path with forward slashes as separators
+    """
+
+    fixed_path = str(path).replace("\\", "/")
+    # fixed_path = fixed_path + "/"
+
+    return fixed_path
+
+
+def fix_BF_czi_imagetitle(imp):
+    image_title = os.path.basename( imp.getShortTitle() )
+    image_title = image_title.replace(".czi", "")
+    image_title = image_title.replace(" ", "_")
+    image_title = image_title.replace("_-_", "")
+    image_title = image_title.replace("__", "_")
+    image_title = image_title.replace("#", "Series")
+
+    return image_title
+
+
+def preprocess_membrane_channel(imp):
+    """apply myosoft pre-processing steps for the membrane channel
+
+    Parameters
+    ----------
+    imp : ImagePlus
+        a single channel image of the membrane staining
+    """
+    IJ.run(imp, "Enhance Contrast", "saturated=0.35")
+    IJ.run(imp, "Apply LUT", "")
+    IJ.run(imp, "Enhance Contrast", "saturated=1")
+    IJ.run(imp, "8-bit", "")
+    IJ.run(imp, "Invert", "")
+    IJ.run(imp, "Convolve...", "text1=[-1.0 -1.0 -1.0 -1.0 -1.0\n-1.0 -1.0 -1.0 -1.0 0\n-1.0 -1.0 24.0 -1.0 -1.0\n-1.0 -1.0 -1.0 -1.0 -1.0\n-1.0 -1.0 -1.0 -1.0 0] normalize")
+
+
+def get_weka_segmentator(model_path, cache_size_in_mb):
+    """returns a WekaSegmentation with the given model loaded, re-using a previously loaded one if possible
+
+    The loaded segmentators are kept in a JVM wide cache (stored in the Java system properties so it
+    survives between script runs in the same Fiji instance, e.g. in batch mode). Entries are keyed by
+    the model path, its modification time and its size, so a changed model file is loaded again. The
+    least recently used entries are evicted once the summed model file sizes exceed the cache size.
+
+    Parameters
+    ----------
+    model_path : string
+        path to the model file
+    cache_size_in_mb : integer
+        the maximum summed size of the cached model files in MB. 0 disables the cache.
+
+    Returns
+    -------
+    WekaSegmentation
+        a segmentator with the model loaded
+    """
+    if cache_size_in_mb <= 0:
+        segmentator = WekaSegmentation()
+        segmentator.loadClassifier( model_path )
+        return segmentator
+
+    model_file = File(model_path)
+    cache_key = model_file.getAbsolutePath() + "|" + str(model_file.lastModified()) + "|" + str(model_file.length())
+
+    properties = System.getProperties()
+    cache = properties.get("myosoft.weka_segmentator_cache")
+    if cache is None:
+        cache = LinkedHashMap(16, 0.75, True) # access order, the eldest entry is the least recently used
+        properties.put("myosoft.weka_segmentator_cache", cache)
+
+    segmentator = cache.get(cache_key)
+    if segmentator is not None:
+        log("re-using cached classifier " + os.path.basename(model_path))
+        return segmentator
+
+    # drop outdated versions of the same model before loading it again
+    for key in list(cache.keySet()):
+        if key.split("|")[0] == model_file.getAbsolutePath():
+            cache.remove(key)
+
+    segmentator = WekaSegmentation()
+    segmentator.loadClassifier( model_path )
+    cache.put(cache_key, segmentator)
+
+    # evict least recently used models, but always keep the one just loaded
+    cache_size_in_bytes = cache_size_in_mb * 1024 * 1024
+    cached_bytes = sum([long(key.split("|")[-1]) for key in cache.keySet()])
+    while cached_bytes > cache_size_in_bytes and cache.size() > 1:
+        eldest_key = cache.keySet().iterator().next()
+        cache.remove(eldest_key)
+        cached_bytes -= long(eldest_key.split("|")[-1])
+
+    return segmentator
+
+
+def apply_weka_model(model_path, imp, tiles_per_dim, cache_size_in_mb, num_threads):
+    """apply a pretrained WEKA model to an ImagePlus
+
+    Parameters
+    ----------
+    model_path : string
+        path to the model file
+    imp : ImagePlus
+        ImagePlus to apply the model to
+    tiles_per_dim : integer
+        tiles the imp to save RAM
+    cache_size_in_mb : integer
+        size of the classifier cache in MB, see get_weka_segmentator. 0 disables the cache.
+    num_threads : integer
+        the number of threads to use for the classification. 0 uses all cores.
+
+    Returns
+    -------
+    ImagePlus
+        the result of the WEKA segmentation. One channel per class.
+    """
+    segmentator = get_weka_segmentator(model_path, cache_size_in_mb)
+    result = segmentator.applyClassifier( imp, [tiles_per_dim, tiles_per_dim], num_threads, True ) #ImagePlus imp, int[x,y,z] tilesPerDim, int numThreads (0=all), boolean probabilityMaps
+
+    return result
+
+
+def get_file_hash(path):
+    """compute the MD5 hex digest of a file's content
+
+    Parameters
+    ----------
+    path : string
+        path to the file
+
+    Returns
+    -------
+    string
+        the hex digest of the file content
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as input_file:
+        chunk = input_file.read(1024 * 1024)
+        while chunk:
+            md5.update(chunk)
+            chunk = input_file.read(1024 * 1024)
+
+    return md5.hexdigest()
+
+
+def get_file_signature(path):
+    """get a cheap signature of a file that changes whenever the file is replaced or modified,
+    without reading its content
+
+    Parameters
+    ----------
+    path : string
+        the file
+
+    Returns
+    -------
+    string
+        the size and the modification time of the file
+    """
+    return str( os.path.getsize(path) ) + "|" + str( os.path.getmtime(path) )
+
+
+def get_image_key(path):
+    """identify an image file by its path, size and modification time. Unlike get_file_hash this
+    does not read the file, which takes minutes for a whole slide.
+
+    Parameters
+    ----------
+    path : string
+        path to the image file
+
+    Returns
+    -------
+    string
+        a hex digest that changes whenever the file is moved, replaced or modified
+    """
+    return hashlib.md5( os.path.abspath(path) + "|" + get_file_signature(path) ).hexdigest()
+
+
+def get_probability_map_cache_key(image_hash, series, channel, model_hashes, tiles_per_dim, pixel_size):
+    """build the cache key of a WEKA probability map from everything the segmentation depends on
+
+    Parameters
+    ----------
+    image_hash : string
+        the key of the image file, see get_image_key
+    series : integer
+        the series of the image file that was segmented. starts at 0.
+    channel : integer
+        the membrane channel that was segmented. starts at 1.
+    model_hashes : array
+        the hashes of all model files applied to the channel
+    tiles_per_dim : integer
+        the sub-tiling used for the classification
+    pixel_size : float
+        the pixel size at which the channel was segmented
+
+    Returns
+    -------
+    string
+        a hex digest identifying the probability map
+    """
+    key_parts = [image_hash, str(series), str(channel), str(tiles_per_dim), str(pixel_size)]
+    key_parts.extend(model_hashes)
+
+    return hashlib.md5("|".join(key_parts)).hexdigest()
+
+
+def open_cached_probability_map(cache_dir, cache_key):
+    """open a probability map from the cache and mark it as recently used
+
+    Parameters
+    ----------
+    cache_dir : string
+        the directory of the probability map cache
+    cache_key : string
+        the key as returned by get_probability_map_cache_key
+
+    Returns
+    -------
+    ImagePlus
+        the cached probability map or None if it is not in the cache
+    """
+    cached_file = File(cache_dir + "/" + cache_key + ".tif")
+    if not cached_file.exists():
+        return None
+
+    cached_file.setLastModified( System.currentTimeMillis() )
+
+    return IJ.openImage( cached_file.getPath() )
+
+
+def save_probability_map_to_cache(cache_dir, cache_key, imp, cache_size_in_mb):
+    """store a probability map in the cache and evict the least recently used maps if the cache is full
+
+    Parameters
+    ----------
+    cache_dir : string
+        the directory of the probability map cache
+    cache_key : string
+        the key as returned by get_probability_map_cache_key
+    imp : ImagePlus
+        the probability map to store
+    cache_size_in_mb : integer
+        the maximum total size of all files in the cache in MB
+    """
+    if not os.path.exists( cache_dir ):
+        os.makedirs( cache_dir )
+
+    IJ.saveAsTiff( imp, cache_dir + "/" + cache_key + ".tif" )
+
+    cached_files = [ File(cache_dir, name) for name in os.listdir(cache_dir) if name.endswith(".tif") ]
+    cached_files.sort( key=lambda cached_file: cached_file.lastModified() )
+    cached_bytes = sum( [cached_file.length() for cached_file in cached_files] )
+    # never evict the newest file, i.e. the one just stored
+    for cached_file in cached_files[:-1]:
+        if cached_bytes <= cache_size_in_mb * 1024 * 1024:
+            break
+        cached_bytes -= cached_file.length()
+        cached_file.delete()
+
+
+def read_journal(journal_path):
+    """read the journal of a previous run
+
+    Parameters
+    ----------
+    journal_path : string
+        path to the journal file
+
+    Returns
+    -------
+    dict
+        the journal as written by write_journal, or None if there is none (or it is unreadable)
+    """
+    if not os.path.isfile(journal_path):
+        return None
+    try:
+        with open(journal_path) as journal_file:
+            return json.load(journal_file)
+    except ValueError:
+        return None
+
+
+def is_journal_complete(journal_path, input_hashes, parameters):
+    """check if a previous run used the same inputs and parameters and all of its outputs still exist
+
+    Parameters
+    ----------
+    journal_path : string
+        path to the journal file
+    input_hashes : dict
+        the hash of every input file of this run, by path
+    parameters : dict
+        the parameters of this run that influence the results
+
+    Returns
+    -------
+    boolean
+        True if the run can be skipped
+    """
+    journal = read_journal(journal_path)
+    if journal is None:
+        return False
+    if journal["inputs"] != input_hashes or journal["parameters"] != parameters:
+        return False
+
+    return all( [os.path.isfile(artifact) for artifact in journal["artifacts"]] )
+
+
+def write_journal(journal_path, input_hashes, parameters, artifacts):
+    """record a completed run, so a re-run with the same inputs and parameters can be skipped
+
+    Parameters
+    ----------
+    journal_path : string
+        path to the journal file
+    input_hashes : dict
+        the hash of every input file, by path
+    parameters : dict
+        the parameters that influence the results
+    artifacts : array
+        the paths of all files written by the run
+    """
+    journal = {
+        "inputs": input_hashes,
+        "parameters": parameters,
+        "artifacts": artifacts,
+        "finished": time.strftime("%Y-%m-%d %H:%M:%S"),
+    }
+    with open(journal_path, "w") as journal_file:
+        json.dump(journal, journal_file, indent=2, sort_keys=True)
+
+
+def process_weka_result(imp):
+    """apply myosoft pre-processing steps for the imp after WEKA classification to prepare it
+    for ROI detection with the particle analyzer
+
+    Parameters
+    ----------
+    imp : ImagePlus
+        a single channel (= desired class) of the WEKA classification result imp
+    """
+    IJ.run(imp, "8-bit", "")
+    IJ.run(imp, "Median...", "radius=3")
+    IJ.run(imp, "Gaussian Blur...", "sigma=2")
+    IJ.run(imp, "Auto Threshold", "method=MaxEntropy")
+    IJ.run(imp, "Invert", "")
+
+
+def delete_channel(imp, channel_number):
+    """delete a channel from target imp
+
+    Parameters
+    ----------
+    imp : ImagePlus
+        the imp from which to delete target channel
+    channel_number : integer
+        the channel number to be deleted. starts at 0.
+    """
+    imp.setC(channel_number)
+    IJ.run(imp, "Delete Slice", "delete=channel")
+
+
+def build_particle_shape_table( imp ):
+    """identifies all particles in a binary imp once and collects their shape descriptors in a table
+
+    The particle analysis runs without any gate, so different sets of morphometric gates can be
+    applied to the table afterwards without tracing the particles again (see gate_particle_shape_table).
+
+    Parameters
+    ----------
+    imp : ImagePlus
+        the binary image in which to identify the particles (white particles on black background)
+
+    Returns
+    -------
+    dict
+        the particle ROIs ("rois") and one array per shape descriptor, all in calibrated units:
+        "Area", "Perim.", "Circ.", "Round", "Solidity", "FeretAR" and "MinFeret"
+    """
+    shape_rt = ResultsTable()
+    particle_rm = RoiManager(True)
+    measurements = Measurements.AREA | Measurements.PERIMETER | Measurements.SHAPE_DESCRIPTORS | Measurements.FERET
+    ParticleAnalyzer.setRoiManager(particle_rm)
+    analyzer = ParticleAnalyzer(ParticleAnalyzer.ADD_TO_MANAGER, measurements, shape_rt, 0, Double.POSITIVE_INFINITY)
+    analyzer.setHideOutputImage(True)
+
+    ip = imp.getProcessor()
+    ip.setThreshold(255, 255, ImageProcessor.NO_LUT_UPDATE)
+    analyzer.analyze(imp, ip)
+    ip.resetThreshold()
+
+    shape_table = { "rois": particle_rm.getRoisAsArray() }
+    particle_rm.close()
+    for column in ["Area", "Perim.", "Circ.", "Round", "Solidity", "MinFeret"]:
+        shape_table[column] = array("d")
+        if shape_rt.size() > 0:
+            shape_table[column].extend( shape_rt.getColumnAsDoubles( shape_rt.getColumnIndex(column) ) )
+
+    # the feret aspect ratio as defined by the extended particle analyzer
+    shape_table["FeretAR"] = array("d")
+    if shape_rt.size() > 0:
+        ferets = shape_rt.getColumnAsDoubles( shape_rt.getColumnIndex("Feret") )
+        shape_table["FeretAR"].extend( [ feret / min_feret if min_feret > 0 else 0.0
+            for feret, min_feret in zip(ferets, shape_table["MinFeret"]) ] )
+
+    return shape_table
+
+
+def gate_particle_shape_table( shape_table, eda_parameters ):
+    """applies the morphometric gates to the shape descriptors of all particles
+
+    Parameters
+    ----------
+    shape_table : dict
+        the particle shape table as returned by build_particle_shape_table
+    eda_parameters : array
+        all user defined parameters to restrict ROI identification, as lower and upper limit pairs
+        for area, perimeter, circularity, roundness, solidity, feret AR and min feret
+
+    Returns
+    -------
+    array
+        the indices of the particles passing all gates
+    """
+    gated_columns = ["Area", "Perim.", "Circ.", "Round", "Solidity", "FeretAR", "MinFeret"]
+    selected_particles = range( len(shape_table["rois"]) )
+    for index, column in enumerate(gated_columns):
+        lower_limit = eda_parameters[2 * index]
+        upper_limit = eda_parameters[2 * index + 1]
+        values = shape_table[column]
+        selected_particles = [ i for i in selected_particles if lower_limit <= values[i] <= upper_limit ]
+
+    return selected_particles
+
+
+def open_image_reader(path_to_file):
+    """open a Bio-Formats reader on an image file to read planes or regions of it on demand
+
+    Parameters
+    ----------
+    path_to_file : string
+        path to the image file
+
+    Returns
+    -------
+    ImageProcessorReader
+        the reader, returning one ImageProcessor per channel. Close it when done.
+    """
+    reader = ImageProcessorReader( ChannelSeparator( LociPrefs.makeImageReader() ) )
+    reader.setMetadataStore( MetadataTools.createOMEXMLMetadata() )
+    reader.setFlattenedResolutions(False) # pyramid levels are resolutions of a series, not series of their own
+    reader.setId(path_to_file)
+
+    return reader
+
+
+def get_calibration_from_reader(reader):
+    """get the spatial calibration of the current series of an opened image file
+
+    Parameters
+    ----------
+    reader : ImageProcessorReader
+        the reader as returned by open_image_reader
+
+    Returns
+    -------
+    Calibration
+        the pixel size in microns, or an uncalibrated Calibration if the file has none
+    """
+    calibration = Calibration()
+    metadata = reader.getMetadataStore()
+    pixel_width = metadata.getPixelsPhysicalSizeX( reader.getSeries() )
+    pixel_height = metadata.getPixelsPhysicalSizeY( reader.getSeries() )
+    if pixel_width is not None and pixel_height is not None:
+        calibration.pixelWidth = pixel_width.value(UNITS.MICROMETER).doubleValue()
+        calibration.pixelHeight = pixel_height.value(UNITS.MICROMETER).doubleValue()
+        calibration.setUnit("micron")
+
+    return calibration
+
+
+def open_series_from_reader(reader, title, channels):
+    """read the first plane of some channels of the current series of an opened image file
+
+    Only the requested channels are read, so an image with many channels takes only a fraction of
+    the memory and read time if few of them are needed.
+
+    Parameters
+    ----------
+    reader : ImageProcessorReader
+        the reader as returned by open_image_reader, set to the series to read
+    title : string
+        the title of the new image
+    channels : array
+        the channels to read, starting at 1. They become channels 1, 2, ... of the new image in
+        this order.
+
+    Returns
+    -------
+    ImagePlus
+        the full resolution channels with their spatial calibration, as a grayscale composite if
+        there are several, each channel scaled to its own min and max
+    """
+    reader.setResolution(0)
+    stack = ImageStack( reader.getSizeX(), reader.getSizeY() )
+    for channel in channels:
+        stack.addSlice( "C" + str(channel), reader.openProcessors( reader.getIndex(0, channel - 1, 0) )[0] ) # z, c, t
+
+    imp = ImagePlus(title, stack)
+    imp.setDimensions(len(channels), 1, 1)
+    imp.setCalibration( get_calibration_from_reader(reader) )
+    if len(channels) > 1:
+        imp = CompositeImage(imp, IJ.GRAYSCALE)
+    for channel in range(1, len(channels) + 1):
+        imp.setC(channel)
+        imp.resetDisplayRange()
+    imp.setC(1)
+
+    return imp
+
+
+def get_image_title_from_path(path_to_file, series=None):
+    """get the image title of an image file the same way as when opening it with Bio-Formats,
+    without opening it
+
+    Parameters
+    ----------
+    path_to_file : string
+        path to the image file
+    series : integer, optional
+        the series of a multi-series file, starts at 0. Its number is appended as "_Series<n>".
+
+    Returns
+    -------
+    string
+        the image title as returned by fix_BF_czi_imagetitle
+    """
+    title_imp = ImagePlus()
+    if series is None:
+        title_imp.setTitle( os.path.basename(path_to_file) )
+    else:
+        title_imp.setTitle( os.path.basename(path_to_file) + " #" + str(series + 1) )
+
+    return fix_BF_czi_imagetitle(title_imp)
+
+
+def read_tile(reader, channel, region):
+    """read a region of one channel of the first plane of an image file
+
+    Parameters
+    ----------
+    reader : ImageProcessorReader
+        the reader as returned by open_image_reader
+    channel : integer
+        the channel to read. starts at 1.
+    region : Rectangle
+        the region to read in pixels
+
+    Returns
+    -------
+    ImageProcessor
+        the pixels of the region
+    """
+    plane_index = reader.getIndex(0, channel - 1, 0) # z, c, t
+    return reader.openProcessors(plane_index, region.x, region.y, region.width, region.height)[0]
+
+
+def get_threshold_from_histogram(histogram, method):
+    """returns the lower threshold of an IJ AutoThreshold method for a dark background, computed
+    from a channel histogram the same way as ImageProcessor.setAutoThreshold does on the image
+
+    Parameters
+    ----------
+    histogram : array
+        the pixel count of every intensity value (256 bins for 8-bit, 65536 bins for 16-bit images)
+    method : string
+        the AutoThreshold method to use
+
+    Returns
+    -------
+    float
+        the lower threshold
+    """
+    if len(histogram) == 256:
+        return AutoThresholder().getThreshold( method, array("i", histogram) ) + 1
+
+    # 16-bit: IJ thresholds the 8-bit conversion of the display range, i.e. min to max for autoscaled images
+    occupied = [value for value, count in enumerate(histogram) if count > 0]
+    min_value = occupied[0]
+    max_value = occupied[-1]
+    scale = 256.0 / (max_value - min_value + 1)
+    byte_histogram = array("i", [0] * 256)
+    for value in occupied:
+        byte_histogram[ min(int( (value - min_value) * scale + 0.5 ), 255) ] += histogram[value]
+    lower_threshold = min(AutoThresholder().getThreshold(method, byte_histogram) + 1, 255)
+
+    return min_value + (lower_threshold / 255.0) * (max_value - min_value)
+
+
+def get_histogram_cache_path(cache_dir, image_hash, series):
+    """returns the path of the cached channel histograms of an image series
+
+    Parameters
+    ----------
+    cache_dir : string
+        the directory of the histogram cache
+    image_hash : string
+        the key of the image file, as returned by get_image_key
+    series : integer
+        the series of the image. starts at 0.
+
+    Returns
+    -------
+    string
+        the path to the JSON file with the histograms of all cached channels of the series
+    """
+    return cache_dir + "/" + image_hash + "_series" + str(series) + "_histograms.json"
+
+
+def read_histogram_cache(cache_path):
+    """read the cached channel histograms of an image series
+
+    Parameters
+    ----------
+    cache_path : string
+        the path as returned by get_histogram_cache_path
+
+    Returns
+    -------
+    dict
+        the sparse histograms keyed by channel, empty if there is no readable cache
+    """
+    if not os.path.isfile(cache_path):
+        return {}
+    try:
+        with open(cache_path) as cache_file:
+            return json.load(cache_file)
+    except ValueError:
+        return {}
+
+
+def get_cached_channel_histogram(cache_dir, image_hash, series, channel, reader, tile_size):
+    """returns the histogram of an image channel from the histogram cache, reading the channel tile
+    by tile and caching its histogram if missing
+
+    The histograms are keyed by the image key, so all scripts writing to the same output directory
+    share them and every AutoThreshold method becomes a lookup. Only the occupied bins are stored.
+    The cache file is replaced atomically, so parallel workers never read a partially written file.
+
+    Parameters
+    ----------
+    cache_dir : string
+        the directory of the histogram cache
+    image_hash : string
+        the key of the image file, as returned by get_image_key
+    series : integer
+        the series of the image. starts at 0.
+    channel : integer
+        the channel of the image. starts at 1.
+    reader : ImageProcessorReader
+        the reader as returned by open_image_reader, set to the series at full resolution
+    tile_size : integer
+        the edge length of the tiles that are read at once, e.g. HISTOGRAM_TILE_SIZE
+
+    Returns
+    -------
+    array
+        the pixel count of every intensity value (256 bins for 8-bit, 65536 bins for 16-bit images)
+    """
+    cache_path = get_histogram_cache_path(cache_dir, image_hash, series)
+    cached_histogram = read_histogram_cache(cache_path).get( str(channel) )
+    if cached_histogram is not None:
+        histogram = array("l", [0] * cached_histogram["bins"])
+        for value, count in cached_histogram["counts"]:
+            histogram[value] = count
+        return histogram
+
+    histogram = get_channel_histogram(reader, channel, tile_size)
+    try:
+        os.makedirs(cache_dir)
+    except OSError:
+        if not os.path.isdir(cache_dir): # otherwise created by a parallel worker
+            raise
+    cache = read_histogram_cache(cache_path)
+    cache[ str(channel) ] = { "bins": len(histogram),
+        "counts": [ [value, count] for value, count in enumerate(histogram) if count > 0 ] }
+    # write next to the cache and move into place. A channel added by a parallel worker in between
+    # may get lost, it is then counted again by the next run that needs it.
+    temp_file = File.createTempFile(os.path.basename(cache_path), ".tmp", File(cache_dir))
+    with open(temp_file.getPath(), "w") as cache_file:
+        json.dump(cache, cache_file)
+    Files.move( temp_file.toPath(), File(cache_path).toPath(), StandardCopyOption.REPLACE_EXISTING, StandardCopyOption.ATOMIC_MOVE )
+
+    return histogram
+
+
+def read_dataset_thresholds(path, channels):
+    """read the dataset-wide thresholds written by 2_dataset_thresholds.py
+
+    Parameters
+    ----------
+    path : string
+        path to the dataset_thresholds.json
+    channels : array
+        the channels that need a threshold. starts at 1.
+
+    Returns
+    -------
+    dict
+        the threshold of each of the channels, keyed by channel
+    """
+    with open(path) as thresholds_file:
+        thresholds = json.load(thresholds_file)["thresholds"]
+    missing_channels = [ str(channel) for channel in channels if str(channel) not in thresholds ]
+    if missing_channels:
+        raise ValueError(path + " has no threshold for channel " + ", ".join(missing_channels))
+
+    return dict( [ (channel, thresholds[ str(channel) ]) for channel in channels ] )
+
+
+def open_channel_downsampled(reader, channel, pixel_size, calibration):
+    """open one channel of an image file at a lower resolution, using its resolution pyramid if present
+
+    The pyramid level closest to (but not coarser than) the requested pixel size is read, and
+    downsampled further by averaging if it does not match the requested pixel size.
+
+    Parameters
+    ----------
+    reader : ImageProcessorReader
+        the reader as returned by open_image_reader, set to the series to read
+    channel : integer
+        the channel to open. starts at 1.
+    pixel_size : float
+        the desired pixel size in calibrated units
+    calibration : Calibration
+        the spatial calibration of the full resolution image
+
+    Returns
+    -------
+    ImagePlus
+        the downsampled channel with a matching calibration
+    """
+    reader.setResolution(0)
+    full_width = reader.getSizeX()
+    full_height = reader.getSizeY()
+    downsampling = pixel_size / calibration.pixelWidth
+
+    pyramid_level = 0
+    for level in range( reader.getResolutionCount() ):
+        reader.setResolution(level)
+        if float(full_width) / reader.getSizeX() <= downsampling:
+            pyramid_level = level
+    reader.setResolution(pyramid_level)
+    ip = read_tile( reader, channel, Rectangle(0, 0, reader.getSizeX(), reader.getSizeY()) )
+    reader.setResolution(0)
+
+    target_width = int( round(full_width / downsampling) )
+    target_height = int( round(full_height / downsampling) )
+    if ip.getWidth() > target_width:
+        ip.setInterpolationMethod(ImageProcessor.BILINEAR)
+        ip = ip.resize(target_width, target_height, True) # average when downsizing
+
+    imp = ImagePlus("membrane_downsampled", ip)
+    downsampled_calibration = calibration.copy()
+    downsampled_calibration.pixelWidth = calibration.pixelWidth * full_width / ip.getWidth()
+    downsampled_calibration.pixelHeight = calibration.pixelHeight * full_height / ip.getHeight()
+    imp.setCalibration(downsampled_calibration)
+
+    return imp
+
+
+def scale_roi(roi, x_scale, y_scale):
+    """scale a ROI relative to the image origin, e.g. to map it from a downsampled image to the full resolution
+
+    Parameters
+    ----------
+    roi : Roi
+        the ROI to scale
+    x_scale : float
+        the scaling factor in x
+    y_scale : float
+        the scaling factor in y
+
+    Returns
+    -------
+    PolygonRoi
+        the scaled ROI
+    """
+    polygon = roi.getFloatPolygon()
+    x_points = array("f", [x * x_scale for x in polygon.xpoints[:polygon.npoints]])
+    y_points = array("f", [y * y_scale for y in polygon.ypoints[:polygon.npoints]])
+
+    return PolygonRoi( FloatPolygon(x_points, y_points, polygon.npoints), Roi.POLYGON )
+
+
+def measure_in_all_rois( imp, channel, rm ):
+    """measures in all ROIS on a given channel of imp all parameters that are set in IJ "Set Measurements"
+
+    Parameters
+    ----------
+    imp : ImagePlus
+        the imp to measure on
+    channel : integer
+        the channel to measure in. starts at 1.
+    rm : RoiManager
+        a reference of the IJ-RoiManager
+    """
+    imp.setC(channel)
+    rm.runCommand(imp,"Deselect")
+    rm.runCommand(imp,"Measure")
+
+
+def set_roi_attributes( rm, indexes=None, color=None, names=None ):
+    """change the color and/or the names of many ROIs in the RoiManager in one operation on its ROIs,
+    instead of selecting and changing them one by one
+
+    Parameters
+    ----------
+    rm : RoiManager
+        a reference of the IJ-RoiManager
+    indexes : array, optional
+        the ROIs in the RoiManager to change. All ROIs if not given.
+    color : string, optional
+        the desired color. e.g. "green", "red", "yellow", "magenta" ...
+    names : array, optional
+        the new names, one per changed ROI
+    """
+    rois = rm.getRoisAsArray() # the ROIs themselves, not copies
+    if indexes is None:
+        indexes = range( len(rois) )
+    stroke_color = Colors.decode(color, None) if color is not None else None
+    for position, index in enumerate(indexes):
+        if stroke_color is not None:
+            rois[index].setStrokeColor(stroke_color)
+        if names is not None:
+            rois[index].setName( names[position] )
+
+    if names is not None:
+        # the list of the RoiManager keeps its own copy of the names, it is rebuilt once from the ROIs
+        overlay = Overlay()
+        for roi in rois:
+            overlay.add(roi)
+        rm.reset()
+        rm.setOverlay(overlay)
+    # refresh the list and the ROIs shown on the image once for all changes
+    if not GraphicsEnvironment.isHeadless():
+        rm.repaint()
+        rm.updateShowAll()
+
+
+def change_all_roi_color( rm, color ):
+    """change the color of all ROIs in the RoiManager
+
+    Parameters
+    ----------
+    rm : RoiManager
+        a reference of the IJ-RoiManager
+    color : string
+        the desired color. e.g. "green", "red", "yellow", "magenta" ...
+    """
+    set_roi_attributes( rm, color=color )
+
+
+def change_subset_roi_color( rm, selected_rois, color ):
+    """change the color of selected ROIs in the RoiManager
+
+    Parameters
+    ----------
+    rm : RoiManager
+        a reference of the IJ-RoiManager
+    selected_rois : array
+        ROIs in the RoiManager to change
+    color : string
+        the desired color. e.g. "green", "red", "yellow", "magenta" ...
+    """
+    set_roi_attributes( rm, selected_rois, color=color )
+
+
+def show_all_rois_on_image(rm, imp):
+    """shows all ROIs in the ROiManager on imp
+
+    Parameters
+    ----------
+    rm : RoiManager
+        a reference of the IJ-RoiManager
+    imp : ImagePlus
+        the imp on which to show the ROIs
+    """
+    imp.show()
+    rm.runCommand(imp,"Show All")
+
+
+def write_roi_store(rois, columns, target):
+    """save ROIs to a ROI store: a single file with the outlines of all ROIs in contiguous arrays,
+    their names and colors, and integer columns per ROI, e.g. class flags. A subset of the ROIs is
+    then a column instead of another file with copies of the outlines.
+
+    Layout (big-endian): the magic "MYOROIS1", the length of a JSON header and the header itself,
+    then the vertex offsets (int, one per ROI plus the end), the x and the y coordinates of all
+    vertices (float), the colors (int, ARGB, 0 for none), the ROI types (byte) and one byte per ROI
+    for each column.
+
+    Parameters
+    ----------
+    rois : array
+        the ROIs to save, stored as their polygon outline
+    columns : dict
+        per column name a list with one value from 0 to 127 per ROI, e.g. 1 for the ROIs of a class
+    target : string
+        the path in to store the ROIs. e.g. /my-images/resulting_rois.roistore
+    """
+    polygons = [ roi.getFloatPolygon() for roi in rois ]
+    vertex_count = sum( [ polygon.npoints for polygon in polygons ] )
+    column_names = sorted( columns.keys() )
+    header = String( json.dumps( { "roi_count": len(rois), "vertex_count": vertex_count, "columns": column_names,
+        "names": [ roi.getName() for roi in rois ] } ) ).getBytes("UTF-8")
+
+    store = ByteBuffer.allocate( len(ROI_STORE_MAGIC) + 4 + len(header) + 4 * (len(rois) + 1) + 8 * vertex_count
+        + (5 + len(column_names)) * len(rois) )
+    store.put( String(ROI_STORE_MAGIC).getBytes("US-ASCII") )
+    store.putInt( len(header) )
+    store.put(header)
+    offset = 0
+    for polygon in polygons:
+        store.putInt(offset)
+        offset += polygon.npoints
+    store.putInt(offset)
+    for coordinates in ["xpoints", "ypoints"]:
+        # bulk copies through a float view of the buffer, which has its own position
+        float_view = store.asFloatBuffer()
+        for polygon in polygons:
+            float_view.put( getattr(polygon, coordinates), 0, polygon.npoints )
+        store.position( store.position() + 4 * vertex_count )
+    for roi in rois:
+        store.putInt( roi.getStrokeColor().getRGB() if roi.getStrokeColor() is not None else 0 )
+    store.put( jarray.array( [ roi.getType() if roi.getType() in [Roi.POLYGON, Roi.FREEROI, Roi.TRACED_ROI] else Roi.POLYGON
+        for roi in rois ], "b" ) )
+    for column_name in column_names:
+        store.put( jarray.array( columns[column_name], "b" ) )
+
+    store.flip()
+    output = FileOutputStream(target)
+    try:
+        output.getChannel().write(store)
+    finally:
+        output.close()
+
+
+def get_flag_column(row_count, flagged_rows):
+    """get a column for a ROI store that flags some ROIs with 1 and all others with 0
+
+    Parameters
+    ----------
+    row_count : integer
+        the number of ROIs
+    flagged_rows : array
+        the indexes of the ROIs to flag
+
+    Returns
+    -------
+    array
+        one value per ROI
+    """
+    flagged_rows = set(flagged_rows)
+
+    return [ 1 if row in flagged_rows else 0 for row in range(row_count) ]
+
+
+def save_all_rois(rm, target):
+    """save all ROIs in the RoiManager as zip to target path
+
+    Parameters
+    ----------
+    rm : RoiManager
+        a reference of the IJ-RoiManager
+    target : string
+        the path in to store the ROIs. e.g. /my-images/resulting_rois.zip
+    """
+    rm.runCommand("Save", target)
+
+
+def save_selected_rois( rm, selected_rois, target ):
+    """save selected ROIs in the RoiManager as zip to target path
+
+    Parameters
+    ----------
+    rm : RoiManager
+        a reference of the IJ-RoiManager
+    selected_rois : array
+        ROIs in the RoiManager to save
+    target : string
+        the path in to store the ROIs. e.g. /my-images/resulting_rois_subset.zip
+    """
+    rm.runCommand("Deselect")
+    rm.setSelectedIndexes(selected_rois)
+    rm.runCommand("save selected", target)
+    rm.runCommand("Deselect")
+
+
+def save_rois_to_zip(rois, target):
+    """save ROIs as a RoiManager compatible zip without going through the RoiManager.
+    The ROIs are named by their position, as after renumbering in the RoiManager.
+
+    Parameters
+    ----------
+    rois : array
+        the ROIs to save
+    target : string
+        the path in to store the ROIs. e.g. /my-images/resulting_rois.zip
+    """
+    zip_stream = ZipOutputStream( BufferedOutputStream( FileOutputStream(target) ) )
+    data_stream = DataOutputStream(zip_stream)
+    encoder = RoiEncoder(data_stream)
+    for index, roi in enumerate(rois):
+        zip_stream.putNextEntry( ZipEntry( str(index + 1) + ".roi" ) )
+        roi.setName( str(index + 1) )
+        encoder.write(roi)
+        data_stream.flush()
+    data_stream.close()
+
+
+def enlarge_all_rois( amount_in_um, rm, pixel_size_in_um ):
+    """enlarges all ROIs in the RoiManager by x scaled units
+
+    Parameters
+    ----------
+    amount_in_um : float
+        the value by which to enlarge in scaled units, e.g 3.5
+    rm : RoiManager
+        a reference of the IJ-RoiManager
+    pixel_size_in_um : float
+        the pixel size, e.g. 0.65 px/um
+    """
+    amount_px = amount_in_um / pixel_size_in_um
+    all_rois = rm.getRoisAsArray()
+    rm.reset()
+    for roi in all_rois:
+        enlarged_roi = RoiEnlarger.enlarge(roi, amount_px)
+        rm.addRoi(enlarged_roi)
+
+
+def run_stripes_in_parallel(measure_stripe, length, num_threads):
+    """split a range into consecutive stripes and process them in parallel threads
+
+    Parameters
+    ----------
+    measure_stripe : function
+        called with the first and the last (exclusive) index of each stripe
+    length : integer
+        the length of the range, e.g. the number of rows of an image
+    num_threads : integer
+        the number of stripes processed in parallel
+    """
+    stripe_length = max( 1, int( math.ceil( float(length) / max(1, num_threads) ) ) )
+    threads = [ threading.Thread( target=measure_stripe, args=( first, min(first + stripe_length, length) ) )
+        for first in range(0, length, stripe_length) ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def get_roi_mask(rois, region):
+    """rasterize ROIs into a mask of a region
+
+    Parameters
+    ----------
+    rois : list
+        the ROIs, in image coordinates
+    region : Rectangle
+        the region of the image, in image coordinates
+
+    Returns
+    -------
+    ByteProcessor
+        the mask of the region, 255 inside the ROIs and 0 elsewhere
+    """
+    mask_ip = ByteProcessor(region.width, region.height)
+    mask_ip.setValue(255)
+    for roi in rois:
+        shifted_roi = roi.clone()
+        shifted_roi.setLocation( roi.getXBase() - region.x, roi.getYBase() - region.y )
+        mask_ip.fill(shifted_roi)
+
+    return mask_ip
+
+
+def get_pixel_view(ip):
+    """create a processor on the pixels of another one, so that a thread can set its own ROI on the image
+    without copying it
+
+    Parameters
+    ----------
+    ip : ImageProcessor
+        an 8-bit, 16-bit or 32-bit image
+
+    Returns
+    -------
+    ImageProcessor
+        a processor of the same type that shares the pixel array of ip
+    """
+    if isinstance(ip, ByteProcessor):
+        return ByteProcessor( ip.getWidth(), ip.getHeight(), ip.getPixels() )
+    if isinstance(ip, ShortProcessor):
+        return ShortProcessor( ip.getWidth(), ip.getHeight(), ip.getPixels(), None )
+
+    return FloatProcessor( ip.getWidth(), ip.getHeight(), ip.getPixels() )
+
+
+def enlarge_all_rois_without_overlap( amount_in_um, rm, pixel_size_in_um, width, height, num_threads ):
+    """enlarges all ROIs in the RoiManager by x scaled units at once, without letting them grow into
+    each other: pixels between fibers go to the nearest fiber.
+
+    All fibers are grown together on one distance map of the background, split between the fibers by
+    its watershed (the Voronoi partition of the fibers). The cost of the distance transform does not
+    depend on the number of fibers, only the outlines are traced fiber by fiber.
+
+    Parameters
+    ----------
+    amount_in_um : float
+        the value by which to enlarge in scaled units, e.g 3.5
+    rm : RoiManager
+        a reference of the IJ-RoiManager
+    pixel_size_in_um : float
+        the pixel size, e.g. 0.65 px/um
+    width : integer
+        the width of the image the ROIs belong to
+    height : integer
+        the height of the image the ROIs belong to
+    num_threads : integer
+        the number of threads tracing the outlines in parallel
+    """
+    amount_px = amount_in_um / pixel_size_in_um
+    all_rois = rm.getRoisAsArray()
+    image_bounds = Rectangle(0, 0, width, height)
+
+    # the distance of every pixel to the nearest fiber, the fibers themselves are at 0
+    background_ip = get_roi_mask(all_rois, image_bounds)
+    background_ip.invert()
+    distance_ip = EDM().makeFloatEDM(background_ip, 0, False)
+    distance_ip.setThreshold(0, amount_px, ImageProcessor.NO_LUT_UPDATE)
+    grown_ip = distance_ip.createMask()
+    # on the negated distance map every fiber is a maximum, the watershed lines between them are
+    # the pixels equally far from two fibers
+    distance_ip.resetThreshold()
+    distance_ip.multiply(-1)
+    partition_ip = MaximumFinder().findMaxima( distance_ip, 0.5, ImageProcessor.NO_THRESHOLD, MaximumFinder.SEGMENTED, False, False )
+    grown_ip.copyBits(partition_ip, 0, 0, Blitter.AND)
+
+    enlarged_rois = list(all_rois)
+    margin = int( math.ceil(amount_px) ) + 1
+
+    def trace_rois(first_roi, last_roi):
+        tracer = ThresholdToSelection()
+        grown_view = get_pixel_view(grown_ip)
+        for index in xrange(first_roi, last_roi):
+            points = all_rois[index].getContainedPoints()
+            if len(points) == 0:
+                continue
+            region = all_rois[index].getBounds()
+            region.grow(margin, margin)
+            region = region.intersection(image_bounds)
+            grown_view.setRoi(region)
+            crop_ip = grown_view.crop()
+            # the grown fiber is the part of its watershed region that is connected to the fiber
+            crop_ip.setValue(128)
+            FloodFiller(crop_ip).fill( points[0].x - region.x, points[0].y - region.y )
+            crop_ip.setThreshold(128, 128, ImageProcessor.NO_LUT_UPDATE)
+            enlarged_roi = tracer.convert(crop_ip)
+            if enlarged_roi is None:
+                continue
+            enlarged_bounds = enlarged_roi.getBounds()
+            enlarged_roi.setLocation(region.x + enlarged_bounds.x, region.y + enlarged_bounds.y)
+            enlarged_rois[index] = enlarged_roi
+
+    run_stripes_in_parallel(trace_rois, len(all_rois), num_threads)
+    rm.reset()
+    for enlarged_roi in enlarged_rois:
+        rm.addRoi(enlarged_roi)
+
+
+def measure_rois(rois, ips, num_threads, histogram_bins):
+    """compute the intensity statistics of all ROIs in several images at once. The ROIs are split
+    between parallel threads, each measuring them with ImageJ on its own view of the images.
+
+    Parameters
+    ----------
+    rois : array
+        the ROIs to measure
+    ips : array
+        the images to measure (e.g. one per channel), all of the same size
+    num_threads : integer
+        the number of threads measuring ROIs in parallel
+    histogram_bins : integer
+        the number of histogram bins per ROI, spread over the intensity range of each image. 0 to
+        skip the histograms.
+
+    Returns
+    -------
+    array
+        per image a dict with the columns "Mean", "Min", "Max", "Sum" and "Count", each an array with
+        one value per ROI. ROIs without pixels have a mean, min and max of 0. With histogram bins, also
+        "Histogram" (the bins of the n-th ROI at index n * histogram_bins) and "HistogramRange" (the
+        lower and upper bound of the bins).
+    """
+    roi_count = len(rois)
+    all_stats = []
+    for ip in ips:
+        stats = dict( [ (column, array( 'd', [0] * roi_count )) for column in ["Mean", "Min", "Max", "Sum", "Count"] ] )
+        if histogram_bins > 0:
+            ip_stats = ip.getStatistics()
+            lower, upper = ip_stats.min, ip_stats.max
+            stats["Histogram"] = array( 'i', [0] * (roi_count * histogram_bins) )
+            stats["HistogramRange"] = (lower, upper)
+            # 8-bit statistics always have 256 bins, which are merged into the histogram bins
+            if isinstance(ip, ByteProcessor) and upper > lower:
+                stats["ByteBins"] = [ min( histogram_bins - 1, max( 0, int( (value - lower) * histogram_bins / (upper - lower) ) ) )
+                    for value in range(256) ]
+        all_stats.append(stats)
+
+    def measure_stripe(first_roi, last_roi):
+        views = [ get_pixel_view(ip) for ip in ips ]
+        for stats, view in zip(all_stats, views):
+            lower, upper = stats.get( "HistogramRange", (0, 0) )
+            if histogram_bins > 0 and upper > lower and "ByteBins" not in stats:
+                view.setHistogramRange(lower, upper)
+                view.setHistogramSize(histogram_bins)
+        for index in xrange(first_roi, last_roi):
+            for stats, view in zip(all_stats, views):
+                view.setRoi( rois[index] )
+                roi_stats = ImageStatistics.getStatistics(view, Measurements.MEAN | Measurements.MIN_MAX, None)
+                if roi_stats.pixelCount == 0:
+                    continue
+                stats["Count"][index] = roi_stats.pixelCount
+                stats["Mean"][index] = roi_stats.mean
+                stats["Min"][index] = roi_stats.min
+                stats["Max"][index] = roi_stats.max
+                stats["Sum"][index] = roi_stats.mean * roi_stats.pixelCount
+                if histogram_bins == 0:
+                    continue
+                offset = index * histogram_bins
+                lower, upper = stats["HistogramRange"]
+                if upper <= lower:
+                    stats["Histogram"][offset] = roi_stats.pixelCount # a flat image
+                elif "ByteBins" in stats:
+                    for value, histogram_bin in enumerate( stats["ByteBins"] ):
+                        stats["Histogram"][offset + histogram_bin] += roi_stats.histogram[value]
+                else:
+                    for histogram_bin in range(histogram_bins):
+                        stats["Histogram"][offset + histogram_bin] = roi_stats.histogram[histogram_bin]
+
+    run_stripes_in_parallel(measure_stripe, roi_count, num_threads)
+    for stats in all_stats:
+        stats.pop("ByteBins", None)
+
+    return all_stats
+
+
+def get_central_rois(rois, shrink, num_threads):
+    """shrink every ROI to its central region by scaling it by the factor shrink around its center,
+    like RoiScaler.scale does for the ROIs in the RoiManager. The ROIs themselves are not changed.
+
+    Parameters
+    ----------
+    rois : array
+        the ROIs to shrink
+    shrink : float
+        the scaling factor, e.g. 0.7
+    num_threads : integer
+        the number of threads shrinking ROIs in parallel
+
+    Returns
+    -------
+    array
+        one central ROI per ROI, new ROI objects that can be renamed without touching the originals
+    """
+    central_rois = [None] * len(rois)
+
+    def shrink_rois(first_roi, last_roi):
+        for index in xrange(first_roi, last_roi):
+            # RoiScaler returns the ROI itself for a factor of 1, so it gets a copy
+            central_rois[index] = RoiScaler.scale(rois[index].clone(), shrink, shrink, True)
+
+    run_stripes_in_parallel(shrink_rois, len(rois), num_threads)
+
+    return central_rois
+
+
+def select_central_nuclei( imp, channel, rm, min_intensity, central_rois=None ):
+    """For all ROIs in the RoiManager, select ROIs based on intensity measurement in given channel of imp.
+    All ROIs are measured at once, see measure_rois.
+
+    Parameters
+    ----------
+    imp : ImagePlus
+        the imp on which to measure
+    channel : integer
+        the channel on which to measure. starts at 1
+    rm : RoiManager
+        a reference of the IJ-RoiManager
+    min_intensity : integer
+        the selection criterion (here: minimum of the maximum intensity)
+    central_rois : array, optional
+        the regions to measure in instead of the ROIs, one per ROI, e.g. as returned by get_central_rois
+
+    Returns
+    -------
+    array
+        a selection of ROIs which passed the selection criterion (are above the threshold)
+    """
+    measured_rois = central_rois if central_rois is not None else rm.getRoisAsArray()
+    imp.setC(channel)
+    stats = measure_rois( measured_rois, [imp.getProcessor()], Runtime.getRuntime().availableProcessors(), 0 )[0]
+
+    return [ i for i in range( len(measured_rois) ) if stats["Max"][i] > min_intensity ]
+
+
+def get_percentile_from_histogram(histogram, histogram_range, percentile):
+    """estimate a percentile of the pixel values from their histogram
+
+    Parameters
+    ----------
+    histogram : array
+        the pixel count per bin
+    histogram_range : array
+        the lower and upper bound of the bins
+    percentile : integer
+        the percentile to estimate, e.g. 50 for the median
+
+    Returns
+    -------
+    float
+        the upper edge of the bin in which the percentile falls. 0 for an empty histogram.
+    """
+    total = sum(histogram)
+    if total == 0:
+        return 0
+    bin_width = float( histogram_range[1] - histogram_range[0] ) / len(histogram)
+    cumulative = 0
+    for histogram_bin, count in enumerate(histogram):
+        cumulative += count
+        if cumulative >= total * percentile / 100.0:
+            return histogram_range[0] + (histogram_bin + 1) * bin_width
+
+    return histogram_range[1]
+
+
+def get_fiber_stats_cache_entry(stats, auto_threshold, histogram_bins):
+    """convert the per-fiber statistics of one channel into their entry of the fiber statistics cache
+
+    Parameters
+    ----------
+    stats : dict
+        the statistics of the channel as returned by measure_rois, with histograms
+    auto_threshold : float
+        the automatic threshold of the channel
+    histogram_bins : integer
+        the number of histogram bins per fiber
+
+    Returns
+    -------
+    dict
+        the mean, min, max, pixel count, 10th, 50th and 90th percentile and histogram of every fiber,
+        the range of the histogram bins and the automatic threshold of the channel
+    """
+    fiber_count = len(stats["Mean"])
+    histograms = [ list( stats["Histogram"][fiber * histogram_bins:(fiber + 1) * histogram_bins] ) for fiber in range(fiber_count) ]
+    entry = { "mean": list(stats["Mean"]), "min": list(stats["Min"]), "max": list(stats["Max"]),
+        "count": list(stats["Count"]), "histogram": histograms, "histogram_range": list(stats["HistogramRange"]),
+        "auto_threshold": auto_threshold }
+    for percentile in [10, 50, 90]:
+        entry["p" + str(percentile)] = [ get_percentile_from_histogram(histogram, stats["HistogramRange"], percentile)
+            for histogram in histograms ]
+
+    return entry
+
+
+def get_fiber_stats_cache_path(rois_path):
+    """get the path of the fiber statistics cache that belongs to a ROI-zip
+
+    Parameters
+    ----------
+    rois_path : string
+        the ROI-zip with the fibers
+
+    Returns
+    -------
+    string
+        the path of the cache, next to the ROI-zip
+    """
+    return os.path.splitext(rois_path)[0] + "_fiber_stats.json"
+
+
+def read_fiber_stats_cache(cache_path, rois_hash, image_signature, series, channels):
+    """read the fiber statistics cache of a previous run, if it is still valid
+
+    Parameters
+    ----------
+    cache_path : string
+        the path of the cache as returned by get_fiber_stats_cache_path
+    rois_hash : string
+        the hash of the ROI-zip the fibers come from
+    image_signature : string
+        the signature of the image as returned by get_file_signature
+    series : integer
+        the series of the image
+    channels : array
+        the channels the cache needs to contain
+
+    Returns
+    -------
+    dict
+        the cache or None if there is none, it belongs to another ROI-zip, image or series or it
+        lacks one of the channels
+    """
+    if not os.path.isfile(cache_path):
+        return None
+    try:
+        with open(cache_path) as cache_file:
+            cache = json.load(cache_file)
+    except ValueError:
+        return None
+    if cache.get("roi_zip") != rois_hash or cache.get("image") != image_signature or cache.get("series") != series:
+        return None
+    for channel in channels:
+        if str(channel) not in cache.get("channels", {}):
+            return None
+
+    return cache
+
+
+def write_fiber_stats_cache(cache_path, rois_hash, image_signature, series, shape_columns, channel_entries):
+    """write the fiber statistics cache, keeping the channels a previous run measured for the same
+    ROI-zip, image and series
+
+    Parameters
+    ----------
+    cache_path : string
+        the path of the cache as returned by get_fiber_stats_cache_path
+    rois_hash : string
+        the hash of the ROI-zip the fibers come from
+    image_signature : string
+        the signature of the image as returned by get_file_signature
+    series : integer
+        the series of the image
+    shape_columns : array
+        the size & shape measurements of the fibers as returned by get_results_columns
+    channel_entries : dict
+        per channel number the entry as returned by get_fiber_stats_cache_entry
+
+    Returns
+    -------
+    dict
+        the cache as written
+    """
+    cache = read_fiber_stats_cache(cache_path, rois_hash, image_signature, series, [])
+    if cache is None:
+        cache = { "roi_zip": rois_hash, "image": image_signature, "series": series, "channels": {} }
+    cache["shape"] = shape_columns
+    for channel, entry in channel_entries.items():
+        cache["channels"][str(channel)] = entry
+    with open(cache_path, "w") as cache_file:
+        json.dump(cache, cache_file)
+
+    return cache
+
+
+def get_results_columns(rt):
+    """get all numeric columns and the row labels of a ResultsTable
+
+    Parameters
+    ----------
+    rt : ResultsTable
+        a reference of the IJ-ResultsTable
+
+    Returns
+    -------
+    array
+        the columns in their order, each a list of the heading and the values
+    """
+    columns = []
+    for heading in rt.getHeadings():
+        if heading == " ":
+            continue
+        if heading == "Label":
+            columns.append( [ heading, [ rt.getLabel(row) for row in range( rt.size() ) ] ] )
+            continue
+        columns.append( [ heading, list( rt.getColumnAsDoubles( rt.getColumnIndex(heading) ) ) ] )
+
+    return columns
+
+
+def set_results_columns(rt, columns):
+    """replace the content of a ResultsTable by columns as returned by get_results_columns
+
+    Parameters
+    ----------
+    rt : ResultsTable
+        a reference of the IJ-ResultsTable
+    columns : array
+        the columns, each a list of the heading and the values
+    """
+    rt.reset()
+    if not columns:
+        return
+    for row in range( len(columns[0][1]) ):
+        rt.incrementCounter()
+        for heading, values in columns:
+            if heading == "Label":
+                rt.addLabel( values[row] )
+            else:
+                rt.addValue(heading, values[row])
+
+
+def add_results_column(columns, heading, values):
+    """add a column to results columns as returned by get_results_columns, replacing a column with
+    the same heading. Nothing is written to the ResultsTable until write_results.
+
+    Parameters
+    ----------
+    columns : array
+        the columns, each a list of the heading and the values
+    heading : string
+        the heading of the column
+    values : array
+        one value per row. Numbers for a numeric column, strings for a category column.
+    """
+    for column in columns:
+        if column[0] == heading:
+            column[1] = list(values)
+            return
+    columns.append( [ heading, list(values) ] )
+
+
+def add_yes_no_column(columns, heading, row_count, yes_rows):
+    """add a column that flags rows with "YES" and all others with "NO"
+
+    Parameters
+    ----------
+    columns : array
+        the columns, each a list of the heading and the values
+    heading : string
+        the heading of the column
+    row_count : integer
+        the number of rows
+    yes_rows : array
+        the row numbers to flag with "YES"
+    """
+    yes_rows = set(yes_rows)
+    add_results_column( columns, heading, [ "YES" if row in yes_rows else "NO" for row in range(row_count) ] )
+
+
+def write_results(rt, columns, target):
+    """fill the ResultsTable with the results columns once and save it
+
+    Parameters
+    ----------
+    rt : ResultsTable
+        a reference of the IJ-ResultsTable
+    columns : array
+        the columns, each a list of the heading and the values
+    target : string
+        the path of the csv file
+    """
+    set_results_columns(rt, columns)
+    if not GraphicsEnvironment.isHeadless():
+        rt.show("Results")
+    rt.save(target)
+
+
+def enhance_contrast( imp ):
+    """use "Auto" Contrast & Brightness settings in each channel of imp
+
+    Parameters
+    ----------
+    imp : ImagePlus
+        the imp on which to change C&B
+    """
+    for channel in range( imp.getDimensions()[2] ):
+        imp.setC(channel + 1) # IJ channels start at 1
+        IJ.run(imp, "Enhance Contrast", "saturated=0.35")
+
+
+def renumber_rois(rm):
+    """rename all ROIs in the RoiManager according to their number
+
+    Parameters
+    ----------
+    rm : RoiManager
+        a reference of the IJ-RoiManager
+    """
+    set_roi_attributes( rm, names=[ str(roi + 1) for roi in range( rm.getCount() ) ] )
+
+
+def create_composite(ips, title, display_settings=None):
+    """combine one image processor per channel into an image, a composite for several channels
+
+    Parameters
+    ----------
+    ips : array
+        the processors of the channels, all of the same size
+    title : string
+        the title of the image
+    display_settings : array, optional
+        per channel the LUT, display minimum and display maximum as returned by get_display_settings
+
+    Returns
+    -------
+    ImagePlus
+        the image
+    """
+    stack = ImageStack( ips[0].getWidth(), ips[0].getHeight() )
+    for channel, ip in enumerate(ips):
+        stack.addSlice("C" + str(channel + 1), ip)
+    imp = ImagePlus(title, stack)
+    imp.setDimensions( len(ips), 1, 1 )
+    if len(ips) > 1:
+        imp = CompositeImage(imp, IJ.COMPOSITE)
+    if display_settings is not None:
+        for channel, (lut, display_min, display_max) in enumerate(display_settings):
+            imp.setC(channel + 1)
+            if imp.isComposite():
+                imp.setChannelLut(lut)
+            else:
+                imp.getProcessor().setLut(lut)
+            imp.setDisplayRange(display_min, display_max)
+
+    return imp
+
+
+def get_display_settings(imp):
+    """get the LUT and the display range of every channel of imp
+
+    Parameters
+    ----------
+    imp : ImagePlus
+        the image
+
+    Returns
+    -------
+    array
+        per channel the LUT, display minimum and display maximum
+    """
+    display_settings = []
+    for channel in range( imp.getNChannels() ):
+        imp.setC(channel + 1)
+        lut = imp.getChannelLut() if imp.isComposite() else imp.getProcessor().getLut()
+        display_settings.append( (lut, imp.getDisplayRangeMin(), imp.getDisplayRangeMax()) )
+
+    return display_settings
+
+
+def get_current_channel_processors(imp):
+    """get the processors of all channels at the current z and t position of imp, without copying them
+
+    Parameters
+    ----------
+    imp : ImagePlus
+        the image
+
+    Returns
+    -------
+    array
+        one processor per channel
+    """
+    return [ imp.getStack().getProcessor( imp.getStackIndex( channel, imp.getZ(), imp.getT() ) )
+        for channel in range( 1, imp.getNChannels() + 1 ) ]
+
+
+def get_scaled_roi(roi, scale):
+    """scale a ROI and its position, keeping its color
+
+    Parameters
+    ----------
+    roi : Roi
+        the ROI to scale
+    scale : float
+        the scaling factor
+
+    Returns
+    -------
+    Roi
+        the scaled ROI, the ROI itself for a scaling factor of 1
+    """
+    if scale == 1:
+        return roi
+    scaled_roi = RoiScaler.scale(roi, scale, scale, False)
+    scaled_roi.setStrokeColor( roi.getStrokeColor() )
+
+    return scaled_roi
+
+
+def save_overview_pyramid(channel_ips, rois, display_settings, target, tile_size):
+    """save a zoomable Deep Zoom pyramid (target.dzi and the PNG tiles in target_files, e.g. for
+    OpenSeadragon) of an image with ROIs. Each level is half the size of the level above, starting at
+    full resolution, and only ever one tile is rendered at a time.
+
+    Parameters
+    ----------
+    channel_ips : array
+        one processor per channel of the image at full resolution
+    rois : array
+        the ROIs to draw, in their color
+    display_settings : array
+        per channel the LUT, display minimum and display maximum as returned by get_display_settings
+    target : string
+        the path to store the pyramid in, without the .dzi extension
+    tile_size : integer
+        the width and height of the tiles
+
+    Returns
+    -------
+    string
+        the path of the .dzi file
+    """
+    width = channel_ips[0].getWidth()
+    height = channel_ips[0].getHeight()
+    top_level = int( math.ceil( math.log( max(width, height), 2 ) ) ) if max(width, height) > 1 else 0
+    level_ips = channel_ips
+    for level in range(top_level, -1, -1):
+        level_width = level_ips[0].getWidth()
+        level_height = level_ips[0].getHeight()
+        scale = float(level_width) / width
+        level_dir = target + "_files/" + str(level)
+        if not os.path.exists(level_dir):
+            os.makedirs(level_dir)
+
+        # sort the ROIs into the tiles they touch, instead of testing every ROI on every tile
+        tile_rois = {}
+        for roi in rois:
+            scaled_roi = get_scaled_roi(roi, scale)
+            bounds = scaled_roi.getBounds()
+            for row in range( max(0, bounds.y // tile_size), min(level_height - 1, bounds.y + bounds.height) // tile_size + 1 ):
+                for column in range( max(0, bounds.x // tile_size), min(level_width - 1, bounds.x + bounds.width) // tile_size + 1 ):
+                    tile_rois.setdefault( (column, row), [] ).append(scaled_roi)
+
+        for row in range( (level_height + tile_size - 1) // tile_size ):
+            for column in range( (level_width + tile_size - 1) // tile_size ):
+                bounds = Rectangle( column * tile_size, row * tile_size,
+                    min(tile_size, level_width - column * tile_size), min(tile_size, level_height - row * tile_size) )
+                tile_ips = []
+                for ip in level_ips:
+                    ip.setRoi(bounds)
+                    tile_ips.append( ip.crop() )
+                    ip.resetRoi()
+                tile = create_composite(tile_ips, str(column) + "_" + str(row), display_settings)
+                overlay = Overlay()
+                for roi in tile_rois.get( (column, row), [] ):
+                    tile_roi = roi.clone()
+                    tile_roi.setLocation( roi.getXBase() - bounds.x, roi.getYBase() - bounds.y )
+                    overlay.add(tile_roi)
+                tile.setOverlay(overlay)
+                IJ.saveAs(tile, "PNG", level_dir + "/" + str(column) + "_" + str(row))
+                tile.close()
+
+        # the next level is half the size, rounded up
+        if level > 0:
+            level_ips = [ ip.resize( max(1, (level_width + 1) // 2), max(1, (level_height + 1) // 2), True ) for ip in level_ips ]
+
+    with open(target + ".dzi", "w") as dzi_file:
+        dzi_file.write( '<?xml version="1.0" encoding="UTF-8"?>\n'
+            + '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" Format="png" Overlap="0" TileSize="' + str(tile_size) + '">\n'
+            + '  <Size Width="' + str(width) + '" Height="' + str(height) + '"/>\n'
+            + '</Image>\n' )
+
+    return target + ".dzi"
+
+
+def save_overview_png(imp, rm, target, max_size, save_pyramid):
+    """save an overview png of imp with all ROIs of the RoiManager in their colors, downsampled so that
+    its longer side is at most max_size. imp is neither duplicated, shown nor changed.
+
+    Parameters
+    ----------
+    imp : ImagePlus
+        the imp to save the overview of
+    rm : RoiManager
+        a reference of the IJ-RoiManager
+    target : string
+        the path to store the png in, without the .png extension
+    max_size : integer
+        the maximum width and height of the png in pixels. 0 for full resolution.
+    save_pyramid : boolean
+        also save a zoomable full resolution pyramid, see save_overview_pyramid
+
+    Returns
+    -------
+    array
+        the paths of the png and of the pyramid's .dzi file
+    """
+    channel_ips = get_current_channel_processors(imp)
+    scale = 1.0
+    if max_size > 0:
+        scale = min( 1.0, float(max_size) / max( imp.getWidth(), imp.getHeight() ) )
+    if scale < 1:
+        overview_width = max( 1, int( round(imp.getWidth() * scale) ) )
+        overview_height = max( 1, int( round(imp.getHeight() * scale) ) )
+        overview_ips = [ ip.resize(overview_width, overview_height, True) for ip in channel_ips ]
+    else:
+        # the processors are shared with imp, only their display range is changed, see below
+        overview_ips = channel_ips
+    display_ranges = [ (ip.getMin(), ip.getMax()) for ip in channel_ips ]
+
+    overview = create_composite( overview_ips, imp.getTitle() )
+    enhance_contrast( overview )
+    display_settings = get_display_settings(overview)
+    overlay = Overlay()
+    for roi in rm.getRoisAsArray():
+        overlay.add( get_scaled_roi(roi, scale) )
+    overview.setOverlay(overlay) # ROIs -> overlays so they show up in the saved png
+    IJ.saveAs(overview, "PNG", target)
+    overview.close()
+    for ip, (display_min, display_max) in zip(channel_ips, display_ranges):
+        ip.setMinAndMax(display_min, display_max)
+    written = [ target + ".png" ]
+
+    if save_pyramid:
+        written.append( save_overview_pyramid( channel_ips, rm.getRoisAsArray(), display_settings, target, 512 ) )
+
+    return written
+
+
+def get_resource_counters():
+    """read the wall time, the CPU time of this process and the garbage collections so far
+
+    Returns
+    -------
+    dict
+        the wall time and the CPU time in seconds, the number of garbage collections and their
+        accumulated time in seconds
+    """
+    collectors = ManagementFactory.getGarbageCollectorMXBeans()
+
+    return { "wall": time.time(),
+        "cpu": ManagementFactory.getOperatingSystemMXBean().getProcessCpuTime() / 1e9,
+        "gc_count": sum( [ max(0, collector.getCollectionCount()) for collector in collectors ] ),
+        "gc_time": sum( [ max(0, collector.getCollectionTime()) for collector in collectors ] ) / 1000.0 }
+
+
+def start_stage_timer(stage, rm):
+    """start recording the time and memory of the stages of an image, see time_stage
+
+    Parameters
+    ----------
+    stage : string
+        the name of the first stage
+    rm : RoiManager
+        a reference of the IJ-RoiManager, its ROIs are counted at the end of each stage
+
+    Returns
+    -------
+    dict
+        the timer to pass to time_stage and write_stage_timings
+    """
+    timer = { "rm": rm, "start": get_resource_counters(), "stages": [], "running": None }
+    time_stage(timer, stage)
+
+    return timer
+
+
+def time_stage(timer, stage):
+    """end the running stage and start the next one. A stage name may occur several times.
+
+    Per stage the wall and CPU time, the JVM heap high-water (summed peaks of the heap memory pools,
+    an upper bound), the heap in use at its end, the garbage collections, the number of ROIs and the
+    number of open images are recorded.
+
+    Parameters
+    ----------
+    timer : dict
+        the timer as returned by start_stage_timer
+    stage : string
+        the name of the next stage, None to only end the running stage
+    """
+    counters = get_resource_counters()
+    heap_pools = [ pool for pool in ManagementFactory.getMemoryPoolMXBeans() if pool.getType() == MemoryType.HEAP ]
+    if timer["running"] is not None:
+        running_stage, stage_start = timer["running"]
+        timer["stages"].append( {
+            "stage": running_stage,
+            "wall_time_s": counters["wall"] - stage_start["wall"],
+            "cpu_time_s": counters["cpu"] - stage_start["cpu"],
+            "heap_peak_mb": sum( [ pool.getPeakUsage().getUsed() for pool in heap_pools ] ) / (1024.0 * 1024.0),
+            "heap_used_mb": ManagementFactory.getMemoryMXBean().getHeapMemoryUsage().getUsed() / (1024.0 * 1024.0),
+            "gc_count": counters["gc_count"] - stage_start["gc_count"],
+            "gc_time_s": counters["gc_time"] - stage_start["gc_time"],
+            "roi_count": timer["rm"].getCount(),
+            "open_images": WindowManager.getImageCount() } )
+    timer["running"] = (stage, counters) if stage is not None else None
+    for pool in heap_pools:
+        pool.resetPeakUsage()
+
+
+def write_stage_timings(timer, target, script, image_title, series):
+    """end the running stage and save the timings of all stages as a JSON sidecar
+
+    Parameters
+    ----------
+    timer : dict
+        the timer as returned by start_stage_timer
+    target : string
+        the path of the JSON file, e.g. /my-images/image_timings.json
+    script : string
+        the name of the script, to tell the sidecars of the scripts apart when aggregating
+    image_title : string
+        the title of the image
+    series : integer
+        the series of the image
+
+    Returns
+    -------
+    string
+        the path of the written file
+    """
+    time_stage(timer, None)
+    end = get_resource_counters()
+    with open(target, "w") as timings_file:
+        json.dump( {
+            "script": script,
+            "image": image_title,
+            "series": series,
+            "wall_time_s": end["wall"] - timer["start"]["wall"],
+            "cpu_time_s": end["cpu"] - timer["start"]["cpu"],
+            "heap_max_mb": Runtime.getRuntime().maxMemory() / (1024.0 * 1024.0),
+            "stages": timer["stages"]
+        }, timings_file, indent=2 )
+
+    return target
+
+
+def log(message):
+    """write a message to the IJ log and keep it for save_log. Running headless, IJ only prints
+    the message to the console.
+
+    Parameters
+    ----------
+    message : string
+        the message, "\\Clear" clears the log
+    """
+    if message == "\\Clear":
+        del LOG_LINES[:]
+    else:
+        LOG_LINES.append(message)
+    IJ.log(message)
+
+
+def save_log(target):
+    """save the log as a text file, from the Log window or, running headless, from the messages
+    collected by log
+
+    Parameters
+    ----------
+    target : string
+        the path to store the log in, without the .txt extension
+
+    Returns
+    -------
+    string
+        the path of the saved log
+    """
+    if GraphicsEnvironment.isHeadless():
+        with open(target + ".txt", "w") as log_file:
+            for message in LOG_LINES:
+                log_file.write(message + "\n")
+    else:
+        IJ.selectWindow("Log")
+        IJ.saveAs("Text", target)
+
+    return target + ".txt"
+
+
+def setup_defined_ij(rm, rt):
+    """set up a clean and defined Fiji user environment
+
+    Parameters
+    ----------
+    rm : RoiManager
+        a reference of the IJ-RoiManager
+    rt : ResultsTable
+        a reference of the IJ-ResultsTable
+    """
+    fix_ij_options()
+    rm.runCommand('reset')
+    rt.reset()
+    log("\\Clear")
+
+
+def get_tile_grid(width, height, tile_size, overlap):
+    """split an image into tiles and add an overlap to each of them
+
+    Parameters
+    ----------
+    width : integer
+        the image width in pixels
+    height : integer
+        the image height in pixels
+    tile_size : integer
+        the edge length of the tiles in pixels, without overlap
+    overlap : integer
+        the number of pixels to add on each side of a tile, limited by the image borders
+
+    Returns
+    -------
+    array
+        one (core, region) pair of Rectangles per tile. The cores cover the image without overlap,
+        the regions are the cores extended by the overlap.
+    """
+    tiles = []
+    for y in range(0, height, tile_size):
+        for x in range(0, width, tile_size):
+            core = Rectangle( x, y, min(tile_size, width - x), min(tile_size, height - y) )
+            region_x = max(0, x - overlap)
+            region_y = max(0, y - overlap)
+            region = Rectangle( region_x, region_y,
+                min(width, x + core.width + overlap) - region_x,
+                min(height, y + core.height + overlap) - region_y )
+            tiles.append( (core, region) )
+
+    return tiles
+
+
+def get_channel_histogram(reader, channel, tile_size):
+    """compute the histogram of one channel by reading it tile by tile
+
+    Parameters
+    ----------
+    reader : ImageProcessorReader
+        the reader as returned by open_image_reader
+    channel : integer
+        the channel of which to compute the histogram. starts at 1.
+    tile_size : integer
+        the edge length of the tiles that are read at once
+
+    Returns
+    -------
+    array
+        the pixel count of every intensity value (256 bins for 8-bit, 65536 bins for 16-bit images)
+    """
+    histogram = None
+    for core, _ in get_tile_grid(reader.getSizeX(), reader.getSizeY(), tile_size, 0):
+        tile_histogram = read_tile(reader, channel, core).getHistogram()
+        if histogram is None:
+            histogram = array("l", [0] * len(tile_histogram))
+        for value, count in enumerate(tile_histogram):
+            if count > 0:
+                histogram[value] += count
+
+    return histogram
+
+
+def read_roi_store(path):
+    """read all ROIs and columns of a ROI store written by write_roi_store. The file is memory-mapped
+    and the coordinates are read in bulk.
+
+    Parameters
+    ----------
+    path : string
+        path to the ROI store
+
+    Returns
+    -------
+    dict
+        the ROIs ("rois", polygon ROIs with their names and colors) and the columns ("columns", per
+        column name a list with one value per ROI)
+    """
+    store_file = RandomAccessFile(path, "r")
+    try:
+        store = store_file.getChannel().map( FileChannel.MapMode.READ_ONLY, 0, store_file.length() )
+    finally:
+        store_file.close() # the mapping stays valid
+
+    magic = jarray.zeros( len(ROI_STORE_MAGIC), "b" )
+    store.get(magic)
+    if String(magic, "US-ASCII") != ROI_STORE_MAGIC:
+        raise ValueError(path + " is not a ROI store")
+    header = jarray.zeros( store.getInt(), "b" )
+    store.get(header)
+    header = json.loads( String(header, "UTF-8") )
+    roi_count = header["roi_count"]
+
+    offsets = jarray.zeros( roi_count + 1, "i" )
+    store.asIntBuffer().get(offsets)
+    store.position( store.position() + 4 * (roi_count + 1) )
+    all_coordinates = []
+    for dimension in range(2):
+        coordinates = jarray.zeros( header["vertex_count"], "f" )
+        store.asFloatBuffer().get(coordinates)
+        store.position( store.position() + 4 * header["vertex_count"] )
+        all_coordinates.append(coordinates)
+    colors = jarray.zeros( roi_count, "i" )
+    store.asIntBuffer().get(colors)
+    store.position( store.position() + 4 * roi_count )
+    types = jarray.zeros( roi_count, "b" )
+    store.get(types)
+    columns = {}
+    for column_name in header["columns"]:
+        values = jarray.zeros( roi_count, "b" )
+        store.get(values)
+        columns[column_name] = list(values)
+
+    rois = []
+    for index in range(roi_count):
+        first, last = offsets[index], offsets[index + 1]
+        roi = PolygonRoi( FloatPolygon( all_coordinates[0][first:last], all_coordinates[1][first:last] ), types[index] )
+        if header["names"][index]:
+            roi.setName( header["names"][index] )
+        if colors[index] != 0:
+            roi.setStrokeColor( Color(colors[index], True) )
+        rois.append(roi)
+
+    return { "rois": rois, "columns": columns }
+
+
+def open_rois_from_file( rm, path ):
+    """open the ROIs of a ROI-zip or a ROI store (.roistore) in the RoiManager
+
+    Parameters
+    ----------
+    rm : RoiManager
+        a reference of the IJ-RoiManager
+    path : string
+        path to the ROI-zip or ROI store
+    """
+    if path.lower().endswith(".roistore"):
+        # fill the RoiManager at once instead of ROI by ROI
+        overlay = Overlay()
+        for roi in read_roi_store(path)["rois"]:
+            overlay.add(roi)
+        rm.setOverlay(overlay)
+    else:
+        rm.runCommand("Open", path)
+
+
+def clear_ij_roi_manager(rm):
+    """delete all ROIs from the RoiManager
+
+    Parameters
+    ----------
+    rm : RoiManager
+        a reference of the IJ-RoiManager
+    """
+    rm.runCommand('reset')
+
+
+def get_series_roi_zip(roi_zip, series_titles, series):
+    """find the ROI-zip of a series, given the one selected for any series of the same file
+
+    Script 1) names its outputs and output folders after the series title, e.g.
+    "slide_Series2_all_fiber_rois.zip", so the ROI-zips of two series only differ in that title.
+
+    Parameters
+    ----------
+    roi_zip : string
+        path to the ROI-zip selected by the user
+    series_titles : array
+        the titles of all series of the image file
+    series : integer
+        the series to find the ROI-zip for. starts at 0.
+
+    Returns
+    -------
+    string
+        path to the ROI-zip of the series, or None if the selected ROI-zip belongs to none of the series
+    """
+    if len(series_titles) == 1:
+        return roi_zip
+
+    roi_dir, roi_name = os.path.split(roi_zip)
+    for title in series_titles:
+        if roi_name.startswith(title + "_"):
+            roi_dir = roi_dir.replace("/" + title + "/", "/" + series_titles[series] + "/")
+            return roi_dir + "/" + series_titles[series] + roi_name[len(title):]
+
+    return None
+
+
+def list_images(directory, extension, manifest):
+    """list the images to process, either from a manifest or from a directory
+
+    Parameters
+    ----------
+    directory : string
+        the directory with the images, used if there is no manifest
+    extension : string
+        the file extension of the images in the directory, e.g. ".czi"
+    manifest : string
+        path to a text file with one image path per line or None. Empty lines and lines starting
+        with # are ignored.
+
+    Returns
+    -------
+    array
+        the paths to all images
+    """
+    if manifest is not None:
+        with open(manifest) as manifest_lines:
+            return [ fix_ij_dirs( line.strip() ) for line in manifest_lines
+                if line.strip() and not line.strip().startswith("#") ]
+
+    return [ directory + "/" + name for name in sorted( os.listdir(directory) )
+        if name.lower().endswith( extension.lower() ) ]
@@ -0,0 +1,56 @@
+"""tests of jars/Lib/myosoft_common.py that run without Fiji: the Java and ImageJ modules are stubbed"""
+
+import os
+import sys
+import types
+
+try:
+    from unittest import mock
+except ImportError: # python 2
+    import mock
+
+import pytest
+
+
+LIB_DIR = os.path.join( os.path.dirname( os.path.dirname( os.path.abspath(__file__) ) ), "jars", "Lib" )
+JAVA_MODULES = ["ij", "ij.gui", "ij.plugin", "ij.measure", "ij.plugin.filter", "ij.plugin.frame", "ij.io", "ij.process",
+    "trainableSegmentation", "loci", "loci.plugins", "loci.plugins.util", "loci.formats", "ome", "ome.units", "java",
+    "java.awt", "java.io", "java.nio", "java.nio.channels", "java.lang", "java.lang.management", "java.util",
+    "java.nio.file", "java.util.zip", "jarray"]
+
+
+class StubModule(types.ModuleType):
+    """a module that returns a mock for every name imported from it"""
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        stub = mock.MagicMock(name=self.__name__ + "." + name)
+        setattr(self, name, stub)
+        return stub
+
+
+@pytest.fixture
+def common(monkeypatch):
+    for module_name in JAVA_MODULES:
+        monkeypatch.setitem( sys.modules, module_name, StubModule(module_name) )
+    monkeypatch.delitem( sys.modules, "myosoft_common", raising=False )
+    monkeypatch.syspath_prepend(LIB_DIR)
+    import myosoft_common
+    return myosoft_common
+
+
+def test_log_passes_messages_to_ij_and_keeps_them(common):
+    common.log("first")
+    common.log("second")
+
+    assert common.LOG_LINES == ["first", "second"]
+    common.IJ.log.assert_has_calls( [ mock.call("first"), mock.call("second") ] )
+
+
+def test_log_clear_empties_the_kept_lines(common):
+    common.log("first")
+    common.log("\\Clear")
+
+    assert common.LOG_LINES == []
+    common.IJ.log.assert_called_with("\\Clear")